@@ -1,16 +1,13 @@
 from django.contrib import admin
-from .models import ChatSession, Message
+from .models import ArchivedSession, ChatJob, ChatSession, DailyStats, Message, RetentionCheckpoint, UserRetention
 
 @admin.register(ChatSession)
 class ChatSessionAdmin(admin.ModelAdmin):
     list_display = ('user', 'title', 'created_at', 'updated_at', 'message_count')
     list_filter = ('created_at', 'updated_at')
     search_fields = ('user__username', 'user__email', 'title')
-    readonly_fields = ('created_at', 'updated_at')
-    
-    def message_count(self, obj):
-        return obj.messages.count()
-    message_count.short_description = 'Messages'
+    readonly_fields = ('created_at', 'updated_at', 'summary_through_id', 'summary_updated_at',
+                       'message_count', 'last_message_at', 'last_message_preview', 'last_message_is_user')
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
@@ -21,4 +18,38 @@ class MessageAdmin(admin.ModelAdmin):
     
     def short_content(self, obj):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
-    short_content.short_description = 'Content'
\ No newline at end of file
+    short_content.short_description = 'Content'
+
+@admin.register(UserRetention)
+class UserRetentionAdmin(admin.ModelAdmin):
+    list_display = ('user', 'days', 'updated_at')
+    search_fields = ('user__username', 'user__email')
+    raw_id_fields = ('user',)
+
+@admin.register(RetentionCheckpoint)
+class RetentionCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('name', 'last_id', 'updated_at')
+    readonly_fields = ('updated_at',)
+
+@admin.register(ArchivedSession)
+class ArchivedSessionAdmin(admin.ModelAdmin):
+    list_display = ('session_id', 'user', 'title', 'message_count', 'updated_at', 'archived_at', 'stored_bytes')
+    list_filter = ('archived_at',)
+    search_fields = ('user__username', 'user__email', 'title')
+    exclude = ('payload',)
+    readonly_fields = [field.name for field in ArchivedSession._meta.fields if field.name != 'payload']
+
+@admin.register(DailyStats)
+class DailyStatsAdmin(admin.ModelAdmin):
+    list_display = ('date', 'new_users', 'new_sessions', 'messages', 'active_users', 'cache_hits',
+                    'llm_latency_p50_ms', 'llm_latency_p95_ms', 'llm_latency_p99_ms')
+    date_hierarchy = 'date'
+    readonly_fields = [field.name for field in DailyStats._meta.fields]
+
+@admin.register(ChatJob)
+class ChatJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'chat_session', 'status', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('user__username', 'user__email')
+    raw_id_fields = ('user', 'chat_session', 'user_message', 'bot_message')
+    readonly_fields = ('created_at', 'queued_at', 'started_at', 'finished_at')
\ No newline at end of file
@@ -0,0 +1,160 @@
+import math
+from typing import Optional, Tuple
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+IVF_TYPES = ("ivf_flat", "ivf_pq")
+
+# k-means wants a few dozen training points per centroid: per IVF list, and per 8-bit PQ code
+MIN_POINTS_PER_LIST = 39
+PQ_TRAINING_POINTS = 256 * MIN_POINTS_PER_LIST
+
+def ann_settings() -> dict:
+    """Index type and tuning knobs from Django settings"""
+    from django.conf import settings
+    return {
+        "index_type": getattr(settings, 'RAG_INDEX_TYPE', 'auto'),
+        "flat_max_vectors": getattr(settings, 'RAG_FLAT_MAX_VECTORS', 10000),
+        "ivf_pq_min_vectors": getattr(settings, 'RAG_IVF_PQ_MIN_VECTORS', 1000000),
+        "nlist": getattr(settings, 'RAG_IVF_NLIST', 0),
+        "nprobe": getattr(settings, 'RAG_IVF_NPROBE', 16),
+        "pq_m": getattr(settings, 'RAG_PQ_M', 16),
+        "hnsw_m": getattr(settings, 'RAG_HNSW_M', 32),
+        "ef_construction": getattr(settings, 'RAG_HNSW_EF_CONSTRUCTION', 80),
+        "ef_search": getattr(settings, 'RAG_HNSW_EF_SEARCH', 64),
+        "retrain_growth": getattr(settings, 'RAG_ANN_RETRAIN_GROWTH', 2.0),
+    }
+
+def choose_nlist(ntotal: int, config: dict) -> int:
+    """Configured nlist, or the usual 4*sqrt(n) capped by available training points"""
+    nlist = config["nlist"] or int(4 * math.sqrt(ntotal))
+    return max(1, min(nlist, ntotal // MIN_POINTS_PER_LIST))
+
+def select_index_type(ntotal: int, config: dict) -> str:
+    """Configured type, or one picked from corpus size when RAG_INDEX_TYPE is 'auto'"""
+    index_type = config["index_type"]
+    if index_type == "auto":
+        if ntotal < config["flat_max_vectors"]:
+            index_type = "flat"
+        elif ntotal < config["ivf_pq_min_vectors"]:
+            index_type = "ivf_flat"
+        else:
+            index_type = "ivf_pq"
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown RAG_INDEX_TYPE {index_type!r}")
+
+    # Too few vectors to train the requested structure; brute force is exact and fast at this size
+    if index_type in IVF_TYPES and ntotal < MIN_POINTS_PER_LIST * 2:
+        return "flat"
+    if index_type == "ivf_pq" and ntotal < PQ_TRAINING_POINTS:
+        return "ivf_flat"
+    return index_type
+
+def _pq_m(dimension: int, wanted: int) -> int:
+    """Largest sub-quantizer count <= wanted that divides the dimension"""
+    for m in range(min(wanted, dimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+def index_type_of(index) -> str:
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+def build_index(vectors: np.ndarray, config: dict, trained=None) -> Tuple[object, bool]:
+    """
+    Index holding vectors, of the type select_index_type picks for their count.
+
+    A trained IVF index of the same type is reused (cloned, emptied, refilled)
+    so routine compactions skip k-means. Returns (index, retrained).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    ntotal, dimension = vectors.shape
+    index_type = select_index_type(ntotal, config)
+
+    if (trained is not None and index_type in IVF_TYPES
+            and index_type_of(trained) == index_type and trained.d == dimension):
+        index = faiss.clone_index(trained)
+        index.reset()
+        index.add(vectors)
+        apply_search_params(index, config)
+        return index, False
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dimension)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, config["hnsw_m"])
+        index.hnsw.efConstruction = config["ef_construction"]
+    else:
+        nlist = choose_nlist(ntotal, config)
+        quantizer = faiss.IndexFlatL2(dimension)
+        if index_type == "ivf_pq":
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, _pq_m(dimension, config["pq_m"]), 8)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+        index.train(vectors)
+
+    index.add(vectors)
+    apply_search_params(index, config)
+    return index, index_type in IVF_TYPES
+
+def read_index(path: str, mmap: bool = True):
+    """Load an index file; a memory-mapped index is read-only and shared through the page cache"""
+    if not mmap:
+        return faiss.read_index(path)
+    return faiss.read_index(path, getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY)
+
+def reconstruct_vectors(index) -> np.ndarray:
+    """Every stored vector in position order (approximate for PQ)"""
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+def apply_search_params(index, config: Optional[dict] = None):
+    """Set query-time knobs (nprobe / efSearch), which are not persisted with the index"""
+    config = config or ann_settings()
+    index_type = index_type_of(index)
+    if index_type in IVF_TYPES:
+        index.nprobe = min(config["nprobe"], index.nlist)
+    elif index_type == "hnsw":
+        index.hnsw.efSearch = config["ef_search"]
+
+def search_parameters(index, selected: np.ndarray):
+    """
+    Per-query parameters restricting the search to positions set in the boolean mask selected.
+
+    The filter runs inside FAISS through an IDSelectorBitmap; IVF and HNSW
+    widen nprobe / efSearch as the filter gets more selective so a narrow
+    filter still finds k neighbours. Returns (params, bitmap), and the
+    bitmap must stay referenced until the search returns.
+    """
+    bitmap = np.packbits(selected, bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(selected), faiss.swig_ptr(bitmap))
+    widen = 1 / max(float(selected.mean()), 1e-3) if len(selected) else 1
+    index_type = index_type_of(index)
+    if index_type in IVF_TYPES:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=min(index.nlist, math.ceil(index.nprobe * widen)))
+    elif index_type == "hnsw":
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=math.ceil(index.hnsw.efSearch * min(widen, 16)))
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return params, bitmap
+
+def describe_index(index) -> dict:
+    """Active index type and its parameters, for get_stats"""
+    index_type = index_type_of(index)
+    description = {"index_type": index_type, "ntotal": index.ntotal}
+    if index_type in IVF_TYPES:
+        description.update(nlist=index.nlist, nprobe=index.nprobe)
+        if index_type == "ivf_pq":
+            description.update(pq_m=index.pq.M, pq_nbits=index.pq.nbits)
+    elif index_type == "hnsw":
+        description.update(hnsw_m=index.hnsw.nb_neighbors(1), ef_construction=index.hnsw.efConstruction,
+                           ef_search=index.hnsw.efSearch)
+    return description
\ No newline at end of file
@@ -0,0 +1,102 @@
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import List
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import ArchivedSession, ChatSession, Message
+from .retention import next_batch
+
+class SessionArchiver:
+    """
+    Moves sessions idle for CHAT_ARCHIVE_AFTER_DAYS out of the hot tables
+    into ArchivedSession, a batch per transaction.
+
+    Archived sessions leave ChatSession, so every run simply scans from the
+    lowest id again; batching, pauses and the time budget follow
+    RetentionEngine.
+    """
+
+    def __init__(self, after_days: int = 30, batch_size: int = 200, batch_messages: int = 20000,
+                 pause: float = 0.05, max_seconds: float = 0):
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.batch_messages = batch_messages
+        self.pause = pause
+        self.max_seconds = max_seconds
+
+    @classmethod
+    def from_settings(cls, **overrides) -> "SessionArchiver":
+        options = {
+            'after_days': getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 30),
+            'batch_size': getattr(settings, 'CHAT_ARCHIVE_BATCH_SIZE', 200),
+            'batch_messages': getattr(settings, 'CHAT_RETENTION_BATCH_MESSAGES', 20000),
+            'pause': getattr(settings, 'CHAT_RETENTION_BATCH_PAUSE', 0.05),
+            'max_seconds': getattr(settings, 'CHAT_RETENTION_MAX_SECONDS', 300),
+        }
+        options.update(overrides)
+        return cls(**options)
+
+    def run(self) -> dict:
+        started = time.monotonic()
+        totals = {'archived_sessions': 0, 'archived_messages': 0, 'raw_bytes': 0, 'stored_bytes': 0, 'batches': 0}
+        complete = True
+        if self.after_days:
+            cutoff = timezone.now() - timedelta(days=self.after_days)
+            idle = ChatSession.objects.filter(updated_at__lt=cutoff)
+            last_id = 0
+            while True:
+                if self.max_seconds and time.monotonic() - started >= self.max_seconds:
+                    complete = False
+                    break
+                candidates = next_batch(idle, last_id, self.batch_size, self.batch_messages)
+                if not candidates:
+                    break
+                for key, value in self._archive_batch(candidates, cutoff).items():
+                    totals[key] += value
+                totals['batches'] += 1
+                last_id = candidates[-1]
+                if self.pause:
+                    time.sleep(self.pause)
+
+        elapsed = time.monotonic() - started
+        rows = totals['archived_sessions'] + totals['archived_messages']
+        return {
+            **totals,
+            'complete': complete,
+            'compression_ratio': round(totals['raw_bytes'] / totals['stored_bytes'], 2) if totals['stored_bytes'] else None,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(rows / elapsed, 1) if elapsed else 0.0,
+        }
+
+    def _archive_batch(self, candidates: List[int], cutoff) -> dict:
+        """Pack the candidates still idle, write their archives and delete the originals, atomically"""
+        with transaction.atomic():
+            # Row locks keep a message from landing in a session while it is being moved
+            sessions = list(
+                ChatSession.objects.select_for_update()
+                .filter(id__in=candidates, updated_at__lt=cutoff)
+                .order_by('id')
+            )
+            if not sessions:
+                return {}
+            messages = defaultdict(list)
+            rows = (
+                Message.objects.filter(chat_session__in=[session.id for session in sessions])
+                .order_by('chat_session_id', 'created_at', 'id')
+                .values('chat_session_id', *ArchivedSession.MESSAGE_FIELDS)
+            )
+            for row in rows:
+                messages[row['chat_session_id']].append(row)
+
+            archives = ArchivedSession.objects.bulk_create(
+                [ArchivedSession.pack(session, messages[session.id]) for session in sessions]
+            )
+            deleted = ChatSession.objects.filter(id__in=[session.id for session in sessions]).delete()[1]
+        return {
+            'archived_sessions': deleted.get(ChatSession._meta.label, 0),
+            'archived_messages': deleted.get(Message._meta.label, 0),
+            'raw_bytes': sum(archive.raw_bytes for archive in archives),
+            'stored_bytes': sum(archive.stored_bytes for archive in archives),
+        }
\ No newline at end of file
@@ -0,0 +1,132 @@
+import json
+from datetime import date, datetime, time, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
+from langchain.schema import Document
+
+FILTER_KEYS = ("document_type", "source", "date_from", "date_to")
+
+TYPES_FILE = "attr_types.npy"
+SOURCES_FILE = "attr_sources.npy"
+ADDED_AT_FILE = "attr_added_at.npy"
+VOCAB_FILE = "attr_vocab.json"
+
+# Chunks without a usable added_at sort before every date range
+UNKNOWN_TIME = np.iinfo(np.int64).min
+
+def _to_timestamp(value, end_of_day: bool = False) -> int:
+    """Epoch seconds for a date, datetime or ISO string; naive values are taken as UTC"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value) if "T" in value or " " in value else date.fromisoformat(value)
+    if not isinstance(value, datetime):
+        # A bare date covers the whole day when it closes a range
+        value = datetime.combine(value + timedelta(days=1) if end_of_day else value, time.min)
+        if end_of_day:
+            value -= timedelta(microseconds=1)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+def normalize_filters(filters: Optional[dict]) -> Optional[Tuple]:
+    """Validated, hashable form of a filters dict; None when nothing is filtered"""
+    if not filters:
+        return None
+    unknown = set(filters) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Unsupported retrieval filters: {', '.join(sorted(unknown))}")
+
+    normalized = []
+    for key in ("document_type", "source"):
+        value = filters.get(key)
+        if value:
+            values = [value] if isinstance(value, str) else list(value)
+            normalized.append((key, tuple(sorted(values))))
+    if filters.get("date_from"):
+        normalized.append(("date_from", _to_timestamp(filters["date_from"])))
+    if filters.get("date_to"):
+        normalized.append(("date_to", _to_timestamp(filters["date_to"], end_of_day=True)))
+    return tuple(normalized) or None
+
+class ChunkAttributes:
+    """
+    Filterable metadata of one store's chunks, one array entry per index position.
+
+    document_type and source are dictionary-encoded so a filter becomes a
+    vectorized comparison producing a bitmap the FAISS search can take.
+    """
+
+    def __init__(self, types: np.ndarray, sources: np.ndarray, added_at: np.ndarray, vocab: Dict[str, List[str]]):
+        self.types = types
+        self.sources = sources
+        self.added_at = added_at
+        self.vocab = vocab
+        self._codes = {column: {value: code for code, value in enumerate(values)} for column, values in vocab.items()}
+
+    @classmethod
+    def empty(cls) -> "ChunkAttributes":
+        return cls(np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0, np.int64), {"type": [], "source": []})
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[Document]) -> "ChunkAttributes":
+        attributes = cls.empty()
+        attributes.append(documents)
+        return attributes
+
+    @staticmethod
+    def exists(path: Union[str, Path]) -> bool:
+        return (Path(path) / VOCAB_FILE).exists()
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "ChunkAttributes":
+        path = Path(path)
+        return cls(
+            np.load(path / TYPES_FILE, mmap_mode="r"),
+            np.load(path / SOURCES_FILE, mmap_mode="r"),
+            np.load(path / ADDED_AT_FILE, mmap_mode="r"),
+            json.loads((path / VOCAB_FILE).read_text())
+        )
+
+    def save(self, path: Union[str, Path]):
+        path = Path(path)
+        np.save(path / TYPES_FILE, np.asarray(self.types))
+        np.save(path / SOURCES_FILE, np.asarray(self.sources))
+        np.save(path / ADDED_AT_FILE, np.asarray(self.added_at))
+        (path / VOCAB_FILE).write_text(json.dumps(self.vocab))
+
+    def _code(self, column: str, value: str) -> int:
+        codes = self._codes[column]
+        if value not in codes:
+            codes[value] = len(self.vocab[column])
+            self.vocab[column].append(value)
+        return codes[value]
+
+    def append(self, documents: Iterable[Document]):
+        """Add the attributes of chunks appended to the store, in position order"""
+        types, sources, added_at = [], [], []
+        for doc in documents:
+            types.append(self._code("type", str(doc.metadata.get("type", ""))))
+            sources.append(self._code("source", str(doc.metadata.get("source", ""))))
+            try:
+                added_at.append(_to_timestamp(doc.metadata["added_at"]))
+            except (KeyError, TypeError, ValueError):
+                added_at.append(UNKNOWN_TIME)
+        self.types = np.concatenate([self.types, np.array(types, dtype=np.int32)])
+        self.sources = np.concatenate([self.sources, np.array(sources, dtype=np.int32)])
+        self.added_at = np.concatenate([self.added_at, np.array(added_at, dtype=np.int64)])
+
+    def mask(self, filters: Tuple) -> np.ndarray:
+        """Boolean bitmap over positions for normalized filters"""
+        mask = np.ones(len(self.types), dtype=bool)
+        for key, value in filters:
+            if key == "document_type":
+                codes = [self._codes["type"][v] for v in value if v in self._codes["type"]]
+                mask &= np.isin(self.types, codes)
+            elif key == "source":
+                codes = [self._codes["source"][v] for v in value if v in self._codes["source"]]
+                mask &= np.isin(self.sources, codes)
+            elif key == "date_from":
+                mask &= self.added_at >= value
+            elif key == "date_to":
+                mask &= (self.added_at <= value) & (self.added_at != UNKNOWN_TIME)
+        return mask
\ No newline at end of file
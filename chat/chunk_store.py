@@ -0,0 +1,103 @@
+import json
+import mmap
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, List, Set, Union
+import numpy as np
+from langchain.docstore.base import Docstore
+from langchain.schema import Document
+
+CHUNKS_FILE = "chunks.bin"
+OFFSETS_FILE = "chunk_offsets.npy"
+IDS_FILE = "chunk_ids.npy"
+SORTED_IDS_FILE = "chunk_ids_sorted.npy"
+SORTED_POSITIONS_FILE = "chunk_positions_sorted.npy"
+DOCUMENT_IDS_FILE = "document_ids.npy"
+
+class ChunkIds(Mapping):
+    """Index position -> chunk id, read straight from the memory-mapped id array"""
+
+    def __init__(self, ids: np.ndarray):
+        self._ids = ids
+
+    def __getitem__(self, position: int) -> str:
+        if not 0 <= position < len(self._ids):
+            raise KeyError(position)
+        return self._ids[position].decode("ascii")
+
+    def __iter__(self):
+        return iter(range(len(self._ids)))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+class ChunkStore(Docstore):
+    """
+    Read-only chunk text and metadata laid out for memory mapping.
+
+    Records are JSON blobs packed back to back in chunks.bin and addressed by
+    index position through an offsets array; a sorted copy of the chunk ids
+    gives id lookups by binary search. Nothing is deserialized up front, so
+    every worker on a host shares the same pages and opening is O(1).
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path)
+        self._offsets = np.load(path / OFFSETS_FILE, mmap_mode="r")
+        self._ids = np.load(path / IDS_FILE, mmap_mode="r")
+        self._sorted_ids = np.load(path / SORTED_IDS_FILE, mmap_mode="r")
+        self._sorted_positions = np.load(path / SORTED_POSITIONS_FILE, mmap_mode="r")
+        self._document_ids = np.load(path / DOCUMENT_IDS_FILE, mmap_mode="r")
+        with open(path / CHUNKS_FILE, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.chunk_ids = ChunkIds(self._ids)
+
+    @staticmethod
+    def exists(path: Union[str, Path]) -> bool:
+        return (Path(path) / CHUNKS_FILE).exists()
+
+    @staticmethod
+    def write(path: Union[str, Path], chunk_ids: List[str], documents: List[Document]):
+        """Persist documents in index-position order"""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        offsets = [0]
+        with open(path / CHUNKS_FILE, "wb") as f:
+            for doc in documents:
+                record = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}).encode("utf-8")
+                f.write(record)
+                offsets.append(offsets[-1] + len(record))
+
+        ids = np.array([chunk_id.encode("ascii") for chunk_id in chunk_ids])
+        order = np.argsort(ids, kind="stable")
+        document_ids = [doc.metadata.get("document_id") for doc in documents]
+        np.save(path / OFFSETS_FILE, np.array(offsets, dtype=np.int64))
+        np.save(path / IDS_FILE, ids)
+        np.save(path / SORTED_IDS_FILE, ids[order])
+        np.save(path / SORTED_POSITIONS_FILE, order.astype(np.int64))
+        np.save(path / DOCUMENT_IDS_FILE, np.array([-1 if d is None else d for d in document_ids], dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def document_at(self, position: int) -> Document:
+        start, end = int(self._offsets[position]), int(self._offsets[position + 1])
+        return Document(**json.loads(self._data[start:end]))
+
+    def search(self, search: str) -> Union[str, Document]:
+        """Chunk by id; mirrors InMemoryDocstore, which returns a message when missing"""
+        encoded = search.encode("ascii")
+        if len(encoded) > self._sorted_ids.dtype.itemsize:
+            return f"ID {search} not found."
+        key = np.array(encoded, dtype=self._sorted_ids.dtype)
+        slot = int(np.searchsorted(self._sorted_ids, key))
+        if slot < len(self._sorted_ids) and self._sorted_ids[slot] == key:
+            return self.document_at(int(self._sorted_positions[slot]))
+        return f"ID {search} not found."
+
+    def document_chunks(self) -> Dict[int, Set[str]]:
+        """knowledge.Document id -> chunk ids, without decoding any records"""
+        chunks = {}
+        for position in np.flatnonzero(self._document_ids >= 0):
+            chunks.setdefault(int(self._document_ids[position]), set()).add(self.chunk_ids[position])
+        return chunks
\ No newline at end of file
@@ -0,0 +1,129 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional, Union
+
+class WriteAheadLog:
+    """
+    Durable, append-only log of index operations shared by every process.
+
+    Entries are JSON lines carrying a monotonically increasing seq; an entry
+    is acknowledged only after it has been fsynced. The writer applies
+    entries in seq order and the published index records the last one
+    applied, so anything after it is replayed after a crash.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        # Separate lock file: truncation replaces the log, which would strand a lock held on it
+        self._lock_path = self.path.with_name(f"{self.path.name}.lock")
+
+    @contextmanager
+    def _locked(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self) -> List[dict]:
+        if not self.path.exists():
+            return []
+        entries = []
+        for line in self.path.read_text().splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A record torn by a crash mid-append was never acknowledged
+                continue
+        return entries
+
+    def append(self, op: str, payload: dict, min_seq: int = 0) -> int:
+        """Log an operation durably and return its seq"""
+        with self._locked():
+            entries = self._read()
+            seq = max([min_seq] + [entry["seq"] for entry in entries]) + 1
+            record = json.dumps({"seq": seq, "op": op, "logged_at": time.time(), **payload})
+            with open(self.path, "ab") as f:
+                # Never glue a record onto a torn one
+                if f.tell() and not self._ends_with_newline():
+                    f.write(b"\n")
+                f.write(record.encode("utf-8") + b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+        return seq
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def pending(self, applied_seq: int) -> List[dict]:
+        """Entries not yet applied, oldest first"""
+        return sorted((entry for entry in self._read() if entry["seq"] > applied_seq), key=lambda e: e["seq"])
+
+    def logged_since(self, since: float) -> List[dict]:
+        """Entries logged at or after since (a time.time() value), applied or not"""
+        return sorted((entry for entry in self._read() if entry["logged_at"] >= since), key=lambda e: e["seq"])
+
+    def truncate(self, applied_seq: int, keep_since: Optional[float] = None):
+        """Drop entries the published index already reflects, except any logged at or after keep_since"""
+        with self._locked():
+            entries = self._read()
+            remaining = [
+                entry for entry in entries
+                if entry["seq"] > applied_seq or (keep_since is not None and entry["logged_at"] >= keep_since)
+            ]
+            if len(remaining) == len(entries):
+                return
+            tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+            with open(tmp_path, "w") as f:
+                f.write("".join(json.dumps(entry) + "\n" for entry in remaining))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    def stats(self, applied_seq: int) -> dict:
+        entries = self._read()
+        return {
+            "entries": len(entries),
+            "pending": sum(entry["seq"] > applied_seq for entry in entries),
+            "applied_seq": applied_seq,
+        }
+
+class WriterLease:
+    """
+    Host-wide exclusive right to mutate the index.
+
+    Backed by flock, so the kernel releases it if the holder dies; re-entrant
+    within a process so maintenance operations can nest.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    @contextmanager
+    def hold(self):
+        with self._lock:
+            if self._depth == 0:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path, "a")
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+                    self._file.close()
+                    self._file = None
\ No newline at end of file
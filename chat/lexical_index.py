@@ -0,0 +1,184 @@
+import hashlib
+import math
+import re
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+import numpy as np
+
+TERM_HASHES_FILE = "lexical_terms.npy"
+TERM_OFFSETS_FILE = "lexical_offsets.npy"
+POSTINGS_FILE = "lexical_postings.npy"
+TERM_FREQS_FILE = "lexical_tfs.npy"
+DOC_LENGTHS_FILE = "lexical_doc_lengths.npy"
+
+# Keep identifiers like ERR-1042, SKU/AB.12 or RAG_INDEX_TYPE whole, and also index their parts
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._\-:/][a-z0-9]+)*")
+_PART_RE = re.compile(r"[a-z0-9]+")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        tokens.append(token)
+        parts = _PART_RE.findall(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+def term_hash(term: str) -> int:
+    """64-bit term key; the on-disk vocabulary is a sorted array of these"""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+class LexicalIndex:
+    """In-memory inverted index over chunk positions, appended to as chunks are added"""
+
+    def __init__(self):
+        self._postings: Dict[str, Tuple[array, array]] = {}
+        self._doc_lengths = array("i")
+        self._arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._lengths: Optional[np.ndarray] = None
+        self.total_length = 0
+
+    @classmethod
+    def build(cls, texts: Iterable[str]) -> "LexicalIndex":
+        index = cls()
+        index.add(texts)
+        return index
+
+    @property
+    def num_docs(self) -> int:
+        return len(self._doc_lengths)
+
+    @property
+    def doc_lengths(self) -> np.ndarray:
+        if self._lengths is None:
+            self._lengths = np.array(self._doc_lengths, dtype=np.int32)
+        return self._lengths
+
+    def add(self, texts: Iterable[str]):
+        """Index texts at the next positions, in the order their vectors were added"""
+        for text in texts:
+            position = len(self._doc_lengths)
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                positions, tfs = self._postings.setdefault(term, (array("i"), array("i")))
+                positions.append(position)
+                tfs.append(tf)
+                self._arrays.pop(term, None)
+            length = sum(counts.values())
+            self._doc_lengths.append(length)
+            self.total_length += length
+        self._lengths = None
+
+    def postings(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """(positions, term frequencies) for term, positions ascending"""
+        cached = self._arrays.get(term)
+        if cached is None:
+            lists = self._postings.get(term)
+            if lists is None:
+                return None
+            cached = (np.array(lists[0], dtype=np.int32), np.array(lists[1], dtype=np.int32))
+            self._arrays[term] = cached
+        return cached
+
+    def save(self, path: Union[str, Path]):
+        """Write the frozen, memory-mappable form read by FrozenLexicalIndex"""
+        path = Path(path)
+        keyed = sorted((term_hash(term), term) for term in self._postings)
+        offsets = [0]
+        for _, term in keyed:
+            offsets.append(offsets[-1] + len(self._postings[term][0]))
+        np.save(path / TERM_HASHES_FILE, np.array([key for key, _ in keyed], dtype=np.int64))
+        np.save(path / TERM_OFFSETS_FILE, np.array(offsets, dtype=np.int64))
+        np.save(path / POSTINGS_FILE, np.array(
+            [p for _, term in keyed for p in self._postings[term][0]], dtype=np.int32))
+        np.save(path / TERM_FREQS_FILE, np.array(
+            [tf for _, term in keyed for tf in self._postings[term][1]], dtype=np.int32))
+        np.save(path / DOC_LENGTHS_FILE, self.doc_lengths)
+
+class FrozenLexicalIndex:
+    """Read-only inverted index of a base version, memory-mapped like its vectors and chunks"""
+
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path)
+        self._terms = np.load(path / TERM_HASHES_FILE, mmap_mode="r")
+        self._offsets = np.load(path / TERM_OFFSETS_FILE, mmap_mode="r")
+        self._postings = np.load(path / POSTINGS_FILE, mmap_mode="r")
+        self._tfs = np.load(path / TERM_FREQS_FILE, mmap_mode="r")
+        self.doc_lengths = np.load(path / DOC_LENGTHS_FILE, mmap_mode="r")
+        self.total_length = int(self.doc_lengths.sum())
+
+    @staticmethod
+    def exists(path: Union[str, Path]) -> bool:
+        return (Path(path) / TERM_HASHES_FILE).exists()
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_lengths)
+
+    def postings(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        key = term_hash(term)
+        slot = int(np.searchsorted(self._terms, key))
+        if slot == len(self._terms) or self._terms[slot] != key:
+            return None
+        start, end = int(self._offsets[slot]), int(self._offsets[slot + 1])
+        return self._postings[start:end], self._tfs[start:end]
+
+def bm25_search(indexes: Sequence, query: str, k: int,
+                masks: Optional[Sequence[Optional[np.ndarray]]] = None) -> List[List[Tuple[int, float]]]:
+    """
+    Top-k BM25 hits as [(position, score)] per index, best first.
+
+    Collection statistics (document count, document frequency, average
+    length) are pooled across the indexes so their scores are comparable.
+    masks optionally restricts each index to the positions set in a boolean bitmap.
+    """
+    masks = masks or [None] * len(indexes)
+    terms = list(dict.fromkeys(tokenize(query)))
+    num_docs = sum(index.num_docs for index in indexes)
+    if not terms or not num_docs:
+        return [[] for _ in indexes]
+    avgdl = max(sum(index.total_length for index in indexes) / num_docs, 1.0)
+
+    postings = [[index.postings(term) for term in terms] for index in indexes]
+    idf = []
+    for t in range(len(terms)):
+        df = sum(len(lists[t][0]) for lists in postings if lists[t] is not None)
+        idf.append(math.log(1 + (num_docs - df + 0.5) / (df + 0.5)))
+
+    results = []
+    for index, lists, mask in zip(indexes, postings, masks):
+        positions, contributions = [], []
+        for weight, found in zip(idf, lists):
+            if found is None:
+                continue
+            docs, tfs = np.asarray(found[0]), np.asarray(found[1], dtype=np.float32)
+            if mask is not None:
+                allowed = mask[docs]
+                docs, tfs = docs[allowed], tfs[allowed]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * index.doc_lengths[docs] / avgdl)
+            positions.append(docs)
+            contributions.append(weight * tfs * (BM25_K1 + 1) / (tfs + norm))
+        if not positions:
+            results.append([])
+            continue
+
+        # Sum each chunk's per-term contributions without touching the rest of the corpus
+        unique, inverse = np.unique(np.concatenate(positions), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions))
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        results.append([(int(unique[i]), float(scores[i])) for i in top])
+    return results
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence], k: int = 60) -> List:
+    """Fuse ranked lists of keys: score(key) = sum of 1 / (k + rank) over the lists containing it"""
+    scores: Dict = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
\ No newline at end of file
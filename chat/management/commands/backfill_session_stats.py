@@ -0,0 +1,32 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.models import ChatSession
+
+class Command(BaseCommand):
+    help = 'Fill ChatSession message_count / last_message_* from existing messages (safe to re-run)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Sessions updated per statement (and transaction)')
+        parser.add_argument('--after-id', type=int, default=0,
+                            help='Resume after this session id')
+
+    def handle(self, *args, **options):
+        last_id = options['after_id']
+        sessions = 0
+        started = time.monotonic()
+        while True:
+            ids = list(
+                ChatSession.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not ids:
+                break
+            # One UPDATE with correlated subqueries per batch; each commits on its own
+            ChatSession.objects.filter(id__in=ids).recompute_message_stats()
+            last_id = ids[-1]
+            sessions += len(ids)
+            elapsed = time.monotonic() - started
+            self.stdout.write(f"{sessions} sessions, last id {last_id} ({sessions / elapsed:.1f} sessions/sec)")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled message stats for {sessions} sessions"))
\ No newline at end of file
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from chat.retention import RetentionEngine
+
+class Command(BaseCommand):
+    help = 'Delete chat sessions idle past their retention period, in batches (resumable)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Sessions deleted per transaction (default CHAT_RETENTION_BATCH_SIZE)')
+        parser.add_argument('--pause', type=float, default=None,
+                            help='Seconds to sleep between batches (default CHAT_RETENTION_BATCH_PAUSE)')
+        parser.add_argument('--max-seconds', type=float, default=0,
+                            help='Stop after this long and leave a checkpoint (0 runs to completion)')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore checkpoints and scan every tier from the start')
+
+    def handle(self, *args, **options):
+        overrides = {'max_seconds': options['max_seconds'], 'progress': self._progress}
+        if options['batch_size'] is not None:
+            overrides['batch_size'] = options['batch_size']
+        if options['pause'] is not None:
+            overrides['pause'] = options['pause']
+        if options['restart']:
+            RetentionEngine.reset_checkpoints()
+
+        result = RetentionEngine.from_settings(**overrides).run()
+        summary = (
+            f"Deleted {result['deleted_sessions']} sessions, {result['deleted_messages']} messages "
+            f"and {result['deleted_archives']} archived sessions "
+            f"in {result['seconds']:.1f}s ({result['rows_per_second']:.1f} rows/sec)"
+        )
+        if result['complete']:
+            self.stdout.write(self.style.SUCCESS(summary))
+        else:
+            self.stdout.write(self.style.WARNING(f"{summary}; stopped at the time limit, re-run to resume"))
+
+    def _progress(self, state):
+        self.stdout.write(
+            f"[{state['tier']}] {state['deleted_sessions']} sessions / {state['deleted_messages']} messages / "
+            f"{state['deleted_archives']} archives, "
+            f"last id {state['last_id']} ({state['rows_per_second']:.1f} rows/sec)"
+        )
\ No newline at end of file
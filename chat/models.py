@@ -1,26 +1,126 @@
-from django.db import models
+import json
+import uuid
+import zlib
+from datetime import datetime
+from asgiref.sync import sync_to_async
+from django.db import models, transaction
+from django.db.models import Case, Count, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Concat, Length, Substr
 from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+
+PREVIEW_LENGTH = 100
+
+class ChatSessionQuerySet(models.QuerySet):
+    def recompute_message_stats(self):
+        """Rewrite the denormalized message fields from the messages themselves (backfill / repair)"""
+        messages = Message.objects.filter(chat_session=OuterRef('pk'))
+        latest = messages.order_by('-created_at', '-id')
+        preview = Case(
+            When(content_length__gt=PREVIEW_LENGTH, then=Concat(Substr('content', 1, PREVIEW_LENGTH), Value('...'))),
+            default=F('content'),
+            output_field=models.TextField()
+        )
+        return self.update(
+            message_count=Coalesce(Subquery(
+                messages.order_by().values('chat_session').annotate(count=Count('id')).values('count')
+            ), 0),
+            last_message_at=Subquery(latest.values('created_at')[:1]),
+            last_message_is_user=Subquery(latest.values('is_user')[:1]),
+            last_message_preview=Coalesce(Subquery(
+                latest.annotate(content_length=Length('content'), preview=preview).values('preview')[:1]
+            ), Value('')),
+        )
 
 class ChatSession(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_sessions')
     title = models.CharField(max_length=200, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Running summary of the turns that have aged out of the raw history sent to the model
+    summary = models.TextField(blank=True, default='')
+    summary_through_id = models.PositiveBigIntegerField(default=0)  # Newest message folded into summary
+    summary_updated_at = models.DateTimeField(null=True, blank=True)
+    # Kept in step with the messages by add_message, so lists need no aggregation
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH + 3, blank=True, default='')
+    last_message_is_user = models.BooleanField(null=True, blank=True)
+    
+    objects = ChatSessionQuerySet.as_manager()
     
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Keyset pagination of a user's sessions, newest activity first
+            models.Index(fields=['user', '-updated_at', '-id'], name='chat_sess_user_updated_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.title or 'Untitled'}"
     
-    def save(self, *args, **kwargs):
-        # Generate title from first message if empty
-        if not self.title and self.pk:
-            first_message = self.messages.filter(is_user=True).first()
-            if first_message:
-                content = first_message.content
-                self.title = content[:50] + '...' if len(content) > 50 else content
-        super().save(*args, **kwargs)
+    @staticmethod
+    def preview(content):
+        return content[:PREVIEW_LENGTH] + '...' if len(content) > PREVIEW_LENGTH else content
+    
+    def add_message(self, content, is_user, metadata=None):
+        """
+        Insert a message and advance the session's counters, preview and
+        updated_at in the same transaction. The update is expressed with F()
+        so concurrent turns never lose a count.
+        """
+        with transaction.atomic():
+            message = Message.objects.create(
+                chat_session=self,
+                content=content,
+                is_user=is_user,
+                metadata=metadata or {}
+            )
+            fields = {
+                'message_count': F('message_count') + 1,
+                'last_message_at': message.created_at,
+                'last_message_preview': self.preview(content),
+                'last_message_is_user': is_user,
+                'updated_at': timezone.now(),
+            }
+            if is_user and not self.title:
+                # Sessions created without a title take it from their first question
+                title = content[:50] + '...' if len(content) > 50 else content
+                fields['title'] = Case(When(title='', then=Value(title)), default=F('title'))
+            ChatSession.objects.filter(pk=self.pk).update(**fields)
+        
+        # Mirror the update on this instance for the response; the row is authoritative
+        self.message_count += 1
+        self.last_message_at = message.created_at
+        self.last_message_preview = fields['last_message_preview']
+        self.last_message_is_user = is_user
+        self.updated_at = fields['updated_at']
+        if 'title' in fields:
+            self.title = title
+        return message
+    
+    async def aadd_message(self, content, is_user, metadata=None):
+        return await sync_to_async(self.add_message)(content, is_user, metadata)
+    
+    def unsummarized_messages(self, before_id=None):
+        """
+        Messages not yet folded into the summary, newest first, capped at CHAT_HISTORY_MAX_MESSAGES;
+        before_id limits them to the history as it stood when that message was sent
+        """
+        limit = getattr(settings, 'CHAT_HISTORY_MAX_MESSAGES', 10)
+        messages = self.messages.filter(id__gt=self.summary_through_id)
+        if before_id is not None:
+            messages = messages.filter(id__lt=before_id)
+        return messages.order_by('-created_at', '-id')[:limit]
+    
+    @staticmethod
+    def summary_due(unsummarized_count):
+        """Whether enough turns have built up beyond the raw window to fold into the summary"""
+        recent_turns = getattr(settings, 'CHAT_RECENT_TURNS', 2)
+        every_turns = getattr(settings, 'CHAT_SUMMARY_EVERY_TURNS', 2)
+        threshold = min(2 * (recent_turns + every_turns), getattr(settings, 'CHAT_HISTORY_MAX_MESSAGES', 10))
+        return unsummarized_count >= threshold
 
 class Message(models.Model):
     chat_session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='messages')
@@ -31,7 +131,206 @@ class Message(models.Model):
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Keyset pagination of a session's messages and the recent-history lookup
+            models.Index(fields=['chat_session', 'created_at', 'id'], name='chat_msg_session_created_idx'),
+        ]
     
     def __str__(self):
         role = "User" if self.is_user else "Bot"
-        return f"{role}: {self.content[:50]}..."
\ No newline at end of file
+        return f"{role}: {self.content[:50]}..."
+
+
+class UserRetention(models.Model):
+    """Per-user chat retention, overriding the user's plan and CHAT_RETENTION_DAYS"""
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_retention')
+    days = models.PositiveIntegerField(null=True, blank=True, help_text='Days a session is kept after its last message; empty or 0 keeps it forever')
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.user} - {self.days or 'forever'}"
+
+class RetentionCheckpoint(models.Model):
+    """Where an unfinished retention pass over one tier resumes: the last session id it scanned"""
+    name = models.CharField(max_length=100, unique=True)
+    last_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.name} after {self.last_id}"
+
+class ArchivedSession(models.Model):
+    """
+    Cold copy of an idle session and its messages, moved out of the hot
+    tables by the archive_idle_chats task: one zlib-compressed JSON blob,
+    plus the summary columns session lists show.
+    """
+    FORMAT_VERSION = 1
+    SESSION_FIELDS = ('title', 'created_at', 'updated_at', 'message_count', 'last_message_at',
+                      'last_message_preview', 'last_message_is_user')
+    MESSAGE_FIELDS = ('id', 'content', 'is_user', 'metadata', 'created_at')
+    
+    session_id = models.PositiveBigIntegerField(unique=True)  # Id of the ChatSession, kept on restore
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='archived_sessions')
+    title = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()  # The session's last activity; retention counts from here
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH + 3, blank=True, default='')
+    last_message_is_user = models.BooleanField(null=True, blank=True)
+    payload = models.BinaryField()
+    raw_bytes = models.PositiveIntegerField(default=0)  # JSON size before compression
+    stored_bytes = models.PositiveIntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['user', '-updated_at', '-id'], name='chat_arch_user_updated_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id} - {self.title or 'Untitled'} (archived)"
+    
+    @classmethod
+    def pack(cls, chat_session, messages):
+        """Unsaved archive of chat_session; messages are MESSAGE_FIELDS dicts, oldest first"""
+        document = {
+            'version': cls.FORMAT_VERSION,
+            'session': {
+                **{field: getattr(chat_session, field) for field in cls.SESSION_FIELDS},
+                'summary': chat_session.summary,
+                'summary_through_id': chat_session.summary_through_id,
+                'summary_updated_at': chat_session.summary_updated_at,
+            },
+            'messages': [{field: message[field] for field in cls.MESSAGE_FIELDS} for message in messages],
+        }
+        # Full isoformat: DjangoJSONEncoder would cut timestamps to milliseconds and break (created_at, id) order
+        raw = json.dumps(document, default=datetime.isoformat, separators=(',', ':')).encode()
+        payload = zlib.compress(raw, 6)
+        return cls(
+            session_id=chat_session.id,
+            user_id=chat_session.user_id,
+            payload=payload,
+            raw_bytes=len(raw),
+            stored_bytes=len(payload),
+            **{field: getattr(chat_session, field) for field in cls.SESSION_FIELDS}
+        )
+    
+    def unpack(self):
+        """The archived session and messages, with timestamps parsed back into datetimes"""
+        document = json.loads(zlib.decompress(bytes(self.payload)))
+        for record in [document['session'], *document['messages']]:
+            for field in ('created_at', 'updated_at', 'last_message_at', 'summary_updated_at'):
+                if record.get(field):
+                    record[field] = parse_datetime(record[field])
+        return document
+    
+    def restore(self):
+        """Move the session back into the hot tables under its original ids and drop the archive"""
+        document = self.unpack()
+        session_fields = document['session']
+        with transaction.atomic():
+            chat_session = ChatSession.objects.create(
+                id=self.session_id, user_id=self.user_id,
+                **{field: value for field, value in session_fields.items() if field not in ('created_at', 'updated_at')}
+            )
+            messages = Message.objects.bulk_create(
+                [Message(chat_session=chat_session, **message) for message in document['messages']], batch_size=500
+            )
+            # auto_now_add stamped the copies with the current time; put the original timestamps back
+            for message, original in zip(messages, document['messages']):
+                message.created_at = original['created_at']
+            Message.objects.bulk_update(messages, ['created_at'], batch_size=500)
+            ChatSession.objects.filter(pk=chat_session.pk).update(created_at=session_fields['created_at'])
+            chat_session.created_at = session_fields['created_at']
+            self.delete()
+        # updated_at stays at now: a restored session is active again and not re-archived straight away
+        return chat_session
+
+class DailyStats(models.Model):
+    """
+    One day of chat activity, rolled up incrementally by the roll_up_daily_stats task
+    (see chat.stats) so reports never scan the live tables.
+    """
+    date = models.DateField(unique=True)
+    new_users = models.PositiveIntegerField(default=0)
+    new_sessions = models.PositiveIntegerField(default=0)
+    messages = models.PositiveIntegerField(default=0)
+    user_messages = models.PositiveIntegerField(default=0)
+    bot_messages = models.PositiveIntegerField(default=0)
+    active_users = models.PositiveIntegerField(default=0)  # Users who sent at least one message
+    cache_hits = models.PositiveIntegerField(default=0)  # Answers served from the semantic response cache
+    llm_calls = models.PositiveIntegerField(default=0)
+    llm_latency_p50_ms = models.PositiveIntegerField(null=True, blank=True)
+    llm_latency_p95_ms = models.PositiveIntegerField(null=True, blank=True)
+    llm_latency_p99_ms = models.PositiveIntegerField(null=True, blank=True)
+    # Log-bucketed latency counts; merged on every rollup so percentiles stay exact to a bucket
+    llm_latency_histogram = models.JSONField(default=dict, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-date']
+        verbose_name_plural = 'daily stats'
+    
+    def __str__(self):
+        return f"Stats for {self.date}"
+
+class DailyActiveUser(models.Model):
+    """Users seen on a recent day, so repeated rollups count each once; older days are pruned"""
+    date = models.DateField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    
+    class Meta:
+        unique_together = ['date', 'user']
+
+class StatsWatermark(models.Model):
+    """Highest row id of one source table (users, sessions, messages) folded into DailyStats"""
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.name} through {self.last_id}"
+
+class ChatJob(models.Model):
+    """A chat turn answered in the background: /send/?async=1 saves the question, a worker the reply"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    FINISHED = (SUCCEEDED, FAILED)
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_jobs')
+    chat_session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='jobs')
+    user_message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='job')
+    bot_message = models.OneToOneField(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    filters = models.JSONField(null=True, blank=True)  # Retrieval filters sent with the question
+    status = models.CharField(max_length=20, choices=[
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed')
+    ], default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    queued_at = models.DateTimeField(default=timezone.now)  # Last (re)enqueue; the sweeper resends lost ones
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # The sweeper's scans for lost, stuck and finished jobs
+            models.Index(fields=['status', 'queued_at'], name='chat_job_status_queued_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+    
+    @property
+    def finished(self):
+        return self.status in self.FINISHED
\ No newline at end of file
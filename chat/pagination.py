@@ -0,0 +1,119 @@
+import base64
+import json
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on a composite key, e.g. (created_at, id).
+
+    The cursor holds the key of the row a page ends at, and the next page is
+    WHERE key > cursor ORDER BY key LIMIT n. With an index on the key every
+    page costs one index range scan: no OFFSET to skip and no COUNT(*), so
+    page 2000 is as cheap as page 2. The trailing unique field (id) breaks
+    ties between rows sharing a timestamp, so nothing is skipped or repeated.
+    """
+    ordering = ('created_at', 'id')
+    page_size = api_settings.PAGE_SIZE or 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        position, reverse = self.decode_cursor(request)
+
+        ordering = self._flip(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self._after(ordering, position))
+
+        # One extra row tells whether another page exists, without counting
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        has_next, has_previous = (True, has_more) if reverse else (has_more, position is not None)
+        self.next_position = self._key(rows[-1]) if rows and has_next else None
+        self.previous_position = self._key(rows[0]) if rows and has_previous else None
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            requested = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(requested, self.max_page_size))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        return self._link(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        return self._link(self.previous_position, reverse=True)
+
+    @staticmethod
+    def _flip(ordering):
+        return tuple(field[1:] if field.startswith('-') else f"-{field}" for field in ordering)
+
+    def _after(self, ordering, position):
+        """Rows strictly past position in ordering: (a > x) or (a = x and b > y) ..."""
+        condition = Q()
+        for i, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            equal = {ordering[j].lstrip('-'): position[j] for j in range(i)}
+            condition |= Q(**equal, **{f"{name}__{lookup}": position[i]})
+        return condition
+
+    def _key(self, row):
+        return [getattr(row, field.lstrip('-')) for field in self.ordering]
+
+    def _link(self, position, reverse):
+        if position is None:
+            return None
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in position]
+        token = base64.urlsafe_b64encode(json.dumps({'p': values, 'r': reverse}).encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, token)
+
+    def decode_cursor(self, request):
+        """(position or None, reverse) from the cursor query parameter"""
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(token.encode()))
+            # The key is timestamps then the integer id; anything else is a forged or corrupted cursor
+            *timestamps, last_id = cursor['p']
+            if len(timestamps) != len(self.ordering) - 1 or type(last_id) is not int:
+                raise ValueError(token)
+            position = [parse_datetime(value) for value in timestamps]
+            if None in position:
+                raise ValueError(token)
+            return [*position, last_id], bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+class MessageCursorPagination(KeysetPagination):
+    """A session's messages, oldest first"""
+    ordering = ('created_at', 'id')
+
+class SessionCursorPagination(KeysetPagination):
+    """A user's sessions, most recently active first"""
+    ordering = ('-updated_at', '-id')
\ No newline at end of file
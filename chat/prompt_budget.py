@@ -0,0 +1,182 @@
+import threading
+from typing import Dict, List, Sequence, Tuple
+import tiktoken
+from langchain.schema import Document
+
+# Chat format overhead (OpenAI cookbook): each message is wrapped in a few
+# special tokens, and every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# A cut-down item is only worth sending if this much of it survives
+MIN_TRIMMED_TOKENS = 32
+
+CONTEXT_HEADER = "Relevant information from knowledge base:"
+NO_CONTEXT = "No relevant documents found in the knowledge base."
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+class _ApproximateEncoding:
+    """Four characters per token; used only when the model's tokenizer cannot be loaded"""
+    name = "approximate"
+
+    @staticmethod
+    def encode(text: str) -> List[str]:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    @staticmethod
+    def decode(tokens: Sequence[str]) -> str:
+        return "".join(tokens)
+
+def get_encoding(model: str):
+    """The model's tokenizer, loaded once per process"""
+    encoding = _encodings.get(model)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(model)
+            if encoding is None:
+                try:
+                    try:
+                        encoding = tiktoken.encoding_for_model(model)
+                    except KeyError:
+                        encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    # tiktoken downloads its BPE ranks on first use; don't fail chats if that can't happen
+                    print(f"Could not load tokenizer for {model}, estimating token counts: {e}")
+                    encoding = _ApproximateEncoding()
+                _encodings[model] = encoding
+    return encoding
+
+def count_message_tokens(messages: List[Dict[str, str]], encoding) -> int:
+    """Prompt tokens the API will bill for messages"""
+    return TOKENS_PER_REPLY + sum(
+        TOKENS_PER_MESSAGE + len(encoding.encode(message["content"])) for message in messages
+    )
+
+class PromptBuilder:
+    """
+    Assembles system prompt, retrieved chunks, chat history and the question
+    within a token budget.
+
+    The instructions, the conversation summary and the question are always sent. Chunks (by retrieval
+    rank) and history (newest first) are then admitted alternately, so when
+    the budget runs out it is the lowest-ranked chunks and the oldest turns
+    that are dropped; the item that no longer fits whole is trimmed instead
+    if a useful part of it does.
+    """
+
+    def __init__(self, model: str, budget: int, chunk_max_tokens: int):
+        self.encoding = get_encoding(model)
+        self.budget = budget
+        self.chunk_max_tokens = chunk_max_tokens
+
+    def _tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def _trim(self, text: str, max_tokens: int) -> str:
+        tokens = self.encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[:max_tokens]).rstrip() + "..."
+
+    @staticmethod
+    def _format_chunk(number: int, doc: Document, content: str) -> str:
+        source = doc.metadata.get('source', 'Unknown')
+        title = doc.metadata.get('title', 'Untitled')
+        return f"[Document {number} - {title} ({source})]:\n{content}"
+
+    @staticmethod
+    def _by_value(chunks: list, history: list) -> list:
+        """Chunks in retrieval order and history newest first, alternating"""
+        history = history[::-1]
+        order = []
+        for i in range(max(len(chunks), len(history))):
+            order.extend(items[i] for items in (chunks, history) if i < len(items))
+        return order
+
+    @staticmethod
+    def _context(items: list) -> str:
+        chunks = sorted((item for item in items if item["kind"] == "chunk"), key=lambda item: item["position"])
+        return "\n\n".join([CONTEXT_HEADER] + [item["text"] for item in chunks]) if chunks else NO_CONTEXT
+
+    def _assemble(self, system_template: str, items: list, user_query: str, summary: str) -> List[Dict[str, str]]:
+        history = sorted((item for item in items if item["kind"] == "history"), key=lambda item: item["position"])
+        messages = [{"role": "system", "content": system_template.format(context=self._context(items))}]
+        if summary:
+            messages.append({"role": "system", "content": f"{SUMMARY_HEADER}\n{summary}"})
+        messages.extend({"role": item["role"], "content": item["text"]} for item in history)
+        messages.append({"role": "user", "content": user_query})
+        return messages
+
+    def build(self, system_template: str, retrieved_docs: List[Document], chat_history,
+              user_query: str, summary: str = "") -> Tuple[List[Dict[str, str]], dict]:
+        """
+        OpenAI messages plus a token usage breakdown for message metadata.
+
+        system_template holds a {context} placeholder for the retrieved chunks;
+        summary is the running summary of turns no longer in chat_history.
+        """
+        chat_history = list(chat_history or [])
+        # Never let one long chunk crowd out the rest
+        chunks = [{
+            "kind": "chunk", "position": i,
+            "text": self._format_chunk(i + 1, doc, self._trim(doc.page_content, self.chunk_max_tokens)),
+            "overhead": 1,  # the blank line joining it to the context
+        } for i, doc in enumerate(retrieved_docs)]
+        history = [{
+            "kind": "history", "position": i, "role": "user" if msg.is_user else "assistant",
+            "text": msg.content, "overhead": TOKENS_PER_MESSAGE,
+        } for i, msg in enumerate(chat_history)]
+
+        fixed = count_message_tokens(self._assemble(system_template, [], user_query, summary), self.encoding)
+        if fixed > self.budget:
+            # Only an enormous question gets here; keep as much of it as fits
+            keep = self._tokens(user_query) - (fixed - self.budget)
+            user_query = self._trim(user_query, max(keep, MIN_TRIMMED_TOKENS))
+            fixed = count_message_tokens(self._assemble(system_template, [], user_query, summary), self.encoding)
+        remaining = self.budget - fixed + self._tokens(NO_CONTEXT) - self._tokens(CONTEXT_HEADER)
+
+        kept = []
+        for item in self._by_value(chunks, history):
+            cost = self._tokens(item["text"]) + item["overhead"]
+            if cost > remaining:
+                room = remaining - item["overhead"]
+                if room >= MIN_TRIMMED_TOKENS:
+                    kept.append({**item, "text": self._trim(item["text"], room - 1), "trimmed": True})
+                break
+            kept.append(item)
+            remaining -= cost
+
+        # Tokens can merge differently once texts are joined; the exact count of the final prompt decides
+        messages = self._assemble(system_template, kept, user_query, summary)
+        while kept and count_message_tokens(messages, self.encoding) > self.budget:
+            kept.pop()
+            messages = self._assemble(system_template, kept, user_query, summary)
+        return messages, self._usage(messages, kept, chunks, history, summary)
+
+    def _usage(self, messages: List[Dict[str, str]], kept: list, chunks: list, history: list, summary: str) -> dict:
+        kept_chunks = [item for item in kept if item["kind"] == "chunk"]
+        kept_history = [item for item in kept if item["kind"] == "history"]
+        context_tokens = self._tokens(self._context(kept))
+        summary_messages = 1 if summary else 0
+
+        def tokens_of(section):
+            return count_message_tokens(section, self.encoding) - TOKENS_PER_REPLY
+
+        system_tokens = tokens_of(messages[:1])
+        return {
+            "tokenizer": self.encoding.name,
+            "exact": not isinstance(self.encoding, _ApproximateEncoding),
+            "budget": self.budget,
+            "prompt_tokens": count_message_tokens(messages, self.encoding),
+            "instructions": system_tokens - context_tokens,
+            "context": context_tokens,
+            "summary": tokens_of(messages[1:1 + summary_messages]),
+            "history": tokens_of(messages[1 + summary_messages:-1]),
+            "query": tokens_of(messages[-1:]),
+            "context_chunks": {"sent": len(kept_chunks), "dropped": len(chunks) - len(kept_chunks)},
+            "history_messages": {"sent": len(kept_history), "dropped": len(history) - len(kept_history)},
+            "trimmed": [f"{item['kind']}:{item['position']}" for item in kept if item.get("trimmed")],
+        }
\ No newline at end of file
@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+import numpy as np
+
+class LRUCache:
+    """Thread-safe bounded LRU whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def peek(self, key: Hashable) -> Any:
+        """Like get, but without touching the hit/miss counters"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def get(self, key: Hashable) -> Any:
+        value = self.peek(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard_where(self, predicate: Callable[[Any], bool]) -> int:
+        """Remove every entry whose value matches predicate"""
+        with self._lock:
+            stale = [key for key, (value, _) in self._data.items() if predicate(value)]
+            for key in stale:
+                del self._data[key]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-insensitive form used as the cache key"""
+    return " ".join(query.lower().split())
+
+class SemanticResponseCache:
+    """Answers keyed by retrieved chunk ids, matched on query-embedding similarity"""
+
+    # A handful of phrasings per chunk set is plenty
+    MAX_PHRASINGS = 8
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 3600, threshold: float = 0.95):
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # frozenset(chunk ids) -> [(unit query vector, answer, document ids)]
+        self._entries = LRUCache(maxsize, ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, embedding, chunk_ids) -> Optional[str]:
+        """Cached answer for a query this similar that retrieved exactly these chunks"""
+        answer = None
+        candidates = self._entries.peek(frozenset(chunk_ids))
+        if candidates:
+            query = self._unit(embedding)
+            similarity, cached_answer = max((float(entry[0] @ query), entry[1]) for entry in candidates)
+            if similarity >= self.threshold:
+                answer = cached_answer
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer
+
+    def set(self, embedding, chunk_ids, answer: str, document_ids):
+        key = frozenset(chunk_ids)
+        with self._lock:
+            candidates = list(self._entries.peek(key) or [])
+            candidates.append((self._unit(embedding), answer, frozenset(document_ids)))
+            self._entries.set(key, candidates[-self.MAX_PHRASINGS:])
+
+    def invalidate_documents(self, document_ids):
+        """Drop every answer that was grounded in any of these documents"""
+        changed = frozenset(document_ids)
+        if not changed:
+            return
+        removed = self._entries.discard_where(
+            lambda candidates: any(entry[2] & changed for entry in candidates)
+        )
+        with self._lock:
+            self.invalidations += removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self._entries.stats()["size"],
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "threshold": self.threshold,
+                "invalidations": self.invalidations,
+            }
\ No newline at end of file
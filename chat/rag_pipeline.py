@@ -1,119 +1,1049 @@
+import hashlib
+import json
 import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import faiss
+import numpy as np
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.vectorstores import FAISS
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
+from .ann_index import (
+    IVF_TYPES, ann_settings, apply_search_params, build_index, describe_index,
+    index_type_of, read_index, reconstruct_vectors, search_parameters, select_index_type
+)
+from .chunk_filters import ChunkAttributes, normalize_filters
+from .chunk_store import ChunkStore
+from .embedding_cache import CachedEmbeddings, EmbeddingCache
+from .index_wal import WriteAheadLog, WriterLease
+from .lexical_index import FrozenLexicalIndex, LexicalIndex, bm25_search, reciprocal_rank_fusion
+from .query_cache import LRUCache, normalize_query
+
+BASE_INDEX_DIR = "faiss_index"
+INDEX_VERSIONS_DIR = "index_versions"
+CURRENT_FILE = "CURRENT"
+WAL_FILE = "index.wal"
+WRITER_LOCK_FILE = "writer.lock"
+REBUILD_HOLD_FILE = "rebuild.hold"
+DELTA_INDEX_DIR = "faiss_deltas"
+TOMBSTONE_LOG = "tombstones.log"
+BASE_VECTORS_FILE = "vectors.npy"
+BASE_META_FILE = "index_meta.json"
+BASE_INDEX_FILE = "index.faiss"
+EMBEDDING_CACHE_FILE = "embedding_cache.sqlite3"
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+def build_text_splitter() -> RecursiveCharacterTextSplitter:
+    """Chunking used for every document that enters the index"""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=200,
+        length_function=len,
+        separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
+    )
+
+class ReadWriteLock:
+    """Many concurrent readers or a single writer"""
+    
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+    
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+    
+    @contextmanager
+    def write(self):
+        with self._cond:
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
 
 class RAGPipeline:
-    def __init__(self, knowledge_base_path: Optional[str] = None):
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
+    def __init__(self, knowledge_base_path: Optional[str] = None, use_embedding_cache: bool = True,
+                 read_only: bool = False):
+        self.knowledge_base_path = knowledge_base_path or "knowledge_base"
+        # Serving-only processes: the base stays memory-mapped and mutations are refused
+        self.read_only = read_only
+        self.embedding_cache = EmbeddingCache(
+            str(Path(self.knowledge_base_path) / EMBEDDING_CACHE_FILE),
+            EMBEDDING_MODEL_NAME
+        ) if use_embedding_cache else None
+        self.embeddings = CachedEmbeddings(
+            HuggingFaceEmbeddings(
+                model_name=EMBEDDING_MODEL_NAME,
+                model_kwargs={'device': 'cpu'},
+                encode_kwargs={'normalize_embeddings': True}
+            ),
+            self.embedding_cache
         )
         
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-            separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
-        )
+        self.text_splitter = build_text_splitter()
         
+        self.ann_config = ann_settings()
+        # Compacted base index (flat, IVF or HNSW) plus a flat store of every delta since
         self.vector_store = None
-        self.knowledge_base_path = knowledge_base_path or "knowledge_base"
+        self.delta_store = None
+        # BM25 inverted indexes over the same chunks, position for position
+        self.base_lexical = None
+        self.delta_lexical = None
+        # Filterable metadata (type, source, added_at) of the same chunks
+        self.base_attributes = None
+        self.delta_attributes = None
+        self.retrieval_mode, self.rrf_k = self._retrieval_settings()
+        # Chunk ids removed since the last compaction, skipped at query time
+        self.tombstones: Set[str] = set()
+        # knowledge.Document id -> ids of its live chunks in the vector store
+        self.document_chunks: Dict[int, Set[str]] = {}
+        self.lock = ReadWriteLock()
+        
+        # The published manifest this process serves, and the CURRENT file stat it was read at
+        self.manifest: Optional[dict] = None
+        self._current_stamp = None
+        self._watcher = None
+        # Every mutation is logged here first and applied by whichever process holds the lease
+        self.wal = WriteAheadLog(Path(self.knowledge_base_path) / WAL_FILE)
+        self.lease = WriterLease(Path(self.knowledge_base_path) / WRITER_LOCK_FILE)
+        
+        # Bumped on every index mutation; retrieval cache entries are keyed on it
+        self.index_version = 0
+        # Callbacks told which knowledge document ids changed (re-indexed or removed)
+        self.change_listeners = []
+        cache_size, cache_ttl = self._query_cache_settings()
+        self.query_embedding_cache = LRUCache(cache_size, cache_ttl)
+        self.retrieval_cache = LRUCache(cache_size, cache_ttl)
+        # Filter bitmaps per store for the current index version
+        self.filter_masks = LRUCache(64, None)
         
         self._initialize_vector_store()
     
+    @staticmethod
+    def _query_cache_settings() -> Tuple[int, float]:
+        from django.conf import settings
+        return (
+            getattr(settings, 'RAG_QUERY_CACHE_SIZE', 1024),
+            getattr(settings, 'RAG_QUERY_CACHE_TTL', 300),
+        )
+    
+    @staticmethod
+    def _retrieval_settings() -> Tuple[str, int]:
+        from django.conf import settings
+        return (
+            getattr(settings, 'RAG_RETRIEVAL_MODE', 'dense'),
+            getattr(settings, 'RAG_RRF_K', 60),
+        )
+    
+    def _bump_index_version(self, model_changed: bool = False):
+        """Invalidate cached retrievals after the index changes; caller holds the write lock"""
+        self.index_version += 1
+        self.retrieval_cache.clear()
+        self.filter_masks.clear()
+        if model_changed:
+            self.query_embedding_cache.clear()
+    
     def _initialize_vector_store(self):
         """Initialize or load vector store"""
-        vector_store_path = Path(self.knowledge_base_path) / "faiss_index"
+        stamp = self._stat_current()
+        manifest = self._read_manifest()
         
-        if vector_store_path.exists():
+        if manifest is not None:
             try:
-                self.vector_store = FAISS.load_local(
-                    str(vector_store_path), 
-                    self.embeddings
-                )
-                print(f"Loaded existing vector store with {self.vector_store.index.ntotal} documents")
+                self._install_state(self._load_state(manifest), stamp)
+                print(f"Loaded existing {index_type_of(self.vector_store.index)} vector store with "
+                      f"{self._total_vectors()} documents ({len(manifest['deltas'])} delta segments)")
             except Exception as e:
                 print(f"Error loading vector store: {e}. Creating new one...")
                 self._create_empty_vector_store()
         else:
             self._create_empty_vector_store()
     
-    def _create_empty_vector_store(self):
-        """Create empty vector store"""
-        # Create with a dummy document
-        dummy_doc = Document(
+    def _stat_current(self):
+        """Cheap change check: CURRENT is replaced, never rewritten, on every publish"""
+        try:
+            stat = os.stat(Path(self.knowledge_base_path) / CURRENT_FILE)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+    
+    def _read_manifest(self) -> Optional[dict]:
+        """The published index: a base version directory plus the delta segments on top of it"""
+        root = Path(self.knowledge_base_path)
+        current = root / CURRENT_FILE
+        if current.exists():
+            return json.loads(current.read_text())
+        # Layout from before versioning: a single mutable base directory
+        if (root / BASE_INDEX_DIR).exists():
+            return {"generation": 0, "base": BASE_INDEX_DIR, "deltas": [p.name for p in self._delta_paths()]}
+        return None
+    
+    def _publish(self, base: Optional[str] = None, deltas: Optional[List[str]] = None,
+                 applied_seq: Optional[int] = None) -> dict:
+        """Atomically point CURRENT at a base version and delta set; serving workers pick it up"""
+        root = Path(self.knowledge_base_path)
+        current = self._read_manifest() or self.manifest or {}
+        manifest = {
+            "generation": time.time_ns(),
+            "base": base if base is not None else current["base"],
+            "deltas": deltas if deltas is not None else current["deltas"],
+            # Last write-ahead log entry reflected in this index
+            "applied_seq": applied_seq if applied_seq is not None else current.get("applied_seq", 0),
+        }
+        tmp_path = root / f".{CURRENT_FILE}.{uuid.uuid4().hex[:8]}"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(manifest))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, root / CURRENT_FILE)
+        
+        # This process already holds the published state
+        self.manifest = manifest
+        self._current_stamp = self._stat_current()
+        return manifest
+    
+    def _load_state(self, manifest: dict) -> dict:
+        """Everything a manifest describes, loaded without touching the live state"""
+        root = Path(self.knowledge_base_path)
+        tombstones = self._load_tombstones()
+        base_path = root / manifest["base"]
+        vector_store = self._load_base(base_path)
+        if FrozenLexicalIndex.exists(base_path) and ChunkAttributes.exists(base_path):
+            base_lexical = FrozenLexicalIndex(base_path)
+            base_attributes = ChunkAttributes.load(base_path)
+        else:
+            # Older bases get these built in memory until their next compaction
+            base_documents = list(self._store_documents(vector_store))
+            base_lexical = LexicalIndex.build(doc.page_content for doc in base_documents)
+            base_attributes = ChunkAttributes.from_documents(base_documents)
+        # IVF and HNSW indexes cannot absorb a flat segment, so deltas are searched alongside
+        delta_store = None
+        for name in manifest["deltas"]:
+            delta = FAISS.load_local(str(root / DELTA_INDEX_DIR / name), self.embeddings)
+            if delta_store is None:
+                delta_store = delta
+            else:
+                delta_store.merge_from(delta)
+        delta_lexical = delta_attributes = None
+        if delta_store is not None:
+            delta_documents = list(self._store_documents(delta_store))
+            delta_lexical = LexicalIndex.build(doc.page_content for doc in delta_documents)
+            delta_attributes = ChunkAttributes.from_documents(delta_documents)
+        
+        document_chunks = {}
+        # Only writers need the document -> chunk map, and building it touches every chunk
+        if not self.read_only:
+            for store in (vector_store, delta_store):
+                if store is not None:
+                    self._index_chunks(store, document_chunks, tombstones)
+        return {
+            "manifest": manifest,
+            "vector_store": vector_store,
+            "delta_store": delta_store,
+            "base_lexical": base_lexical,
+            "delta_lexical": delta_lexical,
+            "base_attributes": base_attributes,
+            "delta_attributes": delta_attributes,
+            "tombstones": tombstones,
+            "document_chunks": document_chunks,
+        }
+    
+    @staticmethod
+    def _store_documents(store: FAISS, start: int = 0) -> Iterable[Document]:
+        """Chunks of store in index-position order, from position start"""
+        for position in range(start, store.index.ntotal):
+            yield store.docstore.search(store.index_to_docstore_id[position])
+    
+    def _install_state(self, state: dict, stamp):
+        self.manifest = state["manifest"]
+        self.vector_store = state["vector_store"]
+        self.delta_store = state["delta_store"]
+        self.base_lexical = state["base_lexical"]
+        self.delta_lexical = state["delta_lexical"]
+        self.base_attributes = state["base_attributes"]
+        self.delta_attributes = state["delta_attributes"]
+        self.tombstones = state["tombstones"]
+        self.document_chunks = state["document_chunks"]
+        self._current_stamp = stamp
+    
+    def refresh(self) -> bool:
+        """Swap in a newer published index if there is one; True when swapped"""
+        stamp = self._stat_current()
+        if stamp is None or stamp == self._current_stamp:
+            return False
+        manifest = self._read_manifest()
+        if self.manifest is not None and manifest["generation"] == self.manifest["generation"]:
+            self._current_stamp = stamp
+            return False
+        
+        # Load outside the lock so queries keep hitting the old version meanwhile
+        state = self._load_state(manifest)
+        with self.lock.write():
+            self._install_state(state, stamp)
+            self._bump_index_version()
+        # The previous version's maps are released once the last in-flight query drops them
+        print(f"Switched to index generation {manifest['generation']} ({manifest['base']}, "
+              f"{len(manifest['deltas'])} delta segments)")
+        return True
+    
+    def _reload(self, model_changed: bool = False):
+        """Serve what this process just published"""
+        state = self._load_state(self.manifest)
+        with self.lock.write():
+            self._install_state(state, self._current_stamp)
+            self._bump_index_version(model_changed=model_changed)
+    
+    def start_watcher(self, interval: float):
+        """Poll CURRENT in a daemon thread and hot-swap new versions as they are published"""
+        if self._watcher is not None or interval <= 0:
+            return
+        
+        def _watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    # Typically a version collected mid-load; the next poll retries
+                    print(f"Error refreshing vector store: {e}")
+        
+        self._watcher = threading.Thread(target=_watch, name="rag-index-watcher", daemon=True)
+        self._watcher.start()
+    
+    def _tombstone_paths(self) -> List[Path]:
+        """The live tombstone log plus any left behind by an interrupted compaction"""
+        root = Path(self.knowledge_base_path)
+        return sorted(root.glob(f"{TOMBSTONE_LOG}.*.merging")) + [root / TOMBSTONE_LOG]
+    
+    def _load_tombstones(self, paths: Optional[Iterable[Path]] = None) -> Set[str]:
+        tombstones = set()
+        for path in paths if paths is not None else self._tombstone_paths():
+            if path.exists():
+                tombstones.update(line.strip() for line in path.read_text().splitlines() if line.strip())
+        return tombstones
+    
+    def _append_tombstones(self, chunk_ids: Iterable[str]):
+        path = Path(self.knowledge_base_path) / TOMBSTONE_LOG
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            f.write("".join(f"{chunk_id}\n" for chunk_id in chunk_ids))
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def _index_chunks(self, store: FAISS, document_chunks: Optional[Dict[int, Set[str]]] = None,
+                      tombstones: Optional[Set[str]] = None):
+        """Record which document each chunk of store belongs to"""
+        document_chunks = self.document_chunks if document_chunks is None else document_chunks
+        tombstones = self.tombstones if tombstones is None else tombstones
+        if isinstance(store.docstore, ChunkStore):
+            for document_id, chunk_ids in store.docstore.document_chunks().items():
+                live = chunk_ids - tombstones
+                if live:
+                    document_chunks.setdefault(document_id, set()).update(live)
+            return
+        
+        for chunk_id in store.index_to_docstore_id.values():
+            if chunk_id in tombstones:
+                continue
+            document_id = store.docstore.search(chunk_id).metadata.get("document_id")
+            if document_id is not None:
+                document_chunks.setdefault(document_id, set()).add(chunk_id)
+    
+    def _tombstone_documents(self, document_ids: Iterable[int]) -> int:
+        """Hide every chunk of the given documents until the next compaction"""
+        document_ids = list(document_ids)
+        chunk_ids = []
+        for document_id in document_ids:
+            chunk_ids.extend(self.document_chunks.pop(document_id, ()))
+        if chunk_ids:
+            self._append_tombstones(chunk_ids)
+            self.tombstones.update(chunk_ids)
+        for listener in self.change_listeners:
+            listener(document_ids)
+        return len(chunk_ids)
+    
+    def _segment_chunk_ids(self, paths: Iterable[Path]) -> Set[str]:
+        chunk_ids = set()
+        for path in paths:
+            chunk_ids.update(FAISS.load_local(str(path), self.embeddings).index_to_docstore_id.values())
+        return chunk_ids
+    
+    def _replace_tombstones(self, tombstone_paths: List[Path], keep: Set[str]):
+        """Retire consumed tombstone logs, re-logging the ids that still hide live chunks"""
+        if keep:
+            self._append_tombstones(keep)
+        for path in tombstone_paths:
+            path.unlink()
+    
+    def _set_aside_tombstones(self) -> List[Path]:
+        """Move the live tombstone log aside so new removals start a fresh one"""
+        tombstone_log = Path(self.knowledge_base_path) / TOMBSTONE_LOG
+        if tombstone_log.exists():
+            os.rename(tombstone_log, tombstone_log.with_name(f"{TOMBSTONE_LOG}.{time.time_ns():020d}.merging"))
+        return self._tombstone_paths()[:-1]
+    
+    def _current_base_path(self) -> Optional[Path]:
+        manifest = self._read_manifest()
+        return Path(self.knowledge_base_path) / manifest["base"] if manifest else None
+    
+    def _base_meta(self) -> dict:
+        """Type, parameters and training size recorded with the published base"""
+        base_path = self._current_base_path()
+        path = base_path / BASE_META_FILE if base_path else None
+        return json.loads(path.read_text()) if path and path.exists() else {}
+    
+    def _build_base(self, entries: List[Tuple[str, Document, np.ndarray]], trained=None):
+        """Base store over (chunk_id, document, vector) entries; returns (store, vectors, retrained)"""
+        if not entries:
+            placeholder = self._placeholder_document()
+            entries = [(str(uuid.uuid4()), placeholder,
+                        np.asarray(self.embeddings.embed_documents([placeholder.page_content])[0]))]
+        chunk_ids = [chunk_id for chunk_id, _, _ in entries]
+        vectors = np.vstack([vector for _, _, vector in entries]).astype(np.float32)
+        index, retrained = build_index(vectors, self.ann_config, trained)
+        store = FAISS(
+            self.embeddings,
+            index,
+            InMemoryDocstore({chunk_id: doc for chunk_id, doc, _ in entries}),
+            dict(enumerate(chunk_ids))
+        )
+        return store, vectors, retrained
+    
+    def _live_entries(self, store: FAISS, vectors: np.ndarray, tombstones: Set[str]):
+        """(chunk_id, document, vector) for every chunk of store not tombstoned"""
+        for position, chunk_id in sorted(store.index_to_docstore_id.items()):
+            if chunk_id in tombstones:
+                continue
+            doc = store.docstore.search(chunk_id)
+            if not self._is_placeholder(doc):
+                yield chunk_id, doc, vectors[position]
+    
+    def _write_version(self, store: FAISS, vectors: np.ndarray, retrained: bool) -> str:
+        """Write store as a new immutable base version; returns its path relative to the knowledge base"""
+        versions_root = Path(self.knowledge_base_path) / INDEX_VERSIONS_DIR
+        versions_root.mkdir(parents=True, exist_ok=True)
+        name = f"{time.time_ns():020d}"
+        tmp_path = versions_root / f".{name}"
+        
+        # Raw vectors let compaction rebuild IVF-PQ/HNSW bases, which cannot hand them back exactly
+        meta = self._base_meta()
+        description = describe_index(store.index)
+        if retrained or description["index_type"] not in IVF_TYPES or meta.get("index_type") != description["index_type"]:
+            meta["trained_on"] = store.index.ntotal
+        meta.update(description, built_at=time.time())
+        # Chunks go to the mmap-friendly chunk store rather than langchain's pickled docstore
+        tmp_path.mkdir(parents=True)
+        faiss.write_index(store.index, str(tmp_path / BASE_INDEX_FILE))
+        chunk_ids = [store.index_to_docstore_id[position] for position in range(store.index.ntotal)]
+        documents = [store.docstore.search(chunk_id) for chunk_id in chunk_ids]
+        ChunkStore.write(tmp_path, chunk_ids, documents)
+        LexicalIndex.build(doc.page_content for doc in documents).save(tmp_path)
+        ChunkAttributes.from_documents(documents).save(tmp_path)
+        np.save(tmp_path / BASE_VECTORS_FILE, vectors)
+        (tmp_path / BASE_META_FILE).write_text(json.dumps(meta))
+        os.rename(tmp_path, versions_root / name)
+        return f"{INDEX_VERSIONS_DIR}/{name}"
+    
+    def _collect_versions(self):
+        """Delete superseded base versions, keeping a few for workers still loading them"""
+        from django.conf import settings
+        keep = getattr(settings, 'RAG_INDEX_KEEP_VERSIONS', 2)
+        root = Path(self.knowledge_base_path)
+        current = root / self.manifest["base"]
+        versions_root = root / INDEX_VERSIONS_DIR
+        superseded = sorted(
+            (p for p in versions_root.iterdir() if p != current and not p.name.startswith(".")),
+            reverse=True
+        ) if versions_root.exists() else []
+        for path in superseded[keep:]:
+            shutil.rmtree(path, ignore_errors=True)
+        # The pre-versioning base is retired once a version replaces it
+        if current != root / BASE_INDEX_DIR:
+            shutil.rmtree(root / BASE_INDEX_DIR, ignore_errors=True)
+    
+    def _delta_paths(self) -> List[Path]:
+        """Delta segments on disk, oldest first"""
+        delta_root = Path(self.knowledge_base_path) / DELTA_INDEX_DIR
+        if not delta_root.exists():
+            return []
+        return sorted(p for p in delta_root.iterdir() if p.is_dir() and not p.name.startswith("."))
+    
+    def _load_base(self, base_path: Path, mmap: bool = True) -> FAISS:
+        """
+        A base version from disk.
+        
+        Memory-mapped by default so every process on the host shares one copy
+        through the page cache; compaction loads it privately because a mapped
+        index cannot be cloned and refilled.
+        """
+        if ChunkStore.exists(base_path):
+            docstore = ChunkStore(base_path)
+            base = FAISS(
+                self.embeddings,
+                read_index(str(base_path / BASE_INDEX_FILE), mmap=mmap),
+                docstore,
+                docstore.chunk_ids
+            )
+        else:
+            # Bases written before the chunk store still carry langchain's pickle
+            base = FAISS.load_local(str(base_path), self.embeddings)
+        apply_search_params(base.index, self.ann_config)
+        return base
+    
+    def _base_vectors(self, base: FAISS, base_path: Path) -> np.ndarray:
+        vectors_path = base_path / BASE_VECTORS_FILE
+        # Bases written before vectors were kept alongside are flat, so reconstruction is exact
+        return np.load(vectors_path, mmap_mode="r") if vectors_path.exists() else reconstruct_vectors(base.index)
+    
+    def _stores(self) -> List[FAISS]:
+        return [store for store in (self.vector_store, self.delta_store) if store is not None]
+    
+    def _filter_masks(self, filters: Optional[Tuple]) -> Optional[List[np.ndarray]]:
+        """Bitmap of the chunks matching normalized filters, one per store in _stores() order"""
+        if filters is None:
+            return None
+        key = (filters, self.index_version)
+        masks = self.filter_masks.get(key)
+        if masks is None:
+            masks = [attributes.mask(filters) for store, attributes in (
+                (self.vector_store, self.base_attributes), (self.delta_store, self.delta_attributes)
+            ) if store is not None]
+            self.filter_masks.set(key, masks)
+        return masks
+    
+    def _total_vectors(self) -> int:
+        return sum(store.index.ntotal for store in self._stores())
+    
+    @staticmethod
+    def _placeholder_document() -> Document:
+        return Document(
             page_content="This is a placeholder document.",
             metadata={"source": "system", "title": "Placeholder"}
         )
-        self.vector_store = FAISS.from_documents([dummy_doc], self.embeddings)
-        self._save_vector_store()
+    
+    def _create_empty_vector_store(self):
+        """Create empty vector store"""
+        # Create with a dummy document
+        self.vector_store, vectors, retrained = self._build_base([])
+        self.delta_store = None
+        placeholder = list(self._store_documents(self.vector_store))
+        self.base_lexical = LexicalIndex.build(doc.page_content for doc in placeholder)
+        self.base_attributes = ChunkAttributes.from_documents(placeholder)
+        self.delta_lexical = self.delta_attributes = None
+        if self.read_only:
+            print("Serving an empty in-memory vector store until a writer publishes one")
+            return
+        self._publish(base=self._write_version(self.vector_store, vectors, retrained), deltas=[])
         print("Created new vector store")
     
-    def _save_vector_store(self):
-        """Save vector store to disk"""
-        vector_store_path = Path(self.knowledge_base_path) / "faiss_index"
-        vector_store_path.parent.mkdir(parents=True, exist_ok=True)
-        self.vector_store.save_local(str(vector_store_path))
-        print(f"Saved vector store to {vector_store_path}")
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError("This RAG pipeline was opened read-only; index changes belong to a writer process")
+    
+    def _save_delta(self, delta: FAISS) -> Path:
+        """Write a delta segment holding only the newly added vectors"""
+        delta_root = Path(self.knowledge_base_path) / DELTA_INDEX_DIR
+        delta_root.mkdir(parents=True, exist_ok=True)
+        # Time-ordered names so segments replay in insertion order across processes
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        tmp_path = delta_root / f".{name}"
+        delta.save_local(str(tmp_path))
+        delta_path = delta_root / name
+        os.rename(tmp_path, delta_path)
+        return delta_path
     
-    def add_documents(self, documents: List[Document]):
-        """Add documents to knowledge base"""
+    def add_documents(self, documents: List[Document], replace_existing: bool = True):
+        """Add documents to knowledge base, replacing older chunks of the same document_id"""
+        self._check_writable()
         if not documents:
             return
+        self._submit("upsert", {
+            "documents": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents],
+            "replace_existing": replace_existing,
+        })
+    
+    def remove_documents(self, document_ids: Iterable[int]) -> int:
+        """Drop every chunk of the given knowledge documents from retrieval"""
+        self._check_writable()
+        return self._submit("remove", {"document_ids": list(document_ids)}) or 0
+    
+    def _submit(self, op: str, payload: dict):
+        """
+        Log an operation durably, then apply the log as the single writer.
         
+        Blocks until the lease is free; by then the previous holder may have
+        applied this operation already, in which case there is nothing to do.
+        """
+        seq = self.wal.append(op, payload, min_seq=(self._read_manifest() or self.manifest).get("applied_seq", 0))
+        with self.lease.hold():
+            results = self._drain()
+        result = results.get(seq)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    
+    def _applied_seq(self) -> int:
+        return self.manifest.get("applied_seq", 0)
+    
+    def _drain(self) -> dict:
+        """Apply every logged operation the published index lacks, in order; caller holds the lease"""
+        # Another process may have written since this one last looked
+        self.refresh()
+        results = {}
+        while True:
+            pending = self.wal.pending(self._applied_seq())
+            if not pending:
+                break
+            for entry in pending:
+                try:
+                    results[entry["seq"]] = self._apply(entry)
+                except Exception as e:
+                    # Skip past a failing operation rather than wedge the log behind it
+                    print(f"Error applying index log entry {entry['seq']} ({entry['op']}): {e}")
+                    self._publish(applied_seq=entry["seq"])
+                    results[entry["seq"]] = e
+        self.wal.truncate(self._applied_seq(), keep_since=self._log_hold())
+        return results
+    
+    def hold_log(self, started_ns: int):
+        """Keep log entries from started_ns on after they are applied, until publish_rebuild reads them"""
+        self._check_writable()
+        path = Path(self.knowledge_base_path) / REBUILD_HOLD_FILE
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(str(started_ns))
+    
+    def _log_hold(self) -> Optional[float]:
+        path = Path(self.knowledge_base_path) / REBUILD_HOLD_FILE
+        return int(path.read_text()) / 1e9 if path.exists() else None
+    
+    def _documents_changed_since(self, started_ns: int, segments: Iterable[Path]) -> Set[int]:
+        """Documents upserted or removed since started_ns, per the held log and the given delta segments"""
+        changed = set()
+        for entry in self.wal.logged_since(started_ns / 1e9):
+            if entry["op"] == "remove":
+                changed.update(entry["document_ids"])
+            elif entry["op"] == "upsert":
+                changed.update(doc["metadata"].get("document_id") for doc in entry["documents"])
+        # An upsert logged before the rebuild started can still have been applied after it
+        for path in segments:
+            document_chunks = {}
+            self._index_chunks(FAISS.load_local(str(path), self.embeddings), document_chunks, set())
+            changed.update(document_chunks)
+        return changed - {None}
+    
+    def recover(self) -> dict:
+        """Replay operations logged but not applied, e.g. after a writer crashed mid-way"""
+        self._check_writable()
+        with self.lease.hold():
+            replayed = len(self._drain())
+        return {"replayed_operations": replayed, **self.wal.stats(self._applied_seq())}
+    
+    def _apply(self, entry: dict):
+        if entry["op"] == "upsert":
+            documents = [Document(**doc) for doc in entry["documents"]]
+            return self._apply_upsert(documents, entry["replace_existing"], entry["seq"])
+        if entry["op"] == "remove":
+            return self._apply_remove(entry["document_ids"], entry["seq"])
+        raise ValueError(f"Unknown index operation {entry['op']!r}")
+    
+    def _apply_upsert(self, documents: List[Document], replace_existing: bool, seq: int) -> int:
         chunks = self.text_splitter.split_documents(documents)
-        if self.vector_store.index.ntotal == 1 and "Placeholder" in self.vector_store.docstore._dict:
-            # Replace the placeholder
-            self.vector_store = FAISS.from_documents(chunks, self.embeddings)
-        else:
-            self.vector_store.add_documents(chunks)
+        if not chunks:
+            self._publish(applied_seq=seq)
+            return 0
         
-        self._save_vector_store()
-        print(f"Added {len(chunks)} chunks to knowledge base")
+        # Embed outside the lock so searches keep running while we encode
+        delta = FAISS.from_documents(chunks, self.embeddings)
+        document_ids = {chunk.metadata.get("document_id") for chunk in chunks} - {None}
+        with self.lock.write():
+            if replace_existing:
+                self._tombstone_documents(document_ids)
+            delta_path = self._save_delta(delta)
+            if self.delta_store is None:
+                self.delta_store = delta
+                self.delta_lexical = LexicalIndex()
+                self.delta_attributes = ChunkAttributes.empty()
+            else:
+                self.delta_store.merge_from(delta)
+            added = list(self._store_documents(self.delta_store, start=self.delta_lexical.num_docs))
+            self.delta_lexical.add(doc.page_content for doc in added)
+            self.delta_attributes.append(added)
+            self._index_chunks(delta)
+            # The delta and the log position become visible together
+            self._publish(deltas=self.manifest["deltas"] + [delta_path.name], applied_seq=seq)
+            self._bump_index_version()
+        print(f"Added {len(chunks)} chunks to knowledge base (segment {delta_path.name})")
+        return len(chunks)
     
-    def retrieve(self, query: str, k: int = 3) -> List[Document]:
-        """Retrieve relevant documents for a query"""
-        try:
-            docs = self.vector_store.similarity_search(query, k=k)
+    def _apply_remove(self, document_ids: List[int], seq: int) -> int:
+        with self.lock.write():
+            removed = self._tombstone_documents(document_ids)
+            self._publish(applied_seq=seq)
+            if removed:
+                self._bump_index_version()
+        print(f"Removed {removed} chunks from knowledge base")
+        return removed
+    
+    def compact(self, min_deltas: int = 1, retrain: bool = False) -> dict:
+        """Merge delta segments on disk back into the base index"""
+        self._check_writable()
+        with self.lease.hold():
+            # Apply anything logged first; the rebuilt base then covers it too
+            self._drain()
+            return self._compact(min_deltas, retrain)
+    
+    def _compact(self, min_deltas: int, retrain: bool) -> dict:
+        delta_root = Path(self.knowledge_base_path) / DELTA_INDEX_DIR
+        deltas = [delta_root / name for name in self.manifest["deltas"]]
+        tombstone_log = Path(self.knowledge_base_path) / TOMBSTONE_LOG
+        if not retrain and len(deltas) < min_deltas and not tombstone_log.exists():
+            return {"merged_deltas": 0, "removed_chunks": 0, "retrained": False,
+                    "total_documents": self._total_vectors()}
+        
+        tombstone_paths = self._set_aside_tombstones()
+        tombstones = self._load_tombstones(tombstone_paths)
+        
+        base_path = self._current_base_path()
+        base = self._load_base(base_path, mmap=False)
+        base_vectors = self._base_vectors(base, base_path)
+        dead = sum(chunk_id in tombstones for chunk_id in base.index_to_docstore_id.values())
+        entries = list(self._live_entries(base, base_vectors, tombstones))
+        for delta_path in deltas:
+            delta = FAISS.load_local(str(delta_path), self.embeddings)
+            dead += sum(chunk_id in tombstones for chunk_id in delta.index_to_docstore_id.values())
+            entries.extend(self._live_entries(delta, reconstruct_vectors(delta.index), tombstones))
+        
+        # Keep the trained coarse quantizer unless asked to retrain; refilling it is far cheaper
+        compacted, vectors, retrained = self._build_base(entries, trained=None if retrain else base.index)
+        self._publish(base=self._write_version(compacted, vectors, retrained), deltas=[])
+        # Unlisted segments were left by a writer that died before publishing; the log replayed them
+        for delta_path in self._delta_paths():
+            shutil.rmtree(delta_path, ignore_errors=True)
+        
+        self._replace_tombstones(tombstone_paths, set())
+        self._collect_versions()
+        
+        # Serve the compacted base here too instead of holding the merged deltas in memory
+        self._reload()
+        
+        print(f"Compacted {len(deltas)} delta segments into {index_type_of(compacted.index)} base index "
+              f"({compacted.index.ntotal} vectors, {dead} removed{', retrained' if retrained else ''})")
+        return {"merged_deltas": len(deltas), "removed_chunks": dead, "retrained": retrained,
+                "total_documents": compacted.index.ntotal}
+    
+    def retrain(self, force: bool = False) -> dict:
+        """Rebuild the base with a freshly trained quantizer once the corpus has drifted from it"""
+        meta = self._base_meta()
+        ntotal = self._total_vectors()
+        growth = ntotal / max(meta.get("trained_on") or 1, 1)
+        factor = self.ann_config["retrain_growth"]
+        selected = select_index_type(ntotal, self.ann_config)
+        
+        due = force or selected != meta.get("index_type") or (
+            selected in IVF_TYPES and (growth >= factor or growth <= 1 / factor)
+        )
+        if not due:
+            return {"retrained": False, "index_type": selected, "growth": round(growth, 2)}
+        
+        result = self.compact(min_deltas=0, retrain=True)
+        result.update(index_type=index_type_of(self.vector_store.index), growth=round(growth, 2))
+        return result
+    
+    def publish_rebuild(self, store: FAISS, started_ns: int):
+        """
+        Install a freshly rebuilt index as the base, keeping segments written since started_ns.
+        
+        The rebuild read each document once, so a document upserted or removed
+        since started_ns has stale chunks in it; those are tombstoned before
+        the base goes live, leaving the newer segments (or the removal) to win.
+        """
+        self._check_writable()
+        rebuilt, vectors, retrained = self._build_base(
+            list(self._live_entries(store, reconstruct_vectors(store.index), set()))
+        )
+        with self.lease.hold():
+            self._drain()
+            tombstone_paths = self._set_aside_tombstones()
+            tombstones = self._load_tombstones(tombstone_paths)
+            version = self._write_version(rebuilt, vectors, retrained)
+            
+            delta_root = Path(self.knowledge_base_path) / DELTA_INDEX_DIR
+            newer = [delta_root / name for name in self.manifest["deltas"]
+                     if int(name.split("-")[0]) >= started_ns]
+            changed = self._documents_changed_since(started_ns, newer)
+            stale = [chunk_id for chunk_id, doc, _ in self._live_entries(rebuilt, vectors, set())
+                     if doc.metadata.get("document_id") in changed]
+            if stale:
+                self._append_tombstones(stale)
+            self._publish(base=version, deltas=[p.name for p in newer])
+            for delta_path in self._delta_paths():
+                if delta_path not in newer:
+                    shutil.rmtree(delta_path, ignore_errors=True)
+            self._replace_tombstones(tombstone_paths, tombstones & self._segment_chunk_ids(newer))
+            (Path(self.knowledge_base_path) / REBUILD_HOLD_FILE).unlink(missing_ok=True)
+            self._collect_versions()
             
-            # Filter out placeholder if it's the only result
-            if len(docs) == 1 and "Placeholder" in str(docs[0].metadata.get('title', '')):
-                return []
+            # Reload so this process serves the rebuilt index too
+            self._reload(model_changed=True)
+    
+    def _search(self, embedding: List[float], k: int,
+                masks: Optional[List[np.ndarray]] = None) -> List[Tuple[str, Document, float]]:
+        """Top-k live chunks as (chunk_id, document, distance); caller holds the read lock"""
+        query = np.array([embedding], dtype=np.float32)
+        # Over-fetch enough to cover tombstoned chunks and the placeholder
+        wanted = k + 1 + len(self.tombstones)
+        
+        candidates = []
+        for store, mask in zip(self._stores(), masks or [None] * 2):
+            fetch_k = min(store.index.ntotal if mask is None else int(mask.sum()), wanted)
+            if fetch_k <= 0:
+                continue
+            if mask is None:
+                scores, positions = store.index.search(query, fetch_k)
+            else:
+                # Filter inside FAISS so the k hits returned all match, however selective the filter
+                params, bitmap = search_parameters(store.index, mask)
+                scores, positions = store.index.search(query, fetch_k, params=params)
+            for score, position in zip(scores[0], positions[0]):
+                if position == -1:
+                    continue
+                chunk_id = store.index_to_docstore_id[position]
+                if chunk_id not in self.tombstones:
+                    candidates.append((float(score), chunk_id, store))
+        
+        # Both stores report L2 distances, so their hits merge directly
+        candidates.sort(key=lambda candidate: candidate[0])
+        results = []
+        for score, chunk_id, store in candidates:
+            doc = store.docstore.search(chunk_id)
+            if self._is_placeholder(doc):
+                continue
+            results.append((chunk_id, doc, score))
+            if len(results) == k:
+                break
+        return results
+    
+    def _lexical_search(self, query: str, k: int,
+                        masks: Optional[List[np.ndarray]] = None) -> List[Tuple[str, Document, float]]:
+        """Top-k live chunks by BM25 as (chunk_id, document, score); caller holds the read lock"""
+        pairs = [(store, lexical) for store, lexical in (
+            (self.vector_store, self.base_lexical), (self.delta_store, self.delta_lexical)
+        ) if store is not None]
+        searchable = [(store, lexical, mask) for (store, lexical), mask in zip(pairs, masks or [None] * len(pairs))
+                      if lexical is not None]
+        hits = bm25_search([lexical for _, lexical, _ in searchable], query, k + 1 + len(self.tombstones),
+                           masks=[mask for _, _, mask in searchable])
+        
+        candidates = []
+        for (store, _, _), store_hits in zip(searchable, hits):
+            for position, score in store_hits:
+                chunk_id = store.index_to_docstore_id[position]
+                if chunk_id not in self.tombstones:
+                    candidates.append((score, chunk_id, store))
+        
+        candidates.sort(key=lambda candidate: -candidate[0])
+        results = []
+        for score, chunk_id, store in candidates:
+            doc = store.docstore.search(chunk_id)
+            if self._is_placeholder(doc):
+                continue
+            results.append((chunk_id, doc, score))
+            if len(results) == k:
+                break
+        return results
+    
+    def _hybrid_search(self, query: str, embedding: List[float], k: int,
+                       masks: Optional[List[np.ndarray]] = None) -> List[Tuple[str, Document, float]]:
+        """Dense and BM25 candidates fused by reciprocal rank; the score is the fused one"""
+        # A deeper pool than k lets a chunk ranked well by only one side still make it
+        pool = max(k * 4, 20)
+        dense = self._search(embedding, pool, masks)
+        lexical = self._lexical_search(query, pool, masks)
+        docs = {chunk_id: doc for chunk_id, doc, _ in dense + lexical}
+        fused = reciprocal_rank_fusion(
+            [[chunk_id for chunk_id, _, _ in dense], [chunk_id for chunk_id, _, _ in lexical]],
+            k=self.rrf_k
+        )
+        return [(chunk_id, docs[chunk_id], 0.0) for chunk_id in fused[:k]]
+    
+    def _get_chunk(self, chunk_id: str) -> Optional[Document]:
+        for store in self._stores():
+            doc = store.docstore.search(chunk_id)
+            if isinstance(doc, Document):
+                return doc
+        return None
+    
+    def embed_query(self, query: str) -> List[float]:
+        """Query embedding, served from the normalized-query cache when possible"""
+        query_key = normalize_query(query)
+        embedding = self.query_embedding_cache.get(query_key)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+            self.query_embedding_cache.set(query_key, embedding)
+        return embedding
+    
+    def retrieve_with_ids(self, query: str, k: int = 3, mode: Optional[str] = None,
+                          filters: Optional[dict] = None) -> Tuple[List[float], List[Tuple[str, Document]]]:
+        """
+        Query embedding plus the top-k (chunk_id, document) pairs; mode is 'dense' or 'hybrid'.
+        
+        filters restricts the candidates by metadata, e.g. {"document_type": "faq",
+        "source": [...], "date_from": "2024-01-01", "date_to": "2024-06-30"}.
+        """
+        mode = mode or self.retrieval_mode
+        filters = normalize_filters(filters)
+        embedding = self.embed_query(query)
+        embedding_key = hashlib.sha1(np.asarray(embedding, dtype=np.float32).tobytes()).hexdigest()
+        # Lexical hits depend on the words themselves, not just the embedding
+        query_key = normalize_query(query) if mode == "hybrid" else None
+        with self.lock.read():
+            result_key = (embedding_key, query_key, k, mode, filters, self.index_version)
+            chunk_ids = self.retrieval_cache.get(result_key)
+            if chunk_ids is not None:
+                return embedding, [(chunk_id, self._get_chunk(chunk_id)) for chunk_id in chunk_ids]
             
-            return docs
+            masks = self._filter_masks(filters)
+            if mode == "hybrid":
+                results = self._hybrid_search(query, embedding, k, masks)
+            else:
+                results = self._search(embedding, k, masks)
+            self.retrieval_cache.set(result_key, [chunk_id for chunk_id, _, _ in results])
+        return embedding, [(chunk_id, doc) for chunk_id, doc, _ in results]
+    
+    def retrieve(self, query: str, k: int = 3, mode: Optional[str] = None,
+                 filters: Optional[dict] = None) -> List[Document]:
+        """Retrieve relevant documents for a query, optionally restricted by metadata filters"""
+        try:
+            _, results = self.retrieve_with_ids(query, k, mode, filters)
+            return [doc for _, doc in results]
         except Exception as e:
             print(f"Error in retrieval: {e}")
             return []
     
-    def update_knowledge_base(self, documents: List[dict]):
-        """Update knowledge base with new documents"""
+    @staticmethod
+    def _is_placeholder(doc: Document) -> bool:
+        return doc.metadata.get('source') == "system" and doc.metadata.get('title') == "Placeholder"
+    
+    @staticmethod
+    def build_documents(documents: List[dict]) -> List[Document]:
+        """Turn knowledge dicts into LangChain documents with index metadata"""
         docs = []
         from datetime import datetime
         
         for doc in documents:
+            metadata = {
+                "source": doc.get("source", "unknown"),
+                "title": doc.get("title", "Untitled"),
+                "added_at": doc.get("added_at", datetime.now().isoformat()),
+                "type": doc.get("type", "article")
+            }
+            if doc.get("id") is not None:
+                metadata["document_id"] = doc["id"]
             docs.append(Document(
                 page_content=doc.get("content", ""),
-                metadata={
-                    "source": doc.get("source", "unknown"),
-                    "title": doc.get("title", "Untitled"),
-                    "added_at": doc.get("added_at", datetime.now().isoformat()),
-                    "type": doc.get("type", "article")
-                }
+                metadata=metadata
             ))
-        
-        self.add_documents(docs)
+        return docs
+    
+    def update_knowledge_base(self, documents: List[dict]):
+        """Update knowledge base with new documents"""
+        self.add_documents(self.build_documents(documents))
     
     def get_stats(self):
         """Get statistics about the knowledge base"""
         if not self.vector_store:
             return {"total_documents": 0}
         
-        return {
-            "total_documents": self.vector_store.index.ntotal,
-            "dimension": self.vector_store.index.d if hasattr(self.vector_store.index, 'd') else None,
-        }
\ No newline at end of file
+        with self.lock.read():
+            index_params = describe_index(self.vector_store.index)
+            return {
+                "total_documents": self._total_vectors(),
+                "dimension": self.vector_store.index.d if hasattr(self.vector_store.index, 'd') else None,
+                "index_type": index_params.pop("index_type"),
+                "index_params": dict(index_params, trained_on=self._base_meta().get("trained_on")),
+                "index_generation": self.manifest["generation"] if self.manifest else None,
+                "index_base": self.manifest["base"] if self.manifest else None,
+                "delta_segments": len(self.manifest["deltas"]) if self.manifest else 0,
+                "delta_vectors": self.delta_store.index.ntotal if self.delta_store else 0,
+                "retrieval_mode": self.retrieval_mode,
+                "write_ahead_log": self.wal.stats(self._applied_seq()) if self.manifest else None,
+                "tombstoned_chunks": len(self.tombstones),
+                "indexed_documents": len(self.document_chunks),
+                "embedding_cache": self.embedding_cache.stats() if self.embedding_cache else None,
+                "index_version": self.index_version,
+                "query_embedding_cache": self.query_embedding_cache.stats(),
+                "retrieval_cache": self.retrieval_cache.stats(),
+            }
+
+# One warm pipeline per worker process, shared by every request thread
+_pipeline = None
+_pipeline_error = None
+_pipeline_lock = threading.Lock()
+
+def get_rag_pipeline() -> RAGPipeline:
+    """Return the process-wide pipeline, loading it on first use"""
+    global _pipeline, _pipeline_error
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                try:
+                    from django.conf import settings
+                    _pipeline = RAGPipeline(read_only=getattr(settings, 'RAG_INDEX_READ_ONLY', False))
+                    _pipeline.start_watcher(getattr(settings, 'RAG_INDEX_POLL_INTERVAL', 5))
+                    _pipeline_error = None
+                except Exception as e:
+                    _pipeline_error = str(e)
+                    raise
+    return _pipeline
+
+def warm_up_rag_pipeline():
+    """Load the shared pipeline in a background thread"""
+    def _load():
+        try:
+            get_rag_pipeline()
+        except Exception as e:
+            print(f"Error warming up RAG pipeline: {e}")
+    
+    if _pipeline is None and not _pipeline_lock.locked():
+        threading.Thread(target=_load, name="rag-warmup", daemon=True).start()
+
+def warm_up_on_startup():
+    """
+    Warm up if RAG_WARMUP_ON_STARTUP is set. Called from the WSGI/ASGI
+    entrypoints and Celery pool processes rather than AppConfig.ready(), so
+    migrate, shell and the prefork parent never load the model.
+    """
+    from django.conf import settings
+    if getattr(settings, 'RAG_WARMUP_ON_STARTUP', False):
+        warm_up_rag_pipeline()
+
+def rag_pipeline_status() -> dict:
+    """Readiness of the shared pipeline in this process"""
+    return {
+        "ready": _pipeline is not None,
+        "loading": _pipeline is None and _pipeline_lock.locked(),
+        "error": _pipeline_error,
+    }
\ No newline at end of file
@@ -0,0 +1,169 @@
+import time
+from datetime import timedelta
+from typing import Callable, List, Optional
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import ArchivedSession, ChatSession, Message, RetentionCheckpoint, UserRetention
+
+# Each tier is purged from the hot tables and from the archive, with a checkpoint per (prefix, tier)
+TARGETS = (('', ChatSession), ('archive:', ArchivedSession))
+
+def retention_tiers() -> List[dict]:
+    """
+    Disjoint groups of sessions sharing one retention period, as
+    {name, sessions (a Q over ChatSession), days}.
+
+    A UserRetention row wins over plans; a plan is an auth group named in
+    CHAT_RETENTION_PLAN_DAYS, and a user on several plans gets the longest.
+    Everyone else gets CHAT_RETENTION_DAYS. A period of 0 (or an empty
+    override) keeps sessions forever, so it has no tier at all.
+    """
+    User = get_user_model()
+    tiers = []
+    overrides = UserRetention.objects.all()
+    for days in overrides.exclude(days=None).exclude(days=0).order_by('days').values_list('days', flat=True).distinct():
+        tiers.append({
+            'name': f"user:{days}d",
+            'sessions': Q(user__in=overrides.filter(days=days).values('user')),
+            'days': days,
+        })
+
+    # Longest plans first, so each later plan only covers users not already claimed by a longer one
+    claimed = Q(user__in=overrides.values('user'))
+    plans = getattr(settings, 'CHAT_RETENTION_PLAN_DAYS', {})
+    for plan, days in sorted(plans.items(), key=lambda item: item[1] or float('inf'), reverse=True):
+        members = Q(user__in=User.objects.filter(groups__name=plan).values('id'))
+        if days:
+            tiers.append({'name': f"plan:{plan}", 'sessions': members & ~claimed, 'days': days})
+        claimed |= members
+
+    default_days = getattr(settings, 'CHAT_RETENTION_DAYS', 365)
+    if default_days:
+        tiers.append({'name': 'default', 'sessions': ~claimed, 'days': default_days})
+    return tiers
+
+def next_batch(sessions, after_id: int, batch_size: int, batch_messages: int) -> List[int]:
+    """Ids of the next sessions after after_id, stopping early once their messages fill batch_messages"""
+    ids, messages = [], 0
+    rows = sessions.filter(id__gt=after_id).order_by('id').values_list('id', 'message_count')[:batch_size]
+    for session_id, message_count in rows:
+        if ids and messages + message_count > batch_messages:
+            break
+        ids.append(session_id)
+        messages += message_count
+    return ids
+
+class RetentionEngine:
+    """
+    Deletes whole chat sessions, live or archived, whose last activity is
+    older than their owner's retention period.
+
+    Each tier is walked in session id order, a batch at a time: a batch is
+    re-checked under row locks and deleted with its messages in its own
+    transaction, together with a checkpoint of the last id scanned. Memory
+    and lock time are bounded by the batch, the pause between batches keeps
+    the database responsive for chat traffic, and a run that hits its time
+    budget is resumed from the checkpoints by the next one.
+    """
+
+    def __init__(self, batch_size: int = 500, batch_messages: int = 20000, pause: float = 0.05,
+                 max_seconds: float = 0, progress: Optional[Callable[[dict], None]] = None):
+        self.batch_size = batch_size
+        self.batch_messages = batch_messages
+        self.pause = pause
+        self.max_seconds = max_seconds
+        self.progress = progress
+
+    @classmethod
+    def from_settings(cls, **overrides) -> "RetentionEngine":
+        options = {
+            'batch_size': getattr(settings, 'CHAT_RETENTION_BATCH_SIZE', 500),
+            'batch_messages': getattr(settings, 'CHAT_RETENTION_BATCH_MESSAGES', 20000),
+            'pause': getattr(settings, 'CHAT_RETENTION_BATCH_PAUSE', 0.05),
+            'max_seconds': getattr(settings, 'CHAT_RETENTION_MAX_SECONDS', 300),
+        }
+        options.update(overrides)
+        return cls(**options)
+
+    @staticmethod
+    def reset_checkpoints():
+        RetentionCheckpoint.objects.all().delete()
+
+    def run(self) -> dict:
+        started = time.monotonic()
+        deadline = started + self.max_seconds if self.max_seconds else None
+        totals = {'deleted_sessions': 0, 'deleted_messages': 0, 'deleted_archives': 0, 'batches': 0}
+        tiers = {}
+        complete = True
+        for tier in retention_tiers():
+            for prefix, model in TARGETS:
+                result = self._purge_tier(tier, model, prefix + tier['name'], deadline, totals, started)
+                tiers[prefix + tier['name']] = result
+                if not result['complete']:
+                    complete = False
+                    break
+            if not complete:
+                break
+
+        elapsed = time.monotonic() - started
+        rows = totals['deleted_sessions'] + totals['deleted_messages'] + totals['deleted_archives']
+        return {
+            **totals,
+            'complete': complete,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(rows / elapsed, 1) if elapsed else 0.0,
+            'tiers': tiers,
+        }
+
+    def _purge_tier(self, tier: dict, model, name: str, deadline: Optional[float], totals: dict, started: float) -> dict:
+        cutoff = timezone.now() - timedelta(days=tier['days'])
+        checkpoint, _ = RetentionCheckpoint.objects.get_or_create(name=name)
+        expired = model.objects.filter(tier['sessions'], updated_at__lt=cutoff)
+        result = {'days': tier['days'], 'resumed_after': checkpoint.last_id,
+                  'deleted_sessions': 0, 'deleted_messages': 0, 'deleted_archives': 0, 'complete': False}
+
+        last_id = checkpoint.last_id
+        while True:
+            if deadline is not None and time.monotonic() >= deadline:
+                return result
+            candidates = next_batch(expired, last_id, self.batch_size, self.batch_messages)
+            if not candidates:
+                break
+            deleted = self._delete_batch(model, name, candidates, cutoff)
+            last_id = candidates[-1]
+
+            for key, count in deleted.items():
+                result[key] += count
+                totals[key] += count
+            totals['batches'] += 1
+            if self.progress:
+                elapsed = time.monotonic() - started
+                rows = totals['deleted_sessions'] + totals['deleted_messages'] + totals['deleted_archives']
+                self.progress({'tier': name, 'last_id': last_id, **totals, 'rows_per_second': rows / elapsed})
+            if self.pause:
+                time.sleep(self.pause)
+
+        # Pass finished: the next run starts over to catch sessions that have expired since
+        RetentionCheckpoint.objects.filter(name=name).update(last_id=0)
+        result['complete'] = True
+        return result
+
+    def _delete_batch(self, model, name: str, candidates: List[int], cutoff) -> dict:
+        """Delete the candidates still expired, and move the checkpoint past them, in one transaction"""
+        with transaction.atomic():
+            # A message that arrived since the batch was read makes its session active again
+            ids = list(
+                model.objects.select_for_update()
+                .filter(id__in=candidates, updated_at__lt=cutoff)
+                .values_list('id', flat=True)
+            )
+            deleted = model.objects.filter(id__in=ids).delete()[1] if ids else {}
+            RetentionCheckpoint.objects.filter(name=name).update(last_id=candidates[-1], updated_at=timezone.now())
+        return {
+            'deleted_sessions': deleted.get(ChatSession._meta.label, 0),
+            'deleted_messages': deleted.get(Message._meta.label, 0),
+            'deleted_archives': deleted.get(ArchivedSession._meta.label, 0),
+        }
\ No newline at end of file
@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from .models import ChatSession, Message
+from .chunk_filters import normalize_filters
+from .models import ArchivedSession, ChatJob, ChatSession, DailyStats, Message
 
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
@@ -8,33 +9,64 @@ class MessageSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
 class ChatSessionSerializer(serializers.ModelSerializer):
-    messages = MessageSerializer(many=True, read_only=True)
+    """Session summary without its messages (those come from /sessions/{id}/messages/)"""
     last_message = serializers.SerializerMethodField()
-    message_count = serializers.SerializerMethodField()
     
     class Meta:
         model = ChatSession
-        fields = ['id', 'title', 'created_at', 'updated_at', 'messages', 'last_message', 'message_count']
-        read_only_fields = ['id', 'created_at', 'updated_at']
+        fields = ['id', 'title', 'created_at', 'updated_at', 'last_message', 'message_count']
+        read_only_fields = ['id', 'created_at', 'updated_at', 'message_count']
     
     def get_last_message(self, obj):
-        last_msg = obj.messages.last()
-        if last_msg:
-            return {
-                'content': last_msg.content[:100] + '...' if len(last_msg.content) > 100 else last_msg.content,
-                'is_user': last_msg.is_user,
-                'created_at': last_msg.created_at
-            }
-        return None
+        # Denormalized on the session, so no per-row query
+        if obj.last_message_at is None:
+            return None
+        return {
+            'content': obj.last_message_preview,
+            'is_user': obj.last_message_is_user,
+            'created_at': obj.last_message_at
+        }
+
+class ArchivedSessionSerializer(serializers.ModelSerializer):
+    """An archived session in the same summary shape, under its original session id"""
+    id = serializers.IntegerField(source='session_id', read_only=True)
+    last_message = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = ArchivedSession
+        fields = ['id', 'title', 'created_at', 'updated_at', 'last_message', 'message_count', 'archived_at']
+        read_only_fields = fields
+    
+    get_last_message = ChatSessionSerializer.get_last_message
+
+class ChatJobSerializer(serializers.ModelSerializer):
+    user_message = MessageSerializer(read_only=True)
+    bot_response = MessageSerializer(source='bot_message', read_only=True)
     
-    def get_message_count(self, obj):
-        return obj.messages.count()
+    class Meta:
+        model = ChatJob
+        fields = ['id', 'status', 'chat_session_id', 'user_message', 'bot_response', 'error',
+                  'created_at', 'started_at', 'finished_at']
+        read_only_fields = fields
+
+class DailyStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DailyStats
+        exclude = ['id', 'llm_latency_histogram']
 
 class ChatRequestSerializer(serializers.Serializer):
     message = serializers.CharField(required=True, max_length=5000)
     chat_session_id = serializers.IntegerField(required=False, allow_null=True)
+    filters = serializers.DictField(required=False, allow_null=True)
     
     def validate_message(self, value):
         if not value.strip():
             raise serializers.ValidationError("Message cannot be empty.")
-        return value.strip()
\ No newline at end of file
+        return value.strip()
+    
+    def validate_filters(self, value):
+        try:
+            normalize_filters(value)
+        except (TypeError, ValueError) as e:
+            raise serializers.ValidationError(str(e))
+        return value
\ No newline at end of file
@@ -1,95 +1,302 @@
+import asyncio
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import aiohttp
 import openai
 from django.conf import settings
-from .rag_pipeline import RAGPipeline
+from .prompt_budget import PromptBuilder
+from .query_cache import SemanticResponseCache
+from .rag_pipeline import get_rag_pipeline
 
 openai.api_key = settings.OPENAI_API_KEY
 
+COMPLETION_PARAMS = {
+    'model': "gpt-3.5-turbo",
+    'temperature': 0.7,
+    'max_tokens': 1000,
+    'top_p': 0.9,
+    'frequency_penalty': 0.1,
+    'presence_penalty': 0.1,
+}
+
+SYSTEM_PROMPT_TEMPLATE = """You are a helpful AI assistant for a chatbot service. Use the following context to answer the user's question when relevant.
+
+        {context}
+
+        Guidelines:
+        1. If the context contains relevant information, use it to formulate your answer.
+        2. If the context doesn't contain relevant information, acknowledge this and provide a helpful answer based on your general knowledge.
+        3. When using information from the context, you can mention that it's based on available documentation.
+        4. Be concise, accurate, and helpful.
+        5. If the user asks about something outside the context, say you don't have specific information but try to help generally.
+        6. Format your responses in a readable way with paragraphs when appropriate."""
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache(rag_pipeline):
+    """Process-wide semantic answer cache, or None unless CHAT_RESPONSE_CACHE_ENABLED"""
+    global _response_cache
+    if not getattr(settings, 'CHAT_RESPONSE_CACHE_ENABLED', False):
+        return None
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                cache = SemanticResponseCache(
+                    maxsize=getattr(settings, 'CHAT_RESPONSE_CACHE_SIZE', 1024),
+                    ttl=getattr(settings, 'CHAT_RESPONSE_CACHE_TTL', 3600),
+                    threshold=getattr(settings, 'CHAT_RESPONSE_CACHE_THRESHOLD', 0.95)
+                )
+                # Forget answers grounded in a document as soon as it is re-indexed or removed
+                rag_pipeline.change_listeners.append(cache.invalidate_documents)
+                _response_cache = cache
+    return _response_cache
+
+_rag_executor = None
+_rag_executor_lock = threading.Lock()
+_openai_sessions = weakref.WeakKeyDictionary()
+
+def get_rag_executor():
+    """Bounded thread pool for embedding and FAISS work issued from async views"""
+    global _rag_executor
+    if _rag_executor is None:
+        with _rag_executor_lock:
+            if _rag_executor is None:
+                _rag_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'RAG_EXECUTOR_WORKERS', 4),
+                    thread_name_prefix='rag'
+                )
+    return _rag_executor
+
+def get_openai_session():
+    """Connection-pooled aiohttp session shared by every OpenAI call on this event loop"""
+    loop = asyncio.get_running_loop()
+    session = _openai_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=getattr(settings, 'OPENAI_MAX_CONNECTIONS', 200))
+        )
+        _openai_sessions[loop] = session
+    return session
+
+@asynccontextmanager
+async def openai_session(pooled=False):
+    """
+    aiohttp session for one OpenAI call.
+    
+    pooled reuses the loop's shared session, which only pays off under ASGI
+    where one event loop lives as long as the process. An async view served
+    by WSGI runs on a fresh loop per request, so it gets a session that is
+    closed with the call instead of one left open on a dead loop.
+    """
+    if pooled:
+        yield get_openai_session()
+        return
+    async with aiohttp.ClientSession() as session:
+        yield session
+
+SUMMARY_PARAMS = {
+    'model': COMPLETION_PARAMS['model'],
+    'temperature': 0.2,
+    'max_tokens': 300,
+}
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and an AI assistant.
+Update the summary with the new messages. Keep facts, names, numbers, decisions, open questions and the user's goals; drop pleasantries.
+Write at most a few short paragraphs in the third person, and return only the updated summary."""
+
+def summarize_conversation(summary, messages):
+    """Running summary extended with messages (oldest first); raises if the model call fails"""
+    per_message = getattr(settings, 'CHAT_SUMMARY_MESSAGE_MAX_CHARS', 1000)
+    transcript = "\n".join(
+        f"{'User' if msg.is_user else 'Assistant'}: {msg.content[:per_message]}" for msg in messages
+    )
+    response = openai.ChatCompletion.create(
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Current summary:\n{summary or '(none yet)'}\n\nNew messages:\n{transcript}"},
+        ],
+        **SUMMARY_PARAMS
+    )
+    return response.choices[0].message.content.strip()
+
 class ChatService:
-    def __init__(self):
-        self.rag_pipeline = RAGPipeline()
+    def __init__(self, rag_pipeline=None, retrieval_filters=None):
+        # Reuse the warm per-process pipeline instead of reloading the model
+        self.rag_pipeline = rag_pipeline or get_rag_pipeline()
+        # Metadata scope for this conversation's retrieval, e.g. {'document_type': 'faq'}
+        self.retrieval_filters = retrieval_filters
+        self.response_cache = get_response_cache(self.rag_pipeline)
     
-    def generate_response(self, user_query, chat_history=None):
+    def generate_response(self, user_query, chat_history=None, summary=''):
         """
         Generate response using RAG pipeline
         """
-        # Retrieve relevant documents
-        retrieved_docs = self.rag_pipeline.retrieve(user_query)
-        
-        # Format context from retrieved documents
-        context = self._format_context(retrieved_docs)
+        turn = self._prepare_turn(user_query, chat_history, summary)
         
-        # Prepare messages for OpenAI
-        messages = self._prepare_messages(user_query, context, chat_history)
+        response = turn['cached_answer']
+        if response is None:
+            # Generate response
+            started = time.monotonic()
+            response, succeeded = self._call_openai(turn['messages'])
+            turn['llm_latency_ms'] = round((time.monotonic() - started) * 1000)
+            if succeeded:
+                self._remember_answer(turn, response)
         
-        # Generate response
-        response = self._call_openai(messages)
+        return response, self._build_metadata(turn)
+    
+    async def agenerate_response(self, user_query, chat_history=None, summary='', pooled_session=False):
+        """
+        Async generate_response: retrieval runs on the bounded RAG executor and the
+        model call goes through aiohttp, so the event loop is never blocked.
+        pooled_session shares the loop's connection pool (ASGI only, see openai_session)
+        """
+        loop = asyncio.get_running_loop()
+        turn = await loop.run_in_executor(get_rag_executor(), self._prepare_turn, user_query, chat_history, summary)
         
-        # Extract and store metadata
-        metadata = {
-            'retrieved_docs': [{'content': doc.page_content[:200] + '...', **doc.metadata} for doc in retrieved_docs],
-            'context_used': bool(retrieved_docs),
-            'model': 'gpt-3.5-turbo',
-        }
+        response = turn['cached_answer']
+        if response is None:
+            started = time.monotonic()
+            response, succeeded = await self._acall_openai(turn['messages'], pooled_session)
+            turn['llm_latency_ms'] = round((time.monotonic() - started) * 1000)
+            if succeeded:
+                self._remember_answer(turn, response)
         
-        return response, metadata
+        return response, self._build_metadata(turn)
     
-    def _format_context(self, retrieved_docs):
-        """Format retrieved documents into context string"""
-        if not retrieved_docs:
-            return "No relevant documents found in the knowledge base."
+    def stream_response(self, user_query, chat_history=None, summary=''):
+        """
+        Generate a response token by token.
+        
+        Yields ('metadata', dict) once retrieval is done, then ('token', str) as the
+        model produces text, and finally ('done', full_text). Closing the generator
+        closes the OpenAI stream, which cancels generation.
+        """
+        turn = self._prepare_turn(user_query, chat_history, summary)
+        metadata = self._build_metadata(turn)
+        yield 'metadata', metadata
         
-        context_parts = ["Relevant information from knowledge base:"]
-        for i, doc in enumerate(retrieved_docs, 1):
-            source = doc.metadata.get('source', 'Unknown')
-            title = doc.metadata.get('title', 'Untitled')
-            content = doc.page_content[:500]  # Limit context length
-            context_parts.append(f"[Document {i} - {title} ({source})]:\n{content}")
+        if turn['cached_answer'] is not None:
+            yield 'token', turn['cached_answer']
+            yield 'done', turn['cached_answer']
+            return
         
-        return "\n\n".join(context_parts)
-    
-    def _prepare_messages(self, user_query, context, chat_history=None):
-        """Prepare messages for OpenAI API"""
-        system_prompt = f"""You are a helpful AI assistant for a chatbot service. Use the following context to answer the user's question when relevant.
-
-        {context}
-
-        Guidelines:
-        1. If the context contains relevant information, use it to formulate your answer.
-        2. If the context doesn't contain relevant information, acknowledge this and provide a helpful answer based on your general knowledge.
-        3. When using information from the context, you can mention that it's based on available documentation.
-        4. Be concise, accurate, and helpful.
-        5. If the user asks about something outside the context, say you don't have specific information but try to help generally.
-        6. Format your responses in a readable way with paragraphs when appropriate."""
+        parts = []
+        stream = None
+        started = time.monotonic()
+        try:
+            stream = openai.ChatCompletion.create(messages=turn['messages'], stream=True, **COMPLETION_PARAMS)
+            for chunk in stream:
+                token = chunk.choices[0].delta.get('content')
+                if token:
+                    parts.append(token)
+                    yield 'token', token
+        except Exception as e:
+            error_reply = self._error_reply(e)
+            parts.append(error_reply)
+            yield 'token', error_reply
+            yield 'done', "".join(parts).strip()
+            return
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
         
-        messages = [{"role": "system", "content": system_prompt}]
+        response = "".join(parts).strip()
+        self._remember_answer(turn, response)
+        # Completed after the metadata event went out; callers save this same dict with the answer
+        metadata['llm_latency_ms'] = round((time.monotonic() - started) * 1000)
+        yield 'done', response
+    
+    def _prepare_turn(self, user_query, chat_history, summary=''):
+        """Retrieval, response-cache lookup and prompt assembly shared by every response path"""
+        # Retrieve relevant documents
+        embedding, retrieved = self._retrieve(user_query)
+        retrieved_docs = [doc for _, doc in retrieved]
+        chunk_ids = [chunk_id for chunk_id, _ in retrieved]
         
-        # Add chat history if available
-        if chat_history:
-            for msg in chat_history:
-                role = "user" if msg.is_user else "assistant"
-                messages.append({"role": role, "content": msg.content})
+        # Follow-ups depend on the conversation, so only standalone questions use the cache
+        response_cache = self.response_cache if embedding is not None and not chat_history and not summary else None
+        cached_answer = response_cache.get(embedding, chunk_ids) if response_cache else None
         
-        # Add current query
-        messages.append({"role": "user", "content": user_query})
+        messages = token_usage = None
+        if cached_answer is None:
+            # Fit instructions, context and history into the prompt token budget
+            messages, token_usage = self._prepare_messages(user_query, retrieved_docs, chat_history, summary)
         
-        return messages
+        return {
+            'embedding': embedding,
+            'chunk_ids': chunk_ids,
+            'retrieved_docs': retrieved_docs,
+            'response_cache': response_cache,
+            'cached_answer': cached_answer,
+            'messages': messages,
+            'token_usage': token_usage,
+            'llm_latency_ms': None,
+        }
+    
+    def _remember_answer(self, turn, response):
+        if turn['response_cache'] and response:
+            document_ids = {
+                doc.metadata['document_id'] for doc in turn['retrieved_docs'] if 'document_id' in doc.metadata
+            }
+            turn['response_cache'].set(turn['embedding'], turn['chunk_ids'], response, document_ids)
+    
+    def _build_metadata(self, turn):
+        """Extract metadata stored on the bot message"""
+        retrieved_docs = turn['retrieved_docs']
+        return {
+            'retrieved_docs': [{'content': doc.page_content[:200] + '...', **doc.metadata} for doc in retrieved_docs],
+            'context_used': bool(retrieved_docs),
+            'model': COMPLETION_PARAMS['model'],
+            'cached_response': turn['cached_answer'] is not None,
+            'token_usage': turn['token_usage'],
+            'llm_latency_ms': turn['llm_latency_ms'],
+            **({'retrieval_filters': self.retrieval_filters} if self.retrieval_filters else {}),
+        }
+    
+    def _retrieve(self, user_query):
+        """Query embedding and (chunk_id, document) pairs; empty on retrieval errors"""
+        try:
+            return self.rag_pipeline.retrieve_with_ids(user_query, filters=self.retrieval_filters)
+        except Exception as e:
+            print(f"Error in retrieval: {e}")
+            return None, []
+    
+    def _prepare_messages(self, user_query, retrieved_docs, chat_history=None, summary=''):
+        """Prepare messages for OpenAI API within the prompt token budget; returns (messages, token_usage)"""
+        builder = PromptBuilder(
+            COMPLETION_PARAMS['model'],
+            budget=getattr(settings, 'CHAT_PROMPT_TOKEN_BUDGET', 3000),
+            chunk_max_tokens=getattr(settings, 'CHAT_CONTEXT_CHUNK_MAX_TOKENS', 300)
+        )
+        return builder.build(SYSTEM_PROMPT_TEMPLATE, retrieved_docs, chat_history, user_query, summary)
     
     def _call_openai(self, messages):
-        """Call OpenAI API"""
+        """Call OpenAI API; returns (text, succeeded)"""
+        try:
+            response = openai.ChatCompletion.create(messages=messages, **COMPLETION_PARAMS)
+            return response.choices[0].message.content.strip(), True
+        except Exception as e:
+            return self._error_reply(e), False
+    
+    async def _acall_openai(self, messages, pooled_session=False):
+        """Async OpenAI call; returns (text, succeeded)"""
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                temperature=0.7,
-                max_tokens=1000,
-                top_p=0.9,
-                frequency_penalty=0.1,
-                presence_penalty=0.1
-            )
-            return response.choices[0].message.content.strip()
-        except openai.error.RateLimitError:
+            async with openai_session(pooled_session) as session:
+                openai.aiosession.set(session)
+                response = await openai.ChatCompletion.acreate(messages=messages, **COMPLETION_PARAMS)
+            return response.choices[0].message.content.strip(), True
+        except Exception as e:
+            return self._error_reply(e), False
+    
+    @staticmethod
+    def _error_reply(e):
+        """User-facing text for a failed OpenAI call"""
+        if isinstance(e, openai.error.RateLimitError):
             return "I'm currently experiencing high demand. Please try again in a moment."
-        except openai.error.AuthenticationError:
+        if isinstance(e, openai.error.AuthenticationError):
             return "Authentication error with AI service. Please contact support."
-        except Exception as e:
-            return f"I apologize, but I encountered an error: {str(e)[:100]}"
\ No newline at end of file
+        return f"I apologize, but I encountered an error: {str(e)[:100]}"
\ No newline at end of file
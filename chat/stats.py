@@ -0,0 +1,151 @@
+import math
+from collections import Counter, defaultdict
+from datetime import timedelta
+from typing import Dict, Iterable
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import ChatSession, DailyActiveUser, DailyStats, Message, StatsWatermark
+
+# Latency buckets grow by 10%, so a percentile read from the histogram is within 10% of the true value
+LATENCY_GROWTH = 1.1
+PERCENTILES = {'llm_latency_p50_ms': 0.5, 'llm_latency_p95_ms': 0.95, 'llm_latency_p99_ms': 0.99}
+
+def latency_bucket(ms: float) -> int:
+    return max(0, math.ceil(math.log(max(ms, 1), LATENCY_GROWTH)))
+
+def latency_percentiles(histogram: Dict[str, int]) -> Dict[str, int]:
+    """PERCENTILES read off a {bucket: count} histogram, each as its bucket's upper bound in ms"""
+    buckets = sorted((int(bucket), count) for bucket, count in histogram.items())
+    total = sum(count for _, count in buckets)
+    if not total:
+        return {field: None for field in PERCENTILES}
+    result = {}
+    for field, quantile in PERCENTILES.items():
+        rank, seen = math.ceil(quantile * total), 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                result[field] = round(LATENCY_GROWTH ** bucket)
+                break
+    return result
+
+class StatsRollup:
+    """
+    Folds users, sessions and messages created since their watermarks into
+    DailyStats, a batch per transaction.
+
+    Each source is read in id order from its watermark, so a run costs what
+    arrived since the last one, not the size of the tables. Rows younger
+    than settle_seconds are left for the next run: their ids may still have
+    lower-id neighbours in transactions that have not committed yet.
+    """
+    SOURCES = ('users', 'sessions', 'messages')
+
+    def __init__(self, batch_size: int = 5000, settle_seconds: float = 60):
+        self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+
+    @classmethod
+    def from_settings(cls) -> "StatsRollup":
+        return cls(
+            batch_size=getattr(settings, 'CHAT_STATS_BATCH_SIZE', 5000),
+            settle_seconds=getattr(settings, 'CHAT_STATS_SETTLE_SECONDS', 60),
+        )
+
+    def _rows(self, source: str):
+        """Rows of one source as dicts with id and 'at' (creation time), plus what its fold needs"""
+        if source == 'users':
+            return get_user_model().objects.values('id', at=F('date_joined'))
+        if source == 'sessions':
+            return ChatSession.objects.values('id', at=F('created_at'))
+        return Message.objects.values(
+            'id', 'is_user', 'metadata__cached_response', 'metadata__llm_latency_ms',
+            at=F('created_at'), user=F('chat_session__user_id')
+        )
+
+    def run(self) -> dict:
+        bound = timezone.now() - timedelta(seconds=self.settle_seconds)
+        result = {}
+        for source in self.SOURCES:
+            StatsWatermark.objects.get_or_create(name=source)
+            rows = batches = 0
+            while True:
+                folded, more = self._fold_batch(source, bound)
+                rows += folded
+                batches += bool(folded)
+                if not more:
+                    break
+            result[f"{source}_rolled_up"] = rows
+            result[f"{source}_batches"] = batches
+
+        # Days before yesterday get no more messages, so their active users are final
+        pruned, _ = DailyActiveUser.objects.filter(date__lt=timezone.localdate() - timedelta(days=1)).delete()
+        result['pruned_active_users'] = pruned
+        return result
+
+    def _fold_batch(self, source: str, bound) -> tuple:
+        """Fold one batch past the watermark; returns (rows folded, whether more may be waiting)"""
+        with transaction.atomic():
+            # The row lock also keeps two concurrent rollups from folding the same rows
+            watermark = StatsWatermark.objects.select_for_update().get(name=source)
+            rows = list(self._rows(source).filter(id__gt=watermark.last_id).order_by('id')[:self.batch_size])
+            settled = []
+            for row in rows:
+                if row['at'] >= bound:
+                    break
+                settled.append(row)
+            if not settled:
+                return 0, False
+
+            self._apply(self._deltas(source, settled))
+            watermark.last_id = settled[-1]['id']
+            watermark.save(update_fields=['last_id', 'updated_at'])
+        return len(settled), len(settled) == len(rows) == self.batch_size
+
+    @staticmethod
+    def _deltas(source: str, rows: Iterable[dict]) -> dict:
+        """Per-day counter increments, latency buckets and active users of a batch"""
+        days = defaultdict(lambda: {'counts': Counter(), 'latency': Counter(), 'users': set()})
+        for row in rows:
+            day = days[timezone.localdate(row['at'])]
+            if source == 'users':
+                day['counts']['new_users'] += 1
+            elif source == 'sessions':
+                day['counts']['new_sessions'] += 1
+            else:
+                day['counts']['messages'] += 1
+                if row['is_user']:
+                    day['counts']['user_messages'] += 1
+                    day['users'].add(row['user'])
+                    continue
+                day['counts']['bot_messages'] += 1
+                if row['metadata__cached_response']:
+                    day['counts']['cache_hits'] += 1
+                latency = row['metadata__llm_latency_ms']
+                if latency is not None:
+                    day['counts']['llm_calls'] += 1
+                    day['latency'][str(latency_bucket(latency))] += 1
+        return days
+
+    @staticmethod
+    def _apply(days: dict):
+        for date, delta in days.items():
+            stats, _ = DailyStats.objects.select_for_update().get_or_create(date=date)
+            for field, count in delta['counts'].items():
+                setattr(stats, field, getattr(stats, field) + count)
+            if delta['latency']:
+                histogram = Counter(stats.llm_latency_histogram)
+                histogram.update(delta['latency'])
+                stats.llm_latency_histogram = dict(histogram)
+                for field, value in latency_percentiles(stats.llm_latency_histogram).items():
+                    setattr(stats, field, value)
+            if delta['users']:
+                DailyActiveUser.objects.bulk_create(
+                    [DailyActiveUser(date=date, user_id=user_id) for user_id in delta['users']],
+                    ignore_conflicts=True
+                )
+                stats.active_users = DailyActiveUser.objects.filter(date=date).count()
+            stats.save()
\ No newline at end of file
@@ -3,35 +3,32 @@ from datetime import timedelta
 from django.utils import timezone
 from django.core.mail import send_mail
 from django.conf import settings
-from .models import ChatSession, Message
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+from .models import ChatJob, ChatSession, DailyStats
+from .rag_pipeline import get_rag_pipeline
+from .archive import SessionArchiver
+from .retention import RetentionEngine
+from .services import ChatService, summarize_conversation
+from .stats import StatsRollup
 
 @shared_task
 def cleanup_old_chats():
     """
-    Delete chat sessions older than 30 days
+    Delete chat sessions idle past their owner's retention period, in batches (see chat.retention)
     """
-    thirty_days_ago = timezone.now() - timedelta(days=30)
-    
     try:
-        # Delete messages first (due to foreign key constraints)
-        old_messages = Message.objects.filter(
-            created_at__lt=thirty_days_ago
-        )
-        message_count = old_messages.count()
-        old_messages.delete()
+        result = RetentionEngine.from_settings().run()
         
-        # Delete old chat sessions (those with no messages or all messages deleted)
-        old_sessions = ChatSession.objects.filter(
-            updated_at__lt=thirty_days_ago
-        )
-        session_count = old_sessions.count()
-        old_sessions.delete()
+        # Out of time budget: carry on from the checkpoints in a fresh run
+        if not result['complete']:
+            cleanup_old_chats.delay()
         
         return {
             'task': 'cleanup_old_chats',
             'status': 'success',
-            'deleted_sessions': session_count,
-            'deleted_messages': message_count,
+            **result,
             'timestamp': timezone.now().isoformat()
         }
     except Exception as e:
@@ -42,28 +39,93 @@ def cleanup_old_chats():
             'timestamp': timezone.now().isoformat()
         }
 
+@shared_task
+def archive_idle_chats():
+    """
+    Move sessions idle past CHAT_ARCHIVE_AFTER_DAYS into compressed ArchivedSession rows
+    """
+    try:
+        result = SessionArchiver.from_settings().run()
+        
+        # Out of time budget: the rest are picked up by a fresh run
+        if not result['complete']:
+            archive_idle_chats.delay()
+        
+        return {
+            'task': 'archive_idle_chats',
+            'status': 'success',
+            **result,
+            'timestamp': timezone.now().isoformat()
+        }
+    except Exception as e:
+        return {
+            'task': 'archive_idle_chats',
+            'status': 'error',
+            'error': str(e),
+            'timestamp': timezone.now().isoformat()
+        }
+
+@shared_task
+def roll_up_daily_stats():
+    """
+    Fold users, sessions and messages created since the last run into DailyStats
+    """
+    try:
+        result = StatsRollup.from_settings().run()
+        return {
+            'task': 'roll_up_daily_stats',
+            'status': 'success',
+            **result,
+            'timestamp': timezone.now().isoformat()
+        }
+    except Exception as e:
+        return {
+            'task': 'roll_up_daily_stats',
+            'status': 'error',
+            'error': str(e),
+            'timestamp': timezone.now().isoformat()
+        }
+
 @shared_task
 def send_daily_stats():
     """
-    Send daily statistics email to admin
+    Send yesterday's statistics from the DailyStats rollup to admin
     """
     try:
-        # Calculate statistics
-        total_users = settings.AUTH_USER_MODEL.objects.count()
-        total_sessions = ChatSession.objects.count()
-        total_messages = Message.objects.count()
-        active_sessions_today = ChatSession.objects.filter(
-            updated_at__gte=timezone.now() - timedelta(days=1)
-        ).count()
-        
-        subject = 'Daily Chatbot Statistics'
+        # Catch the rollup up first; the report itself only reads a handful of rollup rows
+        StatsRollup.from_settings().run()
+        day = timezone.localdate() - timedelta(days=1)
+        stats = DailyStats.objects.filter(date=day).first() or DailyStats(date=day)
+        week = DailyStats.objects.filter(date__gt=day - timedelta(days=7), date__lte=day).aggregate(
+            messages=Coalesce(Sum('messages'), 0),
+            new_sessions=Coalesce(Sum('new_sessions'), 0),
+            new_users=Coalesce(Sum('new_users'), 0),
+            cache_hits=Coalesce(Sum('cache_hits'), 0),
+            bot_messages=Coalesce(Sum('bot_messages'), 0),
+        )
+        
+        def hit_rate(hits, answers):
+            return f"{hits / answers:.1%}" if answers else "n/a"
+        
+        def ms(value):
+            return f"{value} ms" if value is not None else "n/a"
+        
+        subject = f'Daily Chatbot Statistics - {day.isoformat()}'
         message = f"""
-        Daily Statistics Report:
+        Daily Statistics Report for {day.isoformat()}:
+        
+        New Users: {stats.new_users}
+        New Chat Sessions: {stats.new_sessions}
+        Messages: {stats.messages} ({stats.user_messages} from users, {stats.bot_messages} answers)
+        Active Users: {stats.active_users}
+        Cache Hits: {stats.cache_hits} ({hit_rate(stats.cache_hits, stats.bot_messages)} of answers)
+        LLM Latency: p50 {ms(stats.llm_latency_p50_ms)}, p95 {ms(stats.llm_latency_p95_ms)}, p99 {ms(stats.llm_latency_p99_ms)} over {stats.llm_calls} calls
         
-        Total Users: {total_users}
-        Total Chat Sessions: {total_sessions}
-        Total Messages: {total_messages}
-        Active Sessions (Last 24h): {active_sessions_today}
+        Last 7 Days:
+        New Users: {week['new_users']}
+        New Chat Sessions: {week['new_sessions']}
+        Messages: {week['messages']}
+        Cache Hits: {week['cache_hits']} ({hit_rate(week['cache_hits'], week['bot_messages'])} of answers)
         
         Report generated at: {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}
         """
@@ -79,6 +141,7 @@ def send_daily_stats():
         return {
             'task': 'send_daily_stats',
             'status': 'success',
+            'date': day.isoformat(),
             'timestamp': timezone.now().isoformat()
         }
     except Exception as e:
@@ -87,4 +150,222 @@ def send_daily_stats():
             'status': 'error',
             'error': str(e),
             'timestamp': timezone.now().isoformat()
+        }
+
+@shared_task
+def compact_knowledge_index():
+    """
+    Merge FAISS delta segments back into the base index
+    """
+    try:
+        result = get_rag_pipeline().compact(
+            min_deltas=getattr(settings, 'RAG_COMPACTION_MIN_DELTAS', 1)
+        )
+        return {
+            'task': 'compact_knowledge_index',
+            'status': 'success',
+            **result,
+            'timestamp': timezone.now().isoformat()
+        }
+    except Exception as e:
+        return {
+            'task': 'compact_knowledge_index',
+            'status': 'error',
+            'error': str(e),
+            'timestamp': timezone.now().isoformat()
+        }
+
+@shared_task
+def retrain_knowledge_index(force=False):
+    """
+    Retrain the IVF coarse quantizer once the corpus has grown or shrunk past RAG_ANN_RETRAIN_GROWTH
+    """
+    try:
+        result = get_rag_pipeline().retrain(force=force)
+        return {
+            'task': 'retrain_knowledge_index',
+            'status': 'success',
+            **result,
+            'timestamp': timezone.now().isoformat()
+        }
+    except Exception as e:
+        return {
+            'task': 'retrain_knowledge_index',
+            'status': 'error',
+            'error': str(e),
+            'timestamp': timezone.now().isoformat()
+        }
+
+@shared_task
+def replay_knowledge_index_log():
+    """
+    Apply index operations logged but never applied, e.g. by a writer that crashed mid-way
+    """
+    try:
+        result = get_rag_pipeline().recover()
+        return {
+            'task': 'replay_knowledge_index_log',
+            'status': 'success',
+            **result,
+            'timestamp': timezone.now().isoformat()
+        }
+    except Exception as e:
+        return {
+            'task': 'replay_knowledge_index_log',
+            'status': 'error',
+            'error': str(e),
+            'timestamp': timezone.now().isoformat()
+        }
+
+@shared_task
+def update_conversation_summary(chat_session_id):
+    """
+    Fold turns that have aged out of the raw history window into the session's running summary
+    """
+    keep = 2 * getattr(settings, 'CHAT_RECENT_TURNS', 2)
+    batch_size = getattr(settings, 'CHAT_SUMMARY_BATCH_MESSAGES', 12)
+    try:
+        chat_session = ChatSession.objects.get(id=chat_session_id)
+        messages = list(
+            chat_session.messages.filter(id__gt=chat_session.summary_through_id).order_by('created_at', 'id')
+        )
+        to_fold = messages[:max(len(messages) - keep, 0)][:batch_size]
+        summarized = 0
+        if to_fold:
+            summary = summarize_conversation(chat_session.summary, to_fold)
+            # A concurrent run may have moved the summary on meanwhile; then this one is stale
+            summarized = ChatSession.objects.filter(
+                id=chat_session.id, summary_through_id=chat_session.summary_through_id
+            ).update(
+                summary=summary,
+                summary_through_id=to_fold[-1].id,
+                summary_updated_at=timezone.now()
+            ) and len(to_fold)
+            
+            # A long backlog (e.g. a session from before summaries) is folded a batch per run
+            if summarized and len(messages) - keep > batch_size:
+                update_conversation_summary.delay(chat_session_id)
+        
+        return {
+            'task': 'update_conversation_summary',
+            'status': 'success',
+            'chat_session_id': chat_session_id,
+            'summarized_messages': summarized,
+            'timestamp': timezone.now().isoformat()
+        }
+    except Exception as e:
+        return {
+            'task': 'update_conversation_summary',
+            'status': 'error',
+            'chat_session_id': chat_session_id,
+            'error': str(e),
+            'timestamp': timezone.now().isoformat()
+        }
+
+@shared_task
+def generate_chat_reply(job_id):
+    """
+    Answer a ChatJob: run ChatService.generate_response and save the bot message
+    """
+    # Claim the job, so a duplicate delivery or a re-enqueue by the sweeper never answers it twice
+    claimed = ChatJob.objects.filter(id=job_id, status=ChatJob.QUEUED).update(
+        status=ChatJob.RUNNING, started_at=timezone.now(), attempts=F('attempts') + 1
+    )
+    if not claimed:
+        return {
+            'task': 'generate_chat_reply',
+            'status': 'success',
+            'job_id': str(job_id),
+            'skipped': True,
+            'timestamp': timezone.now().isoformat()
+        }
+    
+    job = ChatJob.objects.select_related('chat_session', 'user_message').get(id=job_id)
+    chat_session = job.chat_session
+    error = ''
+    try:
+        # The history the question was asked against, not anything sent after it
+        chat_history = list(reversed(chat_session.unsummarized_messages(before_id=job.user_message_id)))
+        bot_response, metadata = ChatService(retrieval_filters=job.filters).generate_response(
+            job.user_message.content,
+            chat_history,
+            chat_session.summary
+        )
+    except Exception as e:
+        bot_response = "I apologize, but I encountered an error processing your request. Please try again."
+        metadata = {'error': str(e)}
+        error = str(e)[:1000]
+    
+    with transaction.atomic():
+        # The sweeper may have given up on this attempt meanwhile; then its reply is not ours to save
+        if not ChatJob.objects.select_for_update().filter(
+            id=job.id, status=ChatJob.RUNNING, attempts=job.attempts
+        ).exists():
+            return {
+                'task': 'generate_chat_reply',
+                'status': 'error',
+                'job_id': str(job_id),
+                'error': 'Job was taken over while running',
+                'timestamp': timezone.now().isoformat()
+            }
+        bot_message = chat_session.add_message(bot_response, is_user=False, metadata=metadata)
+        ChatJob.objects.filter(id=job.id).update(
+            status=ChatJob.FAILED if error else ChatJob.SUCCEEDED,
+            bot_message=bot_message,
+            error=error,
+            finished_at=timezone.now()
+        )
+    
+    return {
+        'task': 'generate_chat_reply',
+        'status': 'error' if error else 'success',
+        'job_id': str(job_id),
+        'bot_message_id': bot_message.id,
+        **({'error': error} if error else {}),
+        'timestamp': timezone.now().isoformat()
+    }
+
+@shared_task
+def sweep_chat_jobs():
+    """
+    Re-enqueue chat jobs whose message was lost, retry ones a dead worker left running, prune finished ones
+    """
+    now = timezone.now()
+    requeue_after = timedelta(seconds=getattr(settings, 'CHAT_JOB_REQUEUE_SECONDS', 60))
+    timeout = timedelta(seconds=getattr(settings, 'CHAT_JOB_TIMEOUT_SECONDS', 300))
+    max_attempts = getattr(settings, 'CHAT_JOB_MAX_ATTEMPTS', 3)
+    try:
+        # Running far past any reasonable answer time: the worker died mid-job
+        stuck = ChatJob.objects.filter(status=ChatJob.RUNNING, started_at__lt=now - timeout)
+        failed = stuck.filter(attempts__gte=max_attempts).update(
+            status=ChatJob.FAILED, error='Gave up after repeated worker timeouts', finished_at=now
+        )
+        # Back dated so the scan below resends them straight away
+        retried = stuck.filter(attempts__lt=max_attempts).update(status=ChatJob.QUEUED, queued_at=now - requeue_after)
+        
+        # Still queued long after enqueueing: the broker message was lost or the enqueue never happened
+        lost = ChatJob.objects.filter(status=ChatJob.QUEUED, queued_at__lte=now - requeue_after)
+        job_ids = list(lost.values_list('id', flat=True)[:1000])
+        ChatJob.objects.filter(id__in=job_ids).update(queued_at=now)
+        for job_id in job_ids:
+            generate_chat_reply.delay(str(job_id))
+        
+        keep = timedelta(hours=getattr(settings, 'CHAT_JOB_KEEP_HOURS', 24))
+        pruned, _ = ChatJob.objects.filter(status__in=ChatJob.FINISHED, finished_at__lt=now - keep).delete()
+        
+        return {
+            'task': 'sweep_chat_jobs',
+            'status': 'success',
+            'requeued_jobs': len(job_ids),
+            'retried_jobs': retried,
+            'failed_jobs': failed,
+            'pruned_jobs': pruned,
+            'timestamp': timezone.now().isoformat()
+        }
+    except Exception as e:
+        return {
+            'task': 'sweep_chat_jobs',
+            'status': 'error',
+            'error': str(e),
+            'timestamp': timezone.now().isoformat()
         }
\ No newline at end of file
@@ -0,0 +1,1180 @@
+import asyncio
+import base64
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from itertools import count
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import openai
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document as LangchainDocument
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from . import rag_pipeline, retention, tasks
+from .ann_index import ann_settings, build_index, index_type_of, select_index_type
+from .archive import SessionArchiver
+from .chunk_filters import normalize_filters
+from .chunk_store import ChunkStore
+from .embedding_cache import CachedEmbeddings, EmbeddingCache
+from .lexical_index import FrozenLexicalIndex, LexicalIndex, bm25_search, reciprocal_rank_fusion, tokenize
+from .models import (
+    ArchivedSession, ChatJob, ChatSession, DailyStats, Message, RetentionCheckpoint, StatsWatermark, UserRetention
+)
+from .prompt_budget import PromptBuilder, count_message_tokens
+from .query_cache import SemanticResponseCache
+from .rag_pipeline import RAGPipeline
+from .retention import RetentionEngine, next_batch, retention_tiers
+from .services import ChatService
+from .stats import PERCENTILES, StatsRollup, latency_percentiles
+
+class HashEmbeddings(Embeddings):
+    """Bag-of-words vectors hashed into 64 dimensions: deterministic, and similar texts stay close"""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def _embed(self, text):
+        vector = np.zeros(64, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % 64] += 1
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+def create_user(username='alice', **fields):
+    return get_user_model().objects.create_user(
+        username=username, email=f"{username}@example.com", password='password', **fields
+    )
+
+class RAGPipelineTestCase(TestCase):
+    """Runs pipelines over a throwaway knowledge base directory, without the sentence-transformers model"""
+
+    def setUp(self):
+        super().setUp()
+        self.knowledge_base_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.knowledge_base_path, ignore_errors=True)
+        patcher = mock.patch.object(rag_pipeline, 'HuggingFaceEmbeddings', HashEmbeddings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open_pipeline(self, **kwargs):
+        return RAGPipeline(knowledge_base_path=self.knowledge_base_path, **kwargs)
+
+    @staticmethod
+    def knowledge(document_id, content, **fields):
+        return {'id': document_id, 'title': f"Document {document_id}", 'content': content, 'source': 'tests', **fields}
+
+    @staticmethod
+    def texts(documents):
+        return sorted(doc.page_content for doc in documents)
+
+class SharedPipelineTests(SimpleTestCase):
+    """The per-process pipeline behind get_rag_pipeline, with a stand-in that takes a while to build"""
+
+    def setUp(self):
+        self.building, self.release = threading.Event(), threading.Event()
+        self.builds = []
+        for name in ('_pipeline', '_pipeline_error'):
+            patcher = mock.patch.object(rag_pipeline, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(rag_pipeline, 'RAGPipeline', side_effect=self.build)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.release.set)
+
+    def build(self, **kwargs):
+        self.builds.append(kwargs)
+        self.building.set()
+        self.release.wait(5)
+        return mock.Mock(spec=RAGPipeline)
+
+    def join_warm_up(self):
+        for thread in threading.enumerate():
+            if thread.name == 'rag-warmup':
+                thread.join(5)
+
+    def test_readiness_is_503_until_the_warm_up_finishes(self):
+        response = self.client.get(reverse('chat-ready'))
+        self.assertEqual(response.status_code, 503)
+
+        self.building.wait(5)
+        loading = self.client.get(reverse('chat-ready'))
+        self.assertEqual(loading.json(), {'ready': False, 'loading': True, 'error': None})
+        self.release.set()
+        self.join_warm_up()
+
+        response = self.client.get(reverse('chat-ready'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'ready': True, 'loading': False, 'error': None})
+        self.assertEqual(len(self.builds), 1)
+
+    def test_concurrent_and_repeated_calls_build_the_pipeline_once(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            calls = [pool.submit(rag_pipeline.get_rag_pipeline) for _ in range(8)]
+            self.release.set()
+            pipelines = {id(call.result(timeout=5)) for call in calls}
+        rag_pipeline.warm_up_rag_pipeline()
+        self.join_warm_up()
+
+        self.assertEqual(len(pipelines), 1)
+        self.assertIs(rag_pipeline.get_rag_pipeline(), rag_pipeline._pipeline)
+        self.assertEqual(len(self.builds), 1)
+        rag_pipeline._pipeline.start_watcher.assert_called_once()
+
+    def test_a_failed_build_is_reported_and_retried(self):
+        rag_pipeline.RAGPipeline.side_effect = RuntimeError('index missing')
+
+        response = self.client.get(reverse('chat-ready'))
+        self.join_warm_up()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(rag_pipeline.rag_pipeline_status()['error'], 'index missing')
+
+        rag_pipeline.RAGPipeline.side_effect = self.build
+        self.release.set()
+        rag_pipeline.get_rag_pipeline()
+        self.assertEqual(rag_pipeline.rag_pipeline_status(), {'ready': True, 'loading': False, 'error': None})
+
+    def test_startup_warm_up_follows_the_setting(self):
+        self.release.set()
+        with override_settings(RAG_WARMUP_ON_STARTUP=False):
+            rag_pipeline.warm_up_on_startup()
+        self.join_warm_up()
+        self.assertEqual(self.builds, [])
+
+        with override_settings(RAG_WARMUP_ON_STARTUP=True):
+            rag_pipeline.warm_up_on_startup()
+        self.join_warm_up()
+        self.assertEqual(len(self.builds), 1)
+        self.assertTrue(rag_pipeline.rag_pipeline_status()['ready'])
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.cache = EmbeddingCache(str(Path(directory) / 'cache.sqlite3'), 'model')
+
+    def test_cached_chunks_are_not_re_encoded(self):
+        model = mock.Mock(wraps=HashEmbeddings())
+        embeddings = CachedEmbeddings(model, self.cache)
+
+        first = embeddings.embed_documents(['refund policy', 'shipping times', 'refund policy'])
+        second = embeddings.embed_documents(['shipping times', 'opening hours'])
+
+        self.assertEqual(model.embed_documents.call_args_list,
+                         [mock.call(['refund policy', 'shipping times']), mock.call(['opening hours'])])
+        np.testing.assert_allclose(second[0], first[1], rtol=1e-6)
+        self.assertEqual(self.cache.stats()['hits'], 2)
+
+    def test_stats_count_new_rows_without_scanning_the_table(self):
+        self.cache.stats()
+        statements = []
+        self.cache._conn.set_trace_callback(statements.append)
+
+        self.cache.put_many({self.cache.key('a'): [1.0, 0.0], self.cache.key('b'): [0.0, 1.0]})
+        self.cache.put_many({self.cache.key('a'): [1.0, 0.0]})
+        self.cache.record(hits=3, misses=1)
+        stats = self.cache.stats()
+
+        self.assertEqual(stats, {'entries': 2, 'hits': 3, 'misses': 1, 'hit_rate': 0.75})
+        self.assertFalse([statement for statement in statements if 'COUNT' in statement])
+
+class ChatStreamTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def stream(self, service):
+        with mock.patch('chat.views.ChatService', return_value=service):
+            response = self.client.post(reverse('chat-send') + '?stream=1', {'message': 'Where is my order?'})
+            return response, b''.join(response.streaming_content).decode()
+
+    def test_answer_streams_as_tokens_and_is_saved(self):
+        def stream_response(*args):
+            yield 'metadata', {'sources': ['Shipping']}
+            yield 'token', 'It ships '
+            yield 'token', 'today.'
+            yield 'done', 'It ships today.'
+        service = mock.Mock(stream_response=stream_response)
+
+        response, body = self.stream(service)
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = [line[len('event: '):] for line in body.splitlines() if line.startswith('event: ')]
+        self.assertEqual(events, ['session', 'metadata', 'token', 'token', 'done'])
+        bot_message = ChatSession.objects.get(user=self.user).messages.get(is_user=False)
+        self.assertEqual((bot_message.content, bot_message.metadata), ('It ships today.', {'sources': ['Shipping']}))
+
+    def test_pipeline_failure_is_reported_as_an_error_event(self):
+        with mock.patch('chat.views.ChatService', side_effect=RuntimeError('index failed to load')):
+            response = self.client.post(reverse('chat-send') + '?stream=1', {'message': 'Where is my order?'})
+            body = b''.join(response.streaming_content).decode()
+
+        self.assertIn('event: session', body)
+        self.assertIn('event: error', body)
+        session = ChatSession.objects.get(user=self.user)
+        bot_message = session.messages.get(is_user=False)
+        self.assertEqual(bot_message.metadata['error'], 'index failed to load')
+        self.assertEqual(session.messages.count(), 2)
+
+@override_settings(CHAT_RECENT_TURNS=2, CHAT_SUMMARY_EVERY_TURNS=2, CHAT_HISTORY_MAX_MESSAGES=10)
+class AsyncChatViewTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.chat_session = ChatSession.objects.create(user=self.user, title='Router', summary='Router keeps dropping.')
+        for i in range(4):
+            self.chat_session.add_message(f"question {i}", is_user=True)
+            self.chat_session.add_message(f"answer {i}", is_user=False)
+
+    def as_user(self, user):
+        return {'Authorization': f"Bearer {AccessToken.for_user(user)}"}
+
+    async def send(self, payload, user=None, **outcome):
+        """Post to the async endpoint; outcome configures agenerate_response (an answer by default)"""
+        outcome = outcome or {'return_value': ('Try a firmware update.', {'sources': ['Router FAQ']})}
+        service = mock.Mock(agenerate_response=mock.AsyncMock(**outcome))
+        headers = self.as_user(user or self.user)
+        with mock.patch('chat.views.ChatService', return_value=service) as service_class:
+            response = await self.async_client.post(reverse('chat-send-async'), payload, content_type='application/json',
+                                              headers=headers)
+        return response, service_class, service.agenerate_response
+
+    async def test_credentials_are_required(self):
+        response = await self.async_client.post(reverse('chat-send-async'), {'message': 'Hi'},
+                                          content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_another_users_session_is_not_found(self):
+        stranger = await sync_to_async(create_user)('bob')
+        response, _, generate = await self.send({'message': 'Hi', 'chat_session_id': self.chat_session.id}, stranger)
+
+        self.assertEqual(response.status_code, 404)
+        generate.assert_not_called()
+        self.assertEqual(await Message.objects.filter(chat_session=self.chat_session).acount(), 8)
+
+    async def test_history_and_summary_reach_the_model_and_both_messages_are_saved(self):
+        filters = {'document_type': 'faq'}
+        with mock.patch('chat.views.transaction.on_commit') as on_commit:
+            response, service_class, generate = await self.send(
+                {'message': 'Still drops.', 'chat_session_id': self.chat_session.id, 'filters': filters}
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['bot_response']['content'], 'Try a firmware update.')
+        service_class.assert_called_once_with(retrieval_filters=filters)
+        question, history, summary = generate.call_args.args
+        self.assertEqual(question, 'Still drops.')
+        self.assertEqual([message.content for message in history],
+                         [f"{role} {i}" for i in range(4) for role in ('question', 'answer')])
+        self.assertEqual(summary, 'Router keeps dropping.')
+        self.assertIs(generate.call_args.kwargs['pooled_session'], True)
+        # The history is at the summary threshold, so a summary update is queued once the turn commits
+        with mock.patch.object(tasks.update_conversation_summary, 'delay') as summarize:
+            on_commit.call_args.args[0]()
+        summarize.assert_called_once_with(self.chat_session.id)
+
+        stored = await ChatSession.objects.aget(id=self.chat_session.id)
+        self.assertEqual(stored.message_count, 10)
+        self.assertEqual(stored.last_message_preview, 'Try a firmware update.')
+        self.assertIs(stored.last_message_is_user, False)
+        bot_message = await Message.objects.filter(chat_session=stored).alast()
+        self.assertEqual(bot_message.metadata, {'sources': ['Router FAQ']})
+
+    async def test_a_new_session_is_titled_and_a_failed_answer_saved_as_the_fallback(self):
+        response, _, _ = await self.send({'message': 'Where is my order?'}, side_effect=RuntimeError('model unavailable'))
+
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual(data['chat_session']['title'], 'Where is my order?')
+        self.assertEqual(data['bot_response']['metadata'], {'error': 'model unavailable'})
+        stored = await ChatSession.objects.aget(id=data['chat_session_id'])
+        self.assertEqual((stored.message_count, stored.last_message_is_user), (2, False))
+
+class OpenAISessionTests(SimpleTestCase):
+    def setUp(self):
+        self.sessions = []
+
+        async def acreate(**kwargs):
+            self.sessions.append(openai.aiosession.get())
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=' Hello '))])
+
+        patcher = mock.patch.object(openai.ChatCompletion, 'acreate', acreate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = ChatService(rag_pipeline=mock.Mock())
+
+    def test_call_on_a_per_request_loop_closes_its_session(self):
+        reply = async_to_sync(self.service._acall_openai)([{'role': 'user', 'content': 'Hi'}])
+
+        self.assertEqual(reply, ('Hello', True))
+        self.assertTrue(self.sessions[0].closed)
+
+    def test_pooled_calls_share_one_open_session_per_loop(self):
+        async def two_calls():
+            for _ in range(2):
+                await self.service._acall_openai([{'role': 'user', 'content': 'Hi'}], pooled_session=True)
+            still_open = not self.sessions[0].closed
+            await self.sessions[0].close()
+            return still_open
+
+        self.assertTrue(async_to_sync(two_calls)())
+        self.assertIs(self.sessions[0], self.sessions[1])
+
+class DeltaSegmentTests(RAGPipelineTestCase):
+    def test_inserts_are_appended_as_segments_and_compacted_into_the_base(self):
+        pipeline = self.open_pipeline()
+        pipeline.update_knowledge_base([self.knowledge(1, 'refund policy thirty days')])
+        pipeline.update_knowledge_base([self.knowledge(2, 'shipping takes five days')])
+        self.assertEqual(len(pipeline.manifest['deltas']), 2)
+
+        reopened = self.open_pipeline()
+        self.assertEqual(self.texts(reopened.retrieve('refund policy', k=1)), ['refund policy thirty days'])
+
+        result = reopened.compact()
+        self.assertEqual(result['merged_deltas'], 2)
+        self.assertEqual(reopened.manifest['deltas'], [])
+        self.assertEqual(reopened._delta_paths(), [])
+        self.assertEqual(self.texts(self.open_pipeline().retrieve('shipping', k=1)), ['shipping takes five days'])
+
+class DocumentAddressingTests(RAGPipelineTestCase):
+    def test_upsert_replaces_and_remove_drops_a_documents_chunks(self):
+        pipeline = self.open_pipeline()
+        pipeline.update_knowledge_base([
+            self.knowledge(1, 'warranty covers one year'),
+            self.knowledge(2, 'warranty claims by email'),
+        ])
+        pipeline.update_knowledge_base([self.knowledge(1, 'warranty covers two years')])
+
+        self.assertEqual(self.texts(pipeline.retrieve('warranty', k=5)),
+                         ['warranty claims by email', 'warranty covers two years'])
+
+        self.assertEqual(pipeline.remove_documents([2]), 1)
+        self.assertEqual(self.texts(pipeline.retrieve('warranty', k=5)), ['warranty covers two years'])
+        self.assertEqual(self.texts(self.open_pipeline().retrieve('warranty', k=5)), ['warranty covers two years'])
+
+class QueryCacheTests(RAGPipelineTestCase):
+    def test_repeated_query_is_served_from_cache_until_the_index_changes(self):
+        pipeline = self.open_pipeline()
+        pipeline.update_knowledge_base([self.knowledge(1, 'store opens at nine')])
+        embed_query = mock.patch.object(pipeline.embeddings, 'embed_query', wraps=pipeline.embeddings.embed_query)
+
+        with embed_query as embed:
+            pipeline.retrieve('When does the store open?', k=1)
+            pipeline.retrieve('  when does the STORE open? ', k=1)
+        self.assertEqual(embed.call_count, 1)
+        self.assertEqual(pipeline.retrieval_cache.hits, 1)
+
+        pipeline.update_knowledge_base([self.knowledge(1, 'store opens at ten')])
+        self.assertEqual(self.texts(pipeline.retrieve('When does the store open?', k=1)), ['store opens at ten'])
+
+class SemanticResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = SemanticResponseCache(threshold=0.95)
+        self.cache.set([1.0, 0.0], ['chunk-a', 'chunk-b'], 'Refunds take five days.', [7])
+
+    def test_similar_question_over_the_same_chunks_reuses_the_answer(self):
+        self.assertEqual(self.cache.get([0.99, 0.05], ['chunk-b', 'chunk-a']), 'Refunds take five days.')
+        self.assertIsNone(self.cache.get([0.6, 0.8], ['chunk-a', 'chunk-b']))
+        self.assertIsNone(self.cache.get([1.0, 0.0], ['chunk-a']))
+
+    def test_reindexing_a_source_document_drops_its_answers(self):
+        self.cache.invalidate_documents([7])
+
+        self.assertIsNone(self.cache.get([1.0, 0.0], ['chunk-a', 'chunk-b']))
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+class ANNIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.config = {**ann_settings(), 'index_type': 'auto', 'flat_max_vectors': 1000,
+                       'ivf_pq_min_vectors': 100000, 'nlist': 0, 'nprobe': 8}
+        self.vectors = np.random.default_rng(0).random((2000, 32), dtype=np.float32)
+
+    def test_auto_picks_the_index_type_from_corpus_size(self):
+        self.assertEqual(select_index_type(500, self.config), 'flat')
+        self.assertEqual(select_index_type(5000, self.config), 'ivf_flat')
+        self.assertEqual(select_index_type(200000, {**self.config, 'ivf_pq_min_vectors': 100}), 'ivf_pq')
+        # Too few vectors to train the requested structure
+        self.assertEqual(select_index_type(5000, {**self.config, 'ivf_pq_min_vectors': 100}), 'ivf_flat')
+        self.assertEqual(select_index_type(10, {**self.config, 'index_type': 'ivf_flat'}), 'flat')
+
+    def test_ivf_index_finds_stored_vectors_and_is_refilled_without_retraining(self):
+        index, retrained = build_index(self.vectors, self.config)
+        self.assertEqual((index_type_of(index), retrained), ('ivf_flat', True))
+        _, positions = index.search(self.vectors[:20], 1)
+        self.assertGreaterEqual(np.mean(positions[:, 0] == np.arange(20)), 0.9)
+
+        refilled, retrained = build_index(self.vectors[:1500], self.config, trained=index)
+        self.assertEqual((index_type_of(refilled), retrained, refilled.ntotal), ('ivf_flat', False, 1500))
+
+    def test_hnsw_is_built_when_configured(self):
+        index, retrained = build_index(self.vectors[:300], {**self.config, 'index_type': 'hnsw'})
+        self.assertEqual((index_type_of(index), retrained), ('hnsw', False))
+
+@override_settings(RAG_INDEX_TYPE='auto', RAG_FLAT_MAX_VECTORS=50)
+class RetrainTests(RAGPipelineTestCase):
+    def test_retrain_switches_a_grown_corpus_to_ivf(self):
+        pipeline = self.open_pipeline()
+        pipeline.update_knowledge_base([
+            self.knowledge(i, f"item{i} part{i % 7} note{i % 11}") for i in range(1, 121)
+        ])
+
+        result = pipeline.retrain()
+
+        self.assertEqual((result['retrained'], result['index_type']), (True, 'ivf_flat'))
+        self.assertEqual(index_type_of(self.open_pipeline().vector_store.index), 'ivf_flat')
+        self.assertFalse(pipeline.retrain()['retrained'])
+        self.assertEqual(self.texts(pipeline.retrieve('item42 part0 note9', k=1)), ['item42 part0 note9'])
+
+class ReadOnlyPipelineTests(RAGPipelineTestCase):
+    def test_reader_serves_the_mapped_base_and_refuses_writes(self):
+        writer = self.open_pipeline()
+        writer.update_knowledge_base([self.knowledge(1, 'returns desk on floor two')])
+        writer.compact()
+
+        reader = self.open_pipeline(read_only=True)
+
+        self.assertIsInstance(reader.vector_store.docstore, ChunkStore)
+        self.assertEqual(self.texts(reader.retrieve('returns desk', k=1)), ['returns desk on floor two'])
+        with self.assertRaises(RuntimeError):
+            reader.update_knowledge_base([self.knowledge(2, 'lost property office')])
+        with self.assertRaises(RuntimeError):
+            reader.remove_documents([1])
+
+class IndexVersioningTests(RAGPipelineTestCase):
+    def test_readers_hot_swap_to_each_published_version(self):
+        writer = self.open_pipeline()
+        writer.update_knowledge_base([self.knowledge(1, 'parking is free on sundays')])
+        reader = self.open_pipeline(read_only=True)
+        version = reader.index_version
+        self.assertFalse(reader.refresh())
+
+        writer.update_knowledge_base([self.knowledge(2, 'parking costs two euros')])
+        self.assertTrue(reader.refresh())
+        self.assertGreater(reader.index_version, version)
+        self.assertEqual(self.texts(reader.retrieve('parking', k=5)),
+                         ['parking costs two euros', 'parking is free on sundays'])
+
+        writer.compact()
+        self.assertTrue(reader.refresh())
+        self.assertEqual(reader.manifest['deltas'], [])
+        self.assertEqual(len(reader.retrieve('parking', k=5)), 2)
+
+    def test_an_unpublished_version_is_never_served(self):
+        writer = self.open_pipeline()
+        writer.update_knowledge_base([self.knowledge(1, 'lockers by the entrance')])
+        with mock.patch.object(RAGPipeline, '_publish', side_effect=OSError('disk full')), \
+                self.assertRaises(OSError):
+            writer.compact()
+
+        reader = self.open_pipeline(read_only=True)
+        self.assertEqual(len(reader.manifest['deltas']), 1)
+        self.assertEqual(self.texts(reader.retrieve('lockers', k=1)), ['lockers by the entrance'])
+
+class WriterCrash(BaseException):
+    """Stands in for the writer process dying: not an Exception, so nothing on the way up handles it"""
+
+class WriteAheadLogTests(RAGPipelineTestCase):
+    def test_operation_logged_before_a_crash_is_replayed(self):
+        pipeline = self.open_pipeline()
+        pipeline.update_knowledge_base([self.knowledge(1, 'helpdesk closes at six')])
+        with mock.patch.object(RAGPipeline, '_apply', side_effect=WriterCrash), self.assertRaises(WriterCrash):
+            pipeline.remove_documents([1])
+
+        recovered = self.open_pipeline()
+        self.assertEqual(self.texts(recovered.retrieve('helpdesk', k=1)), ['helpdesk closes at six'])
+        self.assertEqual(recovered.recover()['replayed_operations'], 1)
+        self.assertEqual(recovered.retrieve('helpdesk', k=1), [])
+        self.assertEqual(recovered.wal.stats(recovered._applied_seq())['entries'], 0)
+
+    def test_crash_between_segment_write_and_publish_is_replayed_once(self):
+        pipeline = self.open_pipeline()
+        publish = RAGPipeline._publish
+
+        def crash_on_delta_publish(self, base=None, deltas=None, applied_seq=None):
+            if deltas:
+                raise WriterCrash()
+            return publish(self, base, deltas, applied_seq)
+
+        with mock.patch.object(RAGPipeline, '_publish', crash_on_delta_publish), self.assertRaises(WriterCrash):
+            pipeline.update_knowledge_base([self.knowledge(1, 'lift to the roof terrace')])
+        self.assertEqual(len(pipeline._delta_paths()), 1)
+
+        recovered = self.open_pipeline()
+        self.assertEqual(recovered.recover()['replayed_operations'], 1)
+        self.assertEqual(self.texts(recovered.retrieve('roof terrace', k=5)), ['lift to the roof terrace'])
+        recovered.compact()
+        self.assertEqual(self.texts(self.open_pipeline().retrieve('roof terrace', k=5)), ['lift to the roof terrace'])
+
+    def test_torn_record_is_skipped(self):
+        pipeline = self.open_pipeline()
+        with open(pipeline.wal.path, 'a') as f:
+            f.write('{"seq": 1, "op": "remo')
+        pipeline.update_knowledge_base([self.knowledge(1, 'coat check by the stairs')])
+
+        self.assertEqual(self.texts(pipeline.retrieve('coat check', k=1)), ['coat check by the stairs'])
+        self.assertEqual(pipeline._applied_seq(), 1)
+
+class LexicalIndexTests(SimpleTestCase):
+    TEXTS = [
+        'Restart the router if you see ERR-1042 on the display.',
+        'The router firmware updates itself overnight.',
+        'Set RAG_INDEX_TYPE to hnsw for large corpora.',
+    ]
+
+    def test_identifiers_are_indexed_whole_and_in_parts(self):
+        self.assertEqual(tokenize('See ERR-1042'), ['see', 'err-1042', 'err', '1042'])
+
+    def test_saved_index_ranks_like_the_in_memory_one(self):
+        index = LexicalIndex.build(self.TEXTS)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        index.save(directory)
+
+        for query in ('err-1042', 'router', 'rag_index_type hnsw'):
+            hits = bm25_search([index], query, 3)[0]
+            self.assertEqual(bm25_search([FrozenLexicalIndex(directory)], query, 3)[0], hits)
+        self.assertEqual([position for position, _ in bm25_search([index], 'ERR-1042 router', 3)[0]], [0, 1])
+
+    def test_rank_fusion_favours_keys_ranked_well_in_both_lists(self):
+        self.assertEqual(reciprocal_rank_fusion([['a', 'b', 'c'], ['b', 'd', 'a']]), ['b', 'a', 'd', 'c'])
+
+class HybridRetrievalTests(RAGPipelineTestCase):
+    def test_hybrid_retrieval_finds_exact_identifiers(self):
+        pipeline = self.open_pipeline()
+        pipeline.update_knowledge_base([self.knowledge(i + 1, text) for i, text in enumerate(LexicalIndexTests.TEXTS)])
+        query = 'what does ERR-1042 mean'
+        self.assertEqual(self.texts(pipeline.retrieve(query, k=1, mode='hybrid')), [LexicalIndexTests.TEXTS[0]])
+
+        # After compaction the base's postings are read from disk
+        pipeline.compact()
+        reopened = self.open_pipeline()
+        self.assertIsInstance(reopened.base_lexical, FrozenLexicalIndex)
+        self.assertEqual(self.texts(reopened.retrieve(query, k=1, mode='hybrid')), [LexicalIndexTests.TEXTS[0]])
+
+class FilteredRetrievalTests(RAGPipelineTestCase):
+    def test_filters_apply_before_the_top_k_cut(self):
+        pipeline = self.open_pipeline()
+        pipeline.update_knowledge_base([
+            self.knowledge(i, f"password reset steps variant {i}", type='article', added_at='2024-03-01T10:00:00')
+            for i in range(1, 41)
+        ])
+        pipeline.compact()
+        pipeline.update_knowledge_base([
+            self.knowledge(41, 'billing questions answered', type='faq', added_at='2024-06-15T09:00:00'),
+            self.knowledge(42, 'password reset from the faq', type='faq', source='helpdesk',
+                           added_at='2023-12-24T09:00:00'),
+        ])
+
+        faq = pipeline.retrieve('password reset steps', k=1, filters={'document_type': 'faq'})
+        self.assertEqual(self.texts(faq), ['password reset from the faq'])
+        recent_faq = pipeline.retrieve('password reset steps', k=5,
+                                       filters={'document_type': ['faq'], 'date_from': '2024-01-01'})
+        self.assertEqual(self.texts(recent_faq), ['billing questions answered'])
+        march = pipeline.retrieve('password reset steps', k=50, filters={'date_to': '2024-03-01'})
+        self.assertEqual(len(march), 41)
+        self.assertEqual(pipeline.retrieve('password', k=3, filters={'source': 'nowhere'}), [])
+
+    def test_unknown_filter_is_rejected(self):
+        with self.assertRaises(ValueError):
+            normalize_filters({'author': 'someone'})
+
+class PromptBuilderTests(SimpleTestCase):
+    TEMPLATE = "Answer from this context.\n{context}"
+
+    def setUp(self):
+        self.chunks = [
+            LangchainDocument(page_content=f"chunk {i} " + "detail " * 60, metadata={'title': f"Doc {i}"})
+            for i in range(1, 6)
+        ]
+        self.history = [SimpleNamespace(is_user=i % 2 == 0, content=f"turn {i} " + "words " * 40) for i in range(6)]
+
+    def build(self, budget):
+        builder = PromptBuilder('gpt-3.5-turbo', budget=budget, chunk_max_tokens=100)
+        messages, usage = builder.build(
+            self.TEMPLATE, self.chunks, self.history, 'How do I reset it?', 'Earlier: a router.'
+        )
+        return builder, messages, usage
+
+    def test_prompt_fits_the_budget_dropping_low_ranked_chunks_and_old_turns(self):
+        builder, messages, usage = self.build(budget=400)
+
+        self.assertLessEqual(count_message_tokens(messages, builder.encoding), 400)
+        self.assertEqual(usage['prompt_tokens'], count_message_tokens(messages, builder.encoding))
+        self.assertIn('Earlier: a router.', messages[1]['content'])
+        self.assertEqual(messages[-1], {'role': 'user', 'content': 'How do I reset it?'})
+        self.assertGreater(usage['context_chunks']['dropped'], 0)
+        self.assertIn('chunk 1 ', messages[0]['content'])
+        self.assertNotIn('chunk 5 ', messages[0]['content'])
+        sent_history = [message['content'][:len('turn 5')] for message in messages[2:-1]]
+        self.assertEqual(sent_history, ['turn 4', 'turn 5'])
+
+    def test_everything_is_sent_when_it_fits(self):
+        _, messages, usage = self.build(budget=100000)
+
+        self.assertEqual(usage['context_chunks'], {'sent': 5, 'dropped': 0})
+        self.assertEqual(usage['history_messages'], {'sent': 6, 'dropped': 0})
+        self.assertEqual(len(messages), 9)
+
+@override_settings(CHAT_RECENT_TURNS=2, CHAT_SUMMARY_EVERY_TURNS=2, CHAT_HISTORY_MAX_MESSAGES=10,
+                   CHAT_SUMMARY_BATCH_MESSAGES=12)
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        self.chat_session = ChatSession.objects.create(user=create_user())
+
+    def add_turns(self, count):
+        for i in range(count):
+            self.chat_session.add_message(f"question {i}", is_user=True)
+            self.chat_session.add_message(f"answer {i}", is_user=False)
+
+    def summarize(self):
+        with mock.patch.object(tasks, 'summarize_conversation', side_effect=lambda summary, messages: (
+            ' | '.join([summary, *(message.content for message in messages)]).strip(' |')
+        )) as summarize, mock.patch.object(tasks.update_conversation_summary, 'delay') as delay:
+            result = tasks.update_conversation_summary(self.chat_session.id)
+        self.chat_session.refresh_from_db()
+        return result, summarize, delay
+
+    def test_summary_is_due_once_turns_build_up_beyond_the_raw_window(self):
+        self.assertFalse(ChatSession.summary_due(7))
+        self.assertTrue(ChatSession.summary_due(8))
+
+    def test_aged_out_turns_are_folded_and_leave_the_history(self):
+        self.add_turns(4)
+        result, _, delay = self.summarize()
+
+        self.assertEqual(result['summarized_messages'], 4)
+        self.assertEqual(self.chat_session.summary, 'question 0 | answer 0 | question 1 | answer 1')
+        history = [message.content for message in reversed(self.chat_session.unsummarized_messages())]
+        self.assertEqual(history, ['question 2', 'answer 2', 'question 3', 'answer 3'])
+        delay.assert_not_called()
+
+        self.add_turns(1)
+        self.summarize()
+        self.assertTrue(self.chat_session.summary.endswith('question 2 | answer 2'))
+
+    def test_history_before_a_message_leaves_out_later_ones(self):
+        self.add_turns(2)
+        question = self.chat_session.messages.get(content='question 1')
+
+        history = self.chat_session.unsummarized_messages(before_id=question.id)
+        self.assertEqual([message.content for message in history], ['answer 0', 'question 0'])
+
+    def test_long_backlog_is_folded_a_batch_per_run(self):
+        self.add_turns(10)
+        result, summarize, delay = self.summarize()
+
+        self.assertEqual(result['summarized_messages'], 12)
+        self.assertEqual(len(summarize.call_args.args[1]), 12)
+        delay.assert_called_once_with(self.chat_session.id)
+
+    def test_stale_run_does_not_overwrite_a_newer_summary(self):
+        self.add_turns(4)
+
+        def concurrent_run(summary, messages):
+            ChatSession.objects.filter(id=self.chat_session.id).update(summary='newer', summary_through_id=10 ** 6)
+            return 'stale'
+
+        with mock.patch.object(tasks, 'summarize_conversation', side_effect=concurrent_run):
+            result = tasks.update_conversation_summary(self.chat_session.id)
+
+        self.chat_session.refresh_from_db()
+        self.assertEqual(result['summarized_messages'], 0)
+        self.assertEqual(self.chat_session.summary, 'newer')
+
+class SessionListTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_sessions(self, count):
+        for i in range(count):
+            chat_session = ChatSession.objects.create(user=self.user)
+            chat_session.add_message(f"question {i} " + "x" * 150, is_user=True)
+            chat_session.add_message(f"answer {i}", is_user=False)
+
+    def test_a_page_of_sessions_is_one_query_whatever_its_size(self):
+        self.add_sessions(2)
+        with self.assertNumQueries(1):
+            self.client.get(reverse('chat-sessions'))
+        self.add_sessions(8)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('chat-sessions'))
+
+        newest = response.data['results'][0]
+        self.assertNotIn('messages', newest)
+        self.assertEqual(newest['message_count'], 2)
+        self.assertEqual(newest['last_message']['content'], 'answer 7')
+        self.assertFalse(newest['last_message']['is_user'])
+
+class SessionCountersTests(TestCase):
+    def setUp(self):
+        self.chat_session = ChatSession.objects.create(user=create_user())
+
+    def test_add_message_keeps_counters_preview_and_title_in_step(self):
+        long_question = 'Why does my router keep dropping the connection ' * 5
+        self.chat_session.add_message(long_question, is_user=True)
+        self.chat_session.add_message('Try a firmware update.', is_user=False)
+
+        stored = ChatSession.objects.get(id=self.chat_session.id)
+        self.assertEqual(stored.message_count, 2)
+        self.assertEqual(stored.last_message_preview, 'Try a firmware update.')
+        self.assertIs(stored.last_message_is_user, False)
+        self.assertEqual(stored.last_message_at, stored.messages.last().created_at)
+        self.assertEqual(stored.title, long_question[:50] + '...')
+        for field in ('message_count', 'last_message_preview', 'last_message_is_user', 'title'):
+            self.assertEqual(getattr(self.chat_session, field), getattr(stored, field))
+
+    def test_a_stale_instance_does_not_lose_counts(self):
+        stale = ChatSession.objects.get(id=self.chat_session.id)
+        self.chat_session.add_message('first', is_user=True)
+        stale.add_message('second', is_user=True)
+
+        stored = ChatSession.objects.get(id=self.chat_session.id)
+        self.assertEqual(stored.message_count, 2)
+        self.assertEqual(stored.title, 'first')
+
+    def test_backfill_recomputes_the_stored_fields(self):
+        self.chat_session.add_message('question', is_user=True)
+        self.chat_session.add_message('answer ' * 30, is_user=False)
+        ChatSession.objects.update(message_count=0, last_message_at=None, last_message_preview='')
+
+        call_command('backfill_session_stats', batch_size=1, stdout=StringIO())
+
+        stored = ChatSession.objects.get(id=self.chat_session.id)
+        self.assertEqual(stored.message_count, 2)
+        self.assertEqual(stored.last_message_preview, ChatSession.preview('answer ' * 30))
+        self.assertEqual(stored.last_message_at, stored.messages.last().created_at)
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.chat_session = ChatSession.objects.create(user=self.user)
+        for i in range(7):
+            self.chat_session.add_message(f"message {i}", is_user=i % 2 == 0)
+        # Ties on created_at are broken by id, so no message is skipped or repeated
+        Message.objects.filter(content__in=['message 2', 'message 3', 'message 4']).update(
+            created_at=Message.objects.get(content='message 2').created_at
+        )
+        self.url = reverse('chat-messages', args=[self.chat_session.id])
+
+    def page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    @staticmethod
+    def contents(data):
+        return [message['content'] for message in data['results']]
+
+    def cursor(self, payload):
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+    def test_cursors_walk_every_message_forward_and_back(self):
+        seen, url = [], f"{self.url}?page_size=2"
+        while url:
+            last = self.page(url)
+            seen += self.contents(last)
+            url = last['next']
+        self.assertEqual(seen, [f"message {i}" for i in range(7)])
+
+        previous = self.page(last['previous'])
+        self.assertEqual(self.contents(previous), ['message 4', 'message 5'])
+        self.assertEqual(self.contents(self.page(previous['previous'])), ['message 2', 'message 3'])
+
+    def test_session_list_pages_newest_activity_first(self):
+        older = ChatSession.objects.create(user=self.user)
+        older.add_message('older', is_user=True)
+        self.chat_session.add_message('latest', is_user=True)
+
+        data = self.page(f"{reverse('chat-sessions')}?page_size=1")
+        self.assertEqual(data['results'][0]['id'], self.chat_session.id)
+        data = self.page(data['next'])
+        self.assertEqual(data['results'][0]['id'], older.id)
+        self.assertIsNone(data['next'])
+
+    def test_tampered_cursors_are_not_found(self):
+        for token in [
+            'not-base64!',
+            self.cursor(['2024-01-01T00:00:00+00:00', 1]),
+            self.cursor({'p': [{'a': 1}, 2]}),
+            self.cursor({'p': ['2024-01-01T00:00:00+00:00', '1']}),
+            self.cursor({'p': ['2024-01-01T00:00:00+00:00', True]}),
+            self.cursor({'p': ['yesterday', 1]}),
+            self.cursor({'p': ['2024-13-45T00:00:00+00:00', 1]}),
+            self.cursor({'p': [1]}),
+            self.cursor({'p': 5}),
+            self.cursor({'r': True}),
+        ]:
+            with self.subTest(token=token):
+                self.assertEqual(self.client.get(self.url, {'cursor': token}).status_code, 404)
+
+@override_settings(CHAT_RETENTION_DAYS=30, CHAT_RETENTION_PLAN_DAYS={'pro': 100, 'enterprise': 0})
+class RetentionEngineTests(TestCase):
+    def idle_session(self, user, days, messages=1):
+        chat_session = ChatSession.objects.create(user=user)
+        for i in range(messages):
+            chat_session.add_message(f"message {i}", is_user=True)
+        ChatSession.objects.filter(id=chat_session.id).update(updated_at=timezone.now() - timedelta(days=days))
+        return chat_session.id
+
+    def surviving(self, *session_ids):
+        return set(ChatSession.objects.filter(id__in=session_ids).values_list('id', flat=True))
+
+    def test_each_user_keeps_sessions_for_their_own_tier(self):
+        default, pro, enterprise, overridden = (
+            create_user(name) for name in ('default', 'pro', 'enterprise', 'overridden')
+        )
+        pro.groups.add(Group.objects.create(name='pro'))
+        enterprise.groups.add(Group.objects.create(name='enterprise'))
+        overridden.groups.add(Group.objects.get(name='pro'))
+        UserRetention.objects.create(user=overridden, days=10)
+
+        kept = {self.idle_session(default, 20), self.idle_session(pro, 90), self.idle_session(enterprise, 1000),
+                self.idle_session(overridden, 5)}
+        expired = {self.idle_session(default, 40), self.idle_session(pro, 110), self.idle_session(overridden, 20)}
+        archive = ArchivedSession.pack(ChatSession.objects.get(id=self.idle_session(default, 50)), [])
+        ChatSession.objects.filter(id=archive.session_id).delete()
+        archive.save()
+
+        result = RetentionEngine(pause=0).run()
+
+        self.assertTrue(result['complete'])
+        self.assertEqual(self.surviving(*kept, *expired), kept)
+        self.assertEqual(result['deleted_sessions'], 3)
+        self.assertEqual(result['deleted_messages'], 3)
+        self.assertEqual(result['deleted_archives'], 1)
+        self.assertFalse(ArchivedSession.objects.exists())
+        self.assertEqual(set(result['tiers']), {'user:10d', 'plan:pro', 'default',
+                                                'archive:user:10d', 'archive:plan:pro', 'archive:default'})
+
+    @override_settings(CHAT_RETENTION_PLAN_DAYS={})
+    def test_an_unset_default_period_falls_back_to_the_settings_default(self):
+        with override_settings():
+            del settings.CHAT_RETENTION_DAYS
+            self.assertEqual([(tier['name'], tier['days']) for tier in retention_tiers()], [('default', 365)])
+
+    @override_settings(CHAT_RETENTION_PLAN_DAYS={})
+    def test_a_run_out_of_time_resumes_from_its_checkpoint(self):
+        user = create_user()
+        expired = [self.idle_session(user, 40) for _ in range(4)]
+        engine = RetentionEngine(batch_size=1, pause=0, max_seconds=3)
+
+        # Each check of the clock advances it a second, so the run stops after two batches
+        with mock.patch.object(retention, 'time') as clock:
+            clock.monotonic.side_effect = count()
+            result = engine.run()
+
+        self.assertFalse(result['complete'])
+        self.assertEqual(result['deleted_sessions'], 2)
+        self.assertEqual(RetentionCheckpoint.objects.get(name='default').last_id, expired[1])
+        self.assertEqual(self.surviving(*expired), set(expired[2:]))
+
+        result = RetentionEngine(pause=0).run()
+        self.assertTrue(result['complete'])
+        self.assertEqual(result['tiers']['default']['resumed_after'], expired[1])
+        self.assertEqual(result['deleted_sessions'], 2)
+        self.assertEqual(RetentionCheckpoint.objects.get(name='default').last_id, 0)
+
+    def test_batches_are_cut_short_by_their_message_count(self):
+        user = create_user()
+        sessions = [self.idle_session(user, 40, messages=messages) for messages in (3, 3, 1, 5)]
+
+        batch = next_batch(ChatSession.objects.all(), 0, batch_size=10, batch_messages=6)
+        self.assertEqual(batch, sessions[:2])
+        self.assertEqual(next_batch(ChatSession.objects.all(), sessions[1], 10, 5), sessions[2:3])
+        # A session larger than the budget still goes, alone
+        self.assertEqual(next_batch(ChatSession.objects.all(), sessions[2], 10, 2), sessions[3:])
+
+    def test_a_session_active_again_is_not_deleted(self):
+        chat_session = ChatSession.objects.get(id=self.idle_session(create_user(), 40))
+        cutoff = timezone.now() - timedelta(days=30)
+        chat_session.add_message('back again', is_user=True)
+
+        RetentionEngine(pause=0)._delete_batch(ChatSession, 'default', [chat_session.id], cutoff)
+        self.assertTrue(ChatSession.objects.filter(id=chat_session.id).exists())
+
+@override_settings(CHAT_ARCHIVE_AFTER_DAYS=30)
+class SessionArchiverTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.chat_session = ChatSession.objects.create(user=self.user, summary='Router trouble so far.')
+        self.chat_session.add_message('Why does my router drop?', is_user=True)
+        self.chat_session.add_message('Try a firmware update.', is_user=False,
+                                      metadata={'sources': [{'title': 'Router FAQ'}], 'llm_latency_ms': 812})
+        self.chat_session.add_message('Done, still drops.', is_user=True)
+        # Two messages sharing a timestamp keep their (created_at, id) order through the round trip
+        shared = Message.objects.filter(chat_session=self.chat_session).order_by('id')
+        Message.objects.filter(id=shared[2].id).update(created_at=shared[1].created_at)
+        ChatSession.objects.filter(id=self.chat_session.id).update(
+            updated_at=timezone.now() - timedelta(days=40), summary_updated_at=timezone.now() - timedelta(days=41)
+        )
+
+    def snapshot(self):
+        chat_session = ChatSession.objects.get(id=self.chat_session.id)
+        messages = list(chat_session.messages.order_by('created_at', 'id').values(*ArchivedSession.MESSAGE_FIELDS))
+        fields = ArchivedSession.SESSION_FIELDS + ('summary', 'summary_through_id', 'summary_updated_at')
+        return {field: getattr(chat_session, field) for field in fields}, messages
+
+    def test_archive_then_restore_brings_the_session_back_unchanged(self):
+        session_before, messages_before = self.snapshot()
+        self.assertTrue(any(message['created_at'].microsecond for message in messages_before))
+
+        result = SessionArchiver(pause=0).run()
+
+        self.assertEqual((result['archived_sessions'], result['archived_messages']), (1, 3))
+        self.assertFalse(ChatSession.objects.filter(id=self.chat_session.id).exists())
+        self.assertFalse(Message.objects.exists())
+        archive = ArchivedSession.objects.get(session_id=self.chat_session.id)
+        self.assertLess(archive.stored_bytes, archive.raw_bytes)
+        document = archive.unpack()
+        self.assertEqual(document['messages'], messages_before)
+        self.assertEqual(document['session']['summary_updated_at'], session_before['summary_updated_at'])
+
+        archive.restore()
+
+        session_after, messages_after = self.snapshot()
+        self.assertEqual(messages_after, messages_before)
+        self.assertGreater(session_after.pop('updated_at'), session_before.pop('updated_at'))
+        self.assertEqual(session_after, session_before)
+        self.assertFalse(ArchivedSession.objects.exists())
+
+    def test_recently_active_sessions_stay_hot(self):
+        ChatSession.objects.filter(id=self.chat_session.id).update(updated_at=timezone.now() - timedelta(days=10))
+
+        result = SessionArchiver(pause=0).run()
+
+        self.assertEqual(result['archived_sessions'], 0)
+        self.assertFalse(ArchivedSession.objects.exists())
+
+    def test_archived_sessions_are_listed_and_restored_through_the_api(self):
+        SessionArchiver(pause=0).run()
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        listed = client.get(reverse('chat-history'), {'archived': 'true'}).data['results']
+        self.assertEqual([session['id'] for session in listed], [self.chat_session.id])
+        opened = client.get(reverse('chat-archived-session', args=[self.chat_session.id])).data
+        self.assertEqual([message['content'] for message in opened['messages']],
+                         ['Why does my router drop?', 'Try a firmware update.', 'Done, still drops.'])
+
+        client.post(reverse('chat-archived-session-restore', args=[self.chat_session.id]))
+        messages = client.get(reverse('chat-messages', args=[self.chat_session.id])).data['results']
+        self.assertEqual([message['id'] for message in messages], [message['id'] for message in opened['messages']])
+
+class StatsRollupTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.chat_session = ChatSession.objects.create(user=self.user)
+
+    def turn(self, latency_ms=None, cached=False):
+        self.chat_session.add_message('question', is_user=True)
+        metadata = {'cached_response': cached}
+        if latency_ms is not None:
+            metadata['llm_latency_ms'] = latency_ms
+        self.chat_session.add_message('answer', is_user=False, metadata=metadata)
+
+    def age_everything(self):
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        get_user_model().objects.update(date_joined=an_hour_ago)
+        ChatSession.objects.update(created_at=an_hour_ago)
+        Message.objects.update(created_at=an_hour_ago)
+
+    def today(self):
+        return DailyStats.objects.get(date=timezone.localdate(timezone.now() - timedelta(hours=1)))
+
+    def test_each_run_folds_only_what_arrived_since_the_watermark(self):
+        self.turn(latency_ms=100)
+        self.age_everything()
+        first = StatsRollup(batch_size=2, settle_seconds=60).run()
+
+        self.assertEqual((first['users_rolled_up'], first['sessions_rolled_up'], first['messages_rolled_up']),
+                         (1, 1, 2))
+        self.assertEqual(StatsWatermark.objects.get(name='messages').last_id, Message.objects.latest('id').id)
+
+        self.turn(cached=True)
+        self.turn(latency_ms=1000)
+        self.age_everything()
+        second = StatsRollup(batch_size=2, settle_seconds=60).run()
+
+        self.assertEqual((second['users_rolled_up'], second['messages_rolled_up'], second['messages_batches']),
+                         (0, 4, 2))
+        stats = self.today()
+        self.assertEqual((stats.new_users, stats.new_sessions, stats.active_users), (1, 1, 1))
+        self.assertEqual((stats.messages, stats.user_messages, stats.bot_messages), (6, 3, 3))
+        self.assertEqual((stats.cache_hits, stats.llm_calls), (1, 2))
+
+    def test_rows_younger_than_the_settle_lag_wait_for_the_next_run(self):
+        self.turn()
+        self.age_everything()
+        self.turn()
+
+        result = StatsRollup(settle_seconds=60).run()
+
+        self.assertEqual(result['messages_rolled_up'], 2)
+        self.assertEqual(self.today().messages, 2)
+        self.assertEqual(Message.objects.filter(id__gt=StatsWatermark.objects.get(name='messages').last_id).count(), 2)
+        self.assertEqual(StatsRollup(settle_seconds=0).run()['messages_rolled_up'], 2)
+
+    def test_latency_percentiles_come_from_the_merged_histogram(self):
+        for latency_ms in [100] * 90 + [1000] * 9 + [5000]:
+            self.turn(latency_ms=latency_ms)
+        self.age_everything()
+        StatsRollup(batch_size=64).run()
+
+        stats = self.today()
+        self.assertEqual(stats.llm_calls, 100)
+        self.assertEqual(sum(stats.llm_latency_histogram.values()), 100)
+        for value, expected in [(stats.llm_latency_p50_ms, 100), (stats.llm_latency_p95_ms, 1000),
+                                (stats.llm_latency_p99_ms, 1000)]:
+            self.assertGreaterEqual(value, expected)
+            self.assertLess(value, expected * 1.1)
+        self.assertEqual(latency_percentiles({}), dict.fromkeys(PERCENTILES))
+
+class ChatJobTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.chat_session = ChatSession.objects.create(user=self.user)
+        self.chat_session.add_message('earlier question', is_user=True)
+        self.chat_session.add_message('earlier answer', is_user=False)
+
+    def queue(self, question='How do I reset my router?', **fields):
+        user_message = self.chat_session.add_message(question, is_user=True)
+        return ChatJob.objects.create(user=self.user, chat_session=self.chat_session, user_message=user_message,
+                                      **fields)
+
+    def reply(self, job, answer='Hold the reset button.', side_effect=None):
+        with mock.patch.object(tasks, 'ChatService') as service:
+            generate = service.return_value.generate_response
+            generate.return_value, generate.side_effect = (answer, {'sources': []}), side_effect
+            result = tasks.generate_chat_reply(str(job.id))
+        job.refresh_from_db()
+        return result, generate
+
+    def test_send_async_queues_a_job_that_a_worker_answers(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch.object(tasks.generate_chat_reply, 'delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = client.post(f"{reverse('chat-send')}?async=1",
+                                   {'message': 'How do I reset my router?', 'chat_session_id': self.chat_session.id},
+                                   format='json')
+        self.assertEqual(response.status_code, 202)
+        delay.assert_called_once_with(response.data['job_id'])
+
+        self.chat_session.add_message('a later question', is_user=True)
+        job = ChatJob.objects.get(id=response.data['job_id'])
+        _, generate = self.reply(job)
+
+        self.assertEqual(job.status, ChatJob.SUCCEEDED)
+        self.assertEqual(job.bot_message.content, 'Hold the reset button.')
+        question, history, _ = generate.call_args.args
+        self.assertEqual(question, 'How do I reset my router?')
+        self.assertEqual([message.content for message in history], ['earlier question', 'earlier answer'])
+
+        status_response = self.client.get(reverse('chat-job', args=[job.id]),
+                                          HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+        self.assertEqual(status_response.json()['bot_response']['content'], 'Hold the reset button.')
+
+    @override_settings(CHAT_JOB_MAX_WAIT=0.2, CHAT_JOB_POLL_INTERVAL=0.05)
+    async def test_long_poll_is_capped_and_rejects_non_finite_waits(self):
+        job = await sync_to_async(self.queue)()
+        url = reverse('chat-job', args=[job.id])
+        client = AsyncClient()
+
+        def as_user(user):
+            return {'Authorization': f"Bearer {AccessToken.for_user(user)}"}
+
+        for wait in ['60', 'nan', 'inf', '-inf', 'soon']:
+            with self.subTest(wait=wait):
+                # A wait that never ends would hang the test instead of failing it
+                response = await asyncio.wait_for(client.get(url, {'wait': wait}, headers=as_user(self.user)), 5)
+                self.assertEqual(response.json()['status'], ChatJob.QUEUED)
+
+        stranger = await sync_to_async(create_user)('bob')
+        self.assertEqual((await client.get(url, headers=as_user(stranger))).status_code, 404)
+
+    def test_a_duplicate_delivery_is_skipped(self):
+        job = self.queue()
+        self.reply(job)
+        result, generate = self.reply(job)
+
+        self.assertTrue(result['skipped'])
+        generate.assert_not_called()
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(self.chat_session.messages.filter(is_user=False).count(), 2)
+
+    def test_a_failed_answer_is_saved_with_the_error(self):
+        job = self.queue()
+        result, _ = self.reply(job, side_effect=RuntimeError('model unavailable'))
+
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(job.status, ChatJob.FAILED)
+        self.assertEqual(job.error, 'model unavailable')
+        self.assertEqual(job.bot_message.metadata, {'error': 'model unavailable'})
+
+    def test_a_reply_to_an_attempt_taken_over_by_the_sweeper_is_dropped(self):
+        job = self.queue()
+
+        def taken_over(*args):
+            ChatJob.objects.filter(id=job.id).update(status=ChatJob.QUEUED)
+            return 'late answer', {}
+
+        result, _ = self.reply(job, side_effect=taken_over)
+
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(job.status, ChatJob.QUEUED)
+        self.assertFalse(self.chat_session.messages.filter(content='late answer').exists())
+
+    @override_settings(CHAT_JOB_REQUEUE_SECONDS=60, CHAT_JOB_TIMEOUT_SECONDS=300, CHAT_JOB_MAX_ATTEMPTS=3,
+                       CHAT_JOB_KEEP_HOURS=24)
+    def test_sweep_resends_lost_and_stuck_jobs_and_prunes_old_ones(self):
+        now = timezone.now()
+        fresh = self.queue('fresh')
+        lost = self.queue('lost', queued_at=now - timedelta(minutes=5))
+        stuck = self.queue('stuck', status=ChatJob.RUNNING, attempts=1, started_at=now - timedelta(minutes=10))
+        exhausted = self.queue('exhausted', status=ChatJob.RUNNING, attempts=3, started_at=now - timedelta(minutes=10))
+        running = self.queue('running', status=ChatJob.RUNNING, attempts=1, started_at=now - timedelta(seconds=30))
+        old = self.queue('old', status=ChatJob.SUCCEEDED, finished_at=now - timedelta(hours=30))
+        recent = self.queue('recent', status=ChatJob.FAILED, finished_at=now - timedelta(hours=1))
+
+        with mock.patch.object(tasks.generate_chat_reply, 'delay') as delay:
+            result = tasks.sweep_chat_jobs()
+
+        self.assertEqual(sorted(call.args[0] for call in delay.call_args_list), sorted([str(lost.id), str(stuck.id)]))
+        counts = [result[key] for key in ('requeued_jobs', 'retried_jobs', 'failed_jobs', 'pruned_jobs')]
+        self.assertEqual(counts, [2, 1, 1, 1])
+        statuses = dict(ChatJob.objects.values_list('id', 'status'))
+        self.assertEqual(statuses, {
+            fresh.id: ChatJob.QUEUED, lost.id: ChatJob.QUEUED, stuck.id: ChatJob.QUEUED,
+            exhausted.id: ChatJob.FAILED, running.id: ChatJob.RUNNING, recent.id: ChatJob.FAILED,
+        })
+        self.assertNotIn(old.id, statuses)
+
+        # Just resent, so the next sweep leaves them alone
+        with mock.patch.object(tasks.generate_chat_reply, 'delay'):
+            self.assertEqual(tasks.sweep_chat_jobs()['requeued_jobs'], 0)
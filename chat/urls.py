@@ -4,7 +4,13 @@ from .views import (
     ChatSessionDetailView, 
     MessageListView,
     ChatView, 
-    ChatHistoryView
+    AsyncChatView,
+    ChatJobView,
+    ChatHistoryView,
+    ArchivedSessionView,
+    RestoreArchivedSessionView,
+    MetricsView,
+    ReadinessView
 )
 
 urlpatterns = [
@@ -12,5 +18,12 @@ urlpatterns = [
     path('sessions/<int:pk>/', ChatSessionDetailView.as_view(), name='chat-session-detail'),
     path('sessions/<int:chat_session_id>/messages/', MessageListView.as_view(), name='chat-messages'),
     path('send/', ChatView.as_view(), name='chat-send'),
+    path('send/async/', AsyncChatView.as_view(), name='chat-send-async'),
+    path('jobs/<uuid:job_id>/', ChatJobView.as_view(), name='chat-job'),
     path('history/', ChatHistoryView.as_view(), name='chat-history'),
+    path('history/archived/<int:session_id>/', ArchivedSessionView.as_view(), name='chat-archived-session'),
+    path('history/archived/<int:session_id>/restore/', RestoreArchivedSessionView.as_view(),
+         name='chat-archived-session-restore'),
+    path('metrics/', MetricsView.as_view(), name='chat-metrics'),
+    path('ready/', ReadinessView.as_view(), name='chat-ready'),
 ]
\ No newline at end of file
@@ -1,14 +1,38 @@
+import asyncio
+import json
+import math
+from datetime import timedelta
+from asgiref.sync import sync_to_async
 from rest_framework import generics, status
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, AllowAny
+from rest_framework.views import APIView
+from django.http import JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
 from django.shortcuts import get_object_or_404
-from .models import ChatSession, Message
-from .serializers import ChatSessionSerializer, MessageSerializer, ChatRequestSerializer
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from .models import ArchivedSession, ChatJob, ChatSession, DailyStats, Message, StatsWatermark
+from .pagination import MessageCursorPagination, SessionCursorPagination
+from .serializers import (
+    ArchivedSessionSerializer, ChatJobSerializer, ChatSessionSerializer, DailyStatsSerializer, MessageSerializer,
+    ChatRequestSerializer
+)
 from .services import ChatService
+from .tasks import generate_chat_reply, update_conversation_summary
+from .rag_pipeline import rag_pipeline_status, warm_up_rag_pipeline
 
 class ChatSessionListView(generics.ListCreateAPIView):
     serializer_class = ChatSessionSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = SessionCursorPagination
     
     def get_queryset(self):
         return ChatSession.objects.filter(user=self.request.user)
@@ -26,6 +50,7 @@ class ChatSessionDetailView(generics.RetrieveUpdateDestroyAPIView):
 class MessageListView(generics.ListAPIView):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = MessageCursorPagination
     
     def get_queryset(self):
         chat_session_id = self.kwargs.get('chat_session_id')
@@ -46,6 +71,7 @@ class ChatView(generics.CreateAPIView):
         
         user_query = serializer.validated_data['message']
         chat_session_id = serializer.validated_data.get('chat_session_id')
+        filters = serializer.validated_data.get('filters')
         
         # Get or create chat session
         if chat_session_id:
@@ -62,40 +88,35 @@ class ChatView(generics.CreateAPIView):
                 title=title
             )
         
-        # Get chat history for context (last 10 messages)
-        chat_history = Message.objects.filter(
-            chat_session=chat_session
-        ).order_by('-created_at')[:10]
+        # Recent turns go to the model verbatim; older ones are covered by the session summary
+        chat_history = list(reversed(chat_session.unsummarized_messages()))  # Reverse to maintain chronological order
+        if ChatSession.summary_due(len(chat_history)):
+            # robust: a broker hiccup must not fail the user's turn
+            transaction.on_commit(lambda: update_conversation_summary.delay(chat_session.id), robust=True)
         
         # Save user message
-        user_message = Message.objects.create(
-            chat_session=chat_session,
-            content=user_query,
-            is_user=True
-        )
+        user_message = chat_session.add_message(user_query, is_user=True)
+        
+        if request.query_params.get('stream') in ('1', 'true'):
+            return self._stream(chat_session, user_message, chat_history, filters)
+        if request.query_params.get('async') in ('1', 'true'):
+            return self._enqueue(request, chat_session, user_message, filters)
         
         # Generate response using RAG pipeline
-        chat_service = ChatService()
+        chat_service = ChatService(retrieval_filters=filters)
         
         try:
             bot_response, metadata = chat_service.generate_response(
                 user_query, 
-                list(reversed(chat_history))  # Reverse to maintain chronological order
+                chat_history,
+                chat_session.summary
             )
         except Exception as e:
             bot_response = "I apologize, but I encountered an error processing your request. Please try again."
             metadata = {'error': str(e)}
         
         # Save bot response
-        bot_message = Message.objects.create(
-            chat_session=chat_session,
-            content=bot_response,
-            is_user=False,
-            metadata=metadata
-        )
-        
-        # Update chat session timestamp
-        chat_session.save()
+        bot_message = chat_session.add_message(bot_response, is_user=False, metadata=metadata)
         
         return Response({
             'success': True,
@@ -105,10 +126,272 @@ class ChatView(generics.CreateAPIView):
             'chat_session_id': chat_session.id,
             'message': 'Response generated successfully'
         }, status=status.HTTP_201_CREATED)
+    
+    def _enqueue(self, request, chat_session, user_message, filters=None):
+        """202 with a job a Celery worker answers; poll /api/chat/jobs/{job_id}/ for the reply"""
+        job = ChatJob.objects.create(
+            user=request.user,
+            chat_session=chat_session,
+            user_message=user_message,
+            filters=filters
+        )
+        # robust: if the broker is down the job stays queued and sweep_chat_jobs sends it later
+        transaction.on_commit(lambda: generate_chat_reply.delay(str(job.id)), robust=True)
+        
+        return Response({
+            'success': True,
+            'job_id': str(job.id),
+            'status': job.status,
+            'status_url': request.build_absolute_uri(reverse('chat-job', args=[job.id])),
+            'chat_session': ChatSessionSerializer(chat_session).data,
+            'user_message': MessageSerializer(user_message).data,
+            'chat_session_id': chat_session.id,
+            'message': 'Response queued'
+        }, status=status.HTTP_202_ACCEPTED)
+    
+    def _stream(self, chat_session, user_message, chat_history, filters=None):
+        """Server-Sent Events: retrieval metadata first, then tokens, then the saved bot message"""
+        def event(name, data):
+            return f"event: {name}\ndata: {json.dumps(data, default=str)}\n\n"
+        
+        def events():
+            yield event('session', {
+                'chat_session_id': chat_session.id,
+                'user_message': MessageSerializer(user_message).data,
+            })
+            
+            metadata = {}
+            parts = []
+            completed = False
+            stream = None
+            try:
+                # Inside the try: a pipeline that fails to load is answered like any other error
+                stream = ChatService(retrieval_filters=filters).stream_response(
+                    user_message.content, chat_history, chat_session.summary
+                )
+                for kind, payload in stream:
+                    if kind == 'metadata':
+                        metadata = payload
+                        yield event('metadata', payload)
+                    elif kind == 'token':
+                        parts.append(payload)
+                        yield event('token', {'content': payload})
+                    elif kind == 'done':
+                        completed = True
+                        bot_message = chat_session.add_message(payload, is_user=False, metadata=metadata)
+                        yield event('done', {'bot_response': MessageSerializer(bot_message).data})
+            except Exception as e:
+                if not completed:
+                    completed = True
+                    chat_session.add_message(
+                        "I apologize, but I encountered an error processing your request. Please try again.",
+                        is_user=False,
+                        metadata={**metadata, 'error': str(e)}
+                    )
+                    yield event('error', {'error': str(e)})
+            finally:
+                # Client went away mid-answer: stop generation and keep what was produced
+                if stream is not None:
+                    stream.close()
+                if not completed and parts:
+                    chat_session.add_message(
+                        "".join(parts).strip(),
+                        is_user=False,
+                        metadata={**metadata, 'stream_cancelled': True}
+                    )
+        
+        response = StreamingHttpResponse(events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 class ChatHistoryView(generics.ListAPIView):
+    """The user's sessions; ?archived=true lists the ones moved to cold storage instead"""
     permission_classes = [IsAuthenticated]
     serializer_class = ChatSessionSerializer
+    pagination_class = SessionCursorPagination
+    
+    def _archived(self):
+        return self.request.query_params.get('archived', '').lower() in ('1', 'true')
+    
+    def get_serializer_class(self):
+        return ArchivedSessionSerializer if self._archived() else ChatSessionSerializer
     
     def get_queryset(self):
-        return ChatSession.objects.filter(user=self.request.user)
\ No newline at end of file
+        if self._archived():
+            # The blob is only read when a single session is opened
+            return ArchivedSession.objects.filter(user=self.request.user).defer('payload')
+        return ChatSession.objects.filter(user=self.request.user)
+
+class ArchivedSessionView(APIView):
+    """An archived session rehydrated from its blob, messages included"""
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, session_id):
+        archive = get_object_or_404(ArchivedSession, session_id=session_id, user=request.user)
+        document = archive.unpack()
+        data = ArchivedSessionSerializer(archive).data
+        data['messages'] = MessageSerializer(document['messages'], many=True).data
+        return Response(data)
+
+class RestoreArchivedSessionView(APIView):
+    """Move an archived session back into the live tables so the conversation can continue"""
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request, session_id):
+        archive = get_object_or_404(ArchivedSession, session_id=session_id, user=request.user)
+        chat_session = archive.restore()
+        return Response(ChatSessionSerializer(chat_session).data)
+
+class MetricsView(APIView):
+    """Daily usage and LLM latency for the last ?days= days (default 30), read from the DailyStats rollup"""
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        try:
+            days = min(max(int(request.query_params.get('days', 30)), 1), 366)
+        except ValueError:
+            days = 30
+        since = timezone.localdate() - timedelta(days=days - 1)
+        rows = DailyStats.objects.filter(date__gte=since).order_by('-date')
+        return Response({
+            'days': DailyStatsSerializer(rows, many=True).data,
+            # How far the rollup has got; rows created since are not counted yet
+            'watermarks': {
+                watermark.name: {'last_id': watermark.last_id, 'updated_at': watermark.updated_at}
+                for watermark in StatsWatermark.objects.all()
+            },
+        })
+
+class ReadinessView(APIView):
+    """Report whether this worker has its RAG pipeline loaded"""
+    permission_classes = [AllowAny]
+    authentication_classes = []
+    
+    def get(self, request):
+        pipeline_status = rag_pipeline_status()
+        if not pipeline_status['ready']:
+            warm_up_rag_pipeline()
+            return Response(pipeline_status, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response(pipeline_status)
+
+class AsyncJWTMixin:
+    """JWT authentication for plain async Django views, which DRF's authentication classes can't serve"""
+    
+    async def authenticate(self, request):
+        """(user, None), or (None, a 401 response)"""
+        try:
+            user = await sync_to_async(self._authenticate)(request)
+        except AuthenticationFailed as e:
+            return None, JsonResponse({'detail': str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+        if user is None:
+            return None, JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                                      status=status.HTTP_401_UNAUTHORIZED)
+        return user, None
+    
+    def _authenticate(self, request):
+        result = JWTAuthentication().authenticate(request)
+        return result[0] if result else None
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatView(AsyncJWTMixin, View):
+    """
+    Async counterpart of ChatView for ASGI deployments.
+    
+    Plain Django view because DRF views are sync-only; JWT auth and request
+    validation reuse the same classes as ChatView.
+    """
+    
+    async def post(self, request):
+        user, error = await self.authenticate(request)
+        if error:
+            return error
+        
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'detail': 'Invalid JSON body.'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = ChatRequestSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        user_query = serializer.validated_data['message']
+        chat_session_id = serializer.validated_data.get('chat_session_id')
+        filters = serializer.validated_data.get('filters')
+        
+        # Get or create chat session
+        if chat_session_id:
+            try:
+                chat_session = await ChatSession.objects.aget(id=chat_session_id, user=user)
+            except ChatSession.DoesNotExist:
+                return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        else:
+            title = user_query[:50] + "..." if len(user_query) > 50 else user_query
+            chat_session = await ChatSession.objects.acreate(user=user, title=title)
+        
+        # Recent turns go to the model verbatim; older ones are covered by the session summary
+        chat_history = [message async for message in chat_session.unsummarized_messages()]
+        chat_history.reverse()
+        if ChatSession.summary_due(len(chat_history)):
+            await sync_to_async(transaction.on_commit)(
+                lambda: update_conversation_summary.delay(chat_session.id), robust=True
+            )
+        
+        # Save user message
+        user_message = await chat_session.aadd_message(user_query, is_user=True)
+        
+        try:
+            # First use in a process loads the model; keep that off the event loop
+            chat_service = await sync_to_async(ChatService, thread_sensitive=False)(retrieval_filters=filters)
+            # Only an ASGI server keeps one event loop alive long enough to pool connections on it
+            bot_response, metadata = await chat_service.agenerate_response(
+                user_query, chat_history, chat_session.summary, pooled_session=isinstance(request, ASGIRequest)
+            )
+        except Exception as e:
+            bot_response = "I apologize, but I encountered an error processing your request. Please try again."
+            metadata = {'error': str(e)}
+        
+        # Save bot response
+        bot_message = await chat_session.aadd_message(bot_response, is_user=False, metadata=metadata)
+        
+        return JsonResponse({
+            'success': True,
+            'chat_session': ChatSessionSerializer(chat_session).data,
+            'user_message': MessageSerializer(user_message).data,
+            'bot_response': MessageSerializer(bot_message).data,
+            'chat_session_id': chat_session.id,
+            'message': 'Response generated successfully'
+        }, status=status.HTTP_201_CREATED)
+
+class ChatJobView(AsyncJWTMixin, View):
+    """
+    Status of a background chat job, with the reply once it is done.
+    
+    ?wait=N (seconds, up to CHAT_JOB_MAX_WAIT) long-polls: the response is held
+    until the job finishes or the wait runs out. Async, so under ASGI a waiting
+    client costs a coroutine and a primary-key lookup per poll interval, not a worker.
+    """
+    
+    async def get(self, request, job_id):
+        user, error = await self.authenticate(request)
+        if error:
+            return error
+        
+        try:
+            wait = float(request.GET.get('wait', 0))
+        except ValueError:
+            wait = 0
+        # nan (or inf) would survive min/max and leave the deadline unreachable
+        wait = min(max(wait, 0), getattr(settings, 'CHAT_JOB_MAX_WAIT', 30)) if math.isfinite(wait) else 0
+        interval = getattr(settings, 'CHAT_JOB_POLL_INTERVAL', 0.5)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        jobs = ChatJob.objects.select_related('user_message', 'bot_message').filter(id=job_id, user=user)
+        while True:
+            job = await jobs.afirst()
+            if job is None:
+                return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+            if job.finished or loop.time() >= deadline:
+                break
+            await asyncio.sleep(interval)
+        return JsonResponse(ChatJobSerializer(job).data)
\ No newline at end of file
@@ -3,4 +3,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
-application = get_asgi_application()
\ No newline at end of file
+application = get_asgi_application()
+
+# Serving processes only; management commands load the apps without warming up
+from chat.rag_pipeline import warm_up_on_startup
+warm_up_on_startup()
\ No newline at end of file
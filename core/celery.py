@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
@@ -7,13 +8,47 @@ app = Celery('core')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
+@worker_process_init.connect
+def warm_up_rag(**kwargs):
+    # Each pool process warms its own pipeline; the prefork parent never serves tasks
+    from chat.rag_pipeline import warm_up_on_startup
+    warm_up_on_startup()
+
 app.conf.beat_schedule = {
     'cleanup-old-chats-every-day': {
         'task': 'chat.tasks.cleanup_old_chats',
         'schedule': 86400.0,  # Every 24 hours
     },
+    'archive-idle-chats-every-day': {
+        'task': 'chat.tasks.archive_idle_chats',
+        'schedule': 86400.0,  # Every 24 hours
+    },
+    'roll-up-daily-stats': {
+        'task': 'chat.tasks.roll_up_daily_stats',
+        'schedule': 300.0,  # Every 5 minutes, folds in what arrived since the last run
+    },
+    'sweep-chat-jobs': {
+        'task': 'chat.tasks.sweep_chat_jobs',
+        'schedule': 60.0,  # Every minute, resends chat jobs a lost enqueue or a dead worker left behind
+    },
     'send-daily-stats': {
         'task': 'chat.tasks.send_daily_stats',
         'schedule': 86400.0,  # Every 24 hours
     },
+    'ingest-pending-documents': {
+        'task': 'knowledge.tasks.ingest_pending_documents',
+        'schedule': 300.0,  # Every 5 minutes, picks up anything a lost enqueue missed
+    },
+    'compact-knowledge-index': {
+        'task': 'chat.tasks.compact_knowledge_index',
+        'schedule': 3600.0,  # Every hour
+    },
+    'retrain-knowledge-index': {
+        'task': 'chat.tasks.retrain_knowledge_index',
+        'schedule': 86400.0,  # Every 24 hours, a no-op unless the corpus has drifted
+    },
+    'replay-knowledge-index-log': {
+        'task': 'chat.tasks.replay_knowledge_index_log',
+        'schedule': 300.0,  # Every 5 minutes, finishes what a crashed writer left in the log
+    },
 }
\ No newline at end of file
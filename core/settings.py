@@ -129,6 +129,85 @@ CORS_ALLOW_ALL_ORIGINS = True
 # OpenAI Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+# RAG Configuration
+RAG_WARMUP_ON_STARTUP = os.getenv('RAG_WARMUP_ON_STARTUP', 'False') == 'True'
+RAG_COMPACTION_MIN_DELTAS = int(os.getenv('RAG_COMPACTION_MIN_DELTAS', 10))
+RAG_QUERY_CACHE_SIZE = int(os.getenv('RAG_QUERY_CACHE_SIZE', 1024))
+RAG_QUERY_CACHE_TTL = int(os.getenv('RAG_QUERY_CACHE_TTL', 300))  # Seconds
+# 'dense' (vectors only) or 'hybrid' (vectors + BM25 fused by reciprocal rank)
+RAG_RETRIEVAL_MODE = os.getenv('RAG_RETRIEVAL_MODE', 'dense')
+RAG_RRF_K = int(os.getenv('RAG_RRF_K', 60))
+KNOWLEDGE_INGEST_BATCH_SIZE = int(os.getenv('KNOWLEDGE_INGEST_BATCH_SIZE', 64))
+KNOWLEDGE_INGEST_MAX_BATCHES = int(os.getenv('KNOWLEDGE_INGEST_MAX_BATCHES', 50))
+KNOWLEDGE_INGEST_STALE_SECONDS = int(os.getenv('KNOWLEDGE_INGEST_STALE_SECONDS', 900))  # Indexing longer: the worker died
+
+# ANN index: 'auto' picks flat / ivf_flat / ivf_pq from corpus size; or force one, or 'hnsw'
+RAG_INDEX_TYPE = os.getenv('RAG_INDEX_TYPE', 'auto')
+RAG_FLAT_MAX_VECTORS = int(os.getenv('RAG_FLAT_MAX_VECTORS', 10000))
+RAG_IVF_PQ_MIN_VECTORS = int(os.getenv('RAG_IVF_PQ_MIN_VECTORS', 1000000))
+RAG_IVF_NLIST = int(os.getenv('RAG_IVF_NLIST', 0))  # 0 = about 4 * sqrt(vectors)
+RAG_IVF_NPROBE = int(os.getenv('RAG_IVF_NPROBE', 16))
+RAG_PQ_M = int(os.getenv('RAG_PQ_M', 16))
+RAG_HNSW_M = int(os.getenv('RAG_HNSW_M', 32))
+RAG_HNSW_EF_CONSTRUCTION = int(os.getenv('RAG_HNSW_EF_CONSTRUCTION', 80))
+RAG_HNSW_EF_SEARCH = int(os.getenv('RAG_HNSW_EF_SEARCH', 64))
+RAG_ANN_RETRAIN_GROWTH = float(os.getenv('RAG_ANN_RETRAIN_GROWTH', 2.0))  # Retrain once the corpus doubles
+# Set in web (serving) processes: memory-map the shared index and refuse index writes
+RAG_INDEX_READ_ONLY = os.getenv('RAG_INDEX_READ_ONLY', 'False') == 'True'
+# How often workers check the CURRENT pointer for a newly published index (0 disables)
+RAG_INDEX_POLL_INTERVAL = float(os.getenv('RAG_INDEX_POLL_INTERVAL', 5))  # Seconds
+RAG_INDEX_KEEP_VERSIONS = int(os.getenv('RAG_INDEX_KEEP_VERSIONS', 2))  # Superseded versions kept on disk
+
+# Async chat path (ASGI): threads for embedding/FAISS work, pooled OpenAI connections
+RAG_EXECUTOR_WORKERS = int(os.getenv('RAG_EXECUTOR_WORKERS', 4))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 200))
+
+# Semantic answer cache: reuse an answer when a similar question retrieves the same chunks
+CHAT_RESPONSE_CACHE_ENABLED = os.getenv('CHAT_RESPONSE_CACHE_ENABLED', 'False') == 'True'
+CHAT_RESPONSE_CACHE_THRESHOLD = float(os.getenv('CHAT_RESPONSE_CACHE_THRESHOLD', 0.95))
+CHAT_RESPONSE_CACHE_SIZE = int(os.getenv('CHAT_RESPONSE_CACHE_SIZE', 1024))
+CHAT_RESPONSE_CACHE_TTL = int(os.getenv('CHAT_RESPONSE_CACHE_TTL', 3600))  # Seconds
+
+# Prompt token budget (model tokenizer): gpt-3.5-turbo's 4096-token window minus room for max_tokens
+CHAT_PROMPT_TOKEN_BUDGET = int(os.getenv('CHAT_PROMPT_TOKEN_BUDGET', 3000))
+CHAT_CONTEXT_CHUNK_MAX_TOKENS = int(os.getenv('CHAT_CONTEXT_CHUNK_MAX_TOKENS', 300))
+
+# Conversation memory: the last CHAT_RECENT_TURNS turns are sent verbatim, older ones as a running
+# summary that a Celery task extends once CHAT_SUMMARY_EVERY_TURNS more turns have aged out
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv('CHAT_HISTORY_MAX_MESSAGES', 10))  # Cap while the summary catches up
+CHAT_RECENT_TURNS = int(os.getenv('CHAT_RECENT_TURNS', 2))
+CHAT_SUMMARY_EVERY_TURNS = int(os.getenv('CHAT_SUMMARY_EVERY_TURNS', 2))
+CHAT_SUMMARY_BATCH_MESSAGES = int(os.getenv('CHAT_SUMMARY_BATCH_MESSAGES', 12))
+
+# Cold storage: sessions idle this many days move to ArchivedSession, one compressed blob each (0 disables)
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', 30))
+CHAT_ARCHIVE_BATCH_SIZE = int(os.getenv('CHAT_ARCHIVE_BATCH_SIZE', 200))  # Sessions moved per transaction
+
+# Chat retention: a session, live or archived, is deleted once idle this many days (0 keeps forever). Plans are
+# auth groups, e.g. CHAT_RETENTION_PLAN_DAYS=pro:730,enterprise:0; a UserRetention row overrides both per user
+CHAT_RETENTION_DAYS = int(os.getenv('CHAT_RETENTION_DAYS', 365))
+CHAT_RETENTION_PLAN_DAYS = {
+    plan.strip(): int(days)
+    for plan, days in (item.split(':') for item in os.getenv('CHAT_RETENTION_PLAN_DAYS', '').split(',') if item.strip())
+}
+CHAT_RETENTION_BATCH_SIZE = int(os.getenv('CHAT_RETENTION_BATCH_SIZE', 500))  # Sessions deleted per transaction
+CHAT_RETENTION_BATCH_MESSAGES = int(os.getenv('CHAT_RETENTION_BATCH_MESSAGES', 20000))  # Cuts a batch short
+CHAT_RETENTION_BATCH_PAUSE = float(os.getenv('CHAT_RETENTION_BATCH_PAUSE', 0.05))  # Seconds between batches
+CHAT_RETENTION_MAX_SECONDS = float(os.getenv('CHAT_RETENTION_MAX_SECONDS', 300))  # Per run; the next resumes
+
+# DailyStats rollup: rows folded per transaction, and how old a row must be before it is counted
+CHAT_STATS_BATCH_SIZE = int(os.getenv('CHAT_STATS_BATCH_SIZE', 5000))
+CHAT_STATS_SETTLE_SECONDS = float(os.getenv('CHAT_STATS_SETTLE_SECONDS', 60))
+
+# Background chat jobs (/api/chat/send/?async=1): answered by Celery workers consuming CHAT_JOB_QUEUE
+CHAT_JOB_QUEUE = os.getenv('CHAT_JOB_QUEUE', 'celery')  # e.g. chat_generation, to scale those workers apart
+CHAT_JOB_REQUEUE_SECONDS = int(os.getenv('CHAT_JOB_REQUEUE_SECONDS', 60))  # Resend jobs still queued after this
+CHAT_JOB_TIMEOUT_SECONDS = int(os.getenv('CHAT_JOB_TIMEOUT_SECONDS', 300))  # Running longer: the worker died
+CHAT_JOB_MAX_ATTEMPTS = int(os.getenv('CHAT_JOB_MAX_ATTEMPTS', 3))
+CHAT_JOB_KEEP_HOURS = int(os.getenv('CHAT_JOB_KEEP_HOURS', 24))  # Finished jobs are pruned after this
+CHAT_JOB_MAX_WAIT = float(os.getenv('CHAT_JOB_MAX_WAIT', 30))  # Longest long poll, in seconds
+CHAT_JOB_POLL_INTERVAL = float(os.getenv('CHAT_JOB_POLL_INTERVAL', 0.5))  # Seconds between checks while waiting
+
 # Email Configuration
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = os.getenv('EMAIL_HOST', 'smtp.gmail.com')
@@ -140,6 +219,7 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')
 # Celery Configuration
 CELERY_BROKER_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+CELERY_TASK_ROUTES = {'chat.tasks.generate_chat_reply': {'queue': CHAT_JOB_QUEUE}}
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
@@ -3,15 +3,18 @@ from .models import Document
 
 @admin.register(Document)
 class DocumentAdmin(admin.ModelAdmin):
-    list_display = ('title', 'document_type', 'source', 'is_active', 'uploaded_at')
-    list_filter = ('document_type', 'is_active', 'uploaded_at')
+    list_display = ('title', 'document_type', 'source', 'is_active', 'index_status', 'uploaded_at')
+    list_filter = ('document_type', 'is_active', 'index_status', 'uploaded_at')
     search_fields = ('title', 'content', 'source')
-    readonly_fields = ('uploaded_at', 'updated_at')
+    readonly_fields = ('index_status', 'index_error', 'indexed_at', 'uploaded_at', 'updated_at')
     
     fieldsets = (
         ('Basic Information', {
             'fields': ('title', 'content', 'document_type', 'source', 'is_active')
         }),
+        ('Indexing', {
+            'fields': ('index_status', 'index_error', 'indexed_at')
+        }),
         ('Dates', {
             'fields': ('uploaded_at', 'updated_at'),
             'classes': ('collapse',)
@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from langchain.vectorstores import FAISS
+from chat.rag_pipeline import EMBEDDING_MODEL_NAME, RAGPipeline, build_text_splitter, get_rag_pipeline
+from knowledge.models import Document
+
+REBUILD_DIR = ".rebuild"
+CHECKPOINT_FILE = "checkpoint.json"
+
+_splitter = None
+
+def _init_worker():
+    global _splitter
+    _splitter = build_text_splitter()
+
+def _split_document(document):
+    """Chunk one knowledge dict in a pool worker; returns (text, metadata) pairs"""
+    chunks = _splitter.split_documents(RAGPipeline.build_documents([document]))
+    return [(chunk.page_content, chunk.metadata) for chunk in chunks]
+
+class Command(BaseCommand):
+    help = 'Rebuild the FAISS knowledge index from active knowledge Documents (resumable)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes used for chunking')
+        parser.add_argument('--window', type=int, default=500,
+                            help='Documents read, chunked and checkpointed together')
+        parser.add_argument('--embed-batch-size', type=int, default=256,
+                            help='Chunks embedded per model call')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore any checkpoint and start from scratch')
+
+    def handle(self, *args, **options):
+        rag_pipeline = get_rag_pipeline()
+        staging = Path(rag_pipeline.knowledge_base_path) / REBUILD_DIR
+        checkpoint = self._load_checkpoint(staging, options['restart'])
+        # Index changes made while we read are kept in the log until publish_rebuild reconciles them
+        rag_pipeline.hold_log(checkpoint['started_ns'])
+
+        if checkpoint['last_document_id']:
+            self.stdout.write(
+                f"Resuming after document {checkpoint['last_document_id']} "
+                f"({checkpoint['documents']} documents, {checkpoint['chunks']} chunks done)"
+            )
+
+        documents = (
+            Document.objects.filter(is_active=True, id__gt=checkpoint['last_document_id'])
+            .order_by('id')
+            .iterator(chunk_size=options['window'])
+        )
+
+        started = time.monotonic()
+        run_documents = run_chunks = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as pool:
+            for window in self._windows(documents, options['window']):
+                chunk_lists = pool.map(_split_document, [doc.to_knowledge_dict() for doc in window], chunksize=16)
+                chunks = [chunk for chunk_list in chunk_lists for chunk in chunk_list]
+                if chunks:
+                    self._write_segment(rag_pipeline, staging, checkpoint, chunks, options['embed_batch_size'])
+
+                checkpoint['last_document_id'] = window[-1].id
+                checkpoint['documents'] += len(window)
+                checkpoint['chunks'] += len(chunks)
+                self._save_checkpoint(staging, checkpoint)
+
+                run_documents += len(window)
+                run_chunks += len(chunks)
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f"{checkpoint['documents']} documents / {checkpoint['chunks']} chunks "
+                    f"({run_documents / elapsed:.1f} docs/sec, {run_chunks / elapsed:.1f} chunks/sec)"
+                )
+
+        store = self._merge_segments(rag_pipeline, staging)
+        rag_pipeline.publish_rebuild(store, checkpoint['started_ns'])
+        # Documents saved since the rebuild started may be waiting for ingestion; leave their status alone
+        rebuild_started = datetime.fromtimestamp(checkpoint['started_ns'] / 1e9, tz=dt_timezone.utc)
+        Document.objects.filter(
+            is_active=True, id__lte=checkpoint['last_document_id'], updated_at__lt=rebuild_started
+        ).update(
+            index_status=Document.INDEX_INDEXED,
+            index_error='',
+            indexed_at=timezone.now()
+        )
+        shutil.rmtree(staging, ignore_errors=True)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt index from {checkpoint['documents']} documents ({checkpoint['chunks']} chunks) "
+            f"in {elapsed:.1f}s: {run_documents / elapsed:.1f} docs/sec, {run_chunks / elapsed:.1f} chunks/sec"
+        ))
+        if rag_pipeline.embedding_cache:
+            cache_stats = rag_pipeline.embedding_cache.stats()
+            self.stdout.write(
+                f"Embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                f"(hit rate {cache_stats['hit_rate']})"
+            )
+
+    def _windows(self, documents, size):
+        window = []
+        for document in documents:
+            window.append(document)
+            if len(window) == size:
+                yield window
+                window = []
+        if window:
+            yield window
+
+    def _load_checkpoint(self, staging, restart):
+        path = staging / CHECKPOINT_FILE
+        if not restart and path.exists():
+            checkpoint = json.loads(path.read_text())
+            if checkpoint.get('model') == EMBEDDING_MODEL_NAME:
+                return checkpoint
+            self.stdout.write(self.style.WARNING('Checkpoint was written for another model, starting over'))
+
+        shutil.rmtree(staging, ignore_errors=True)
+        (staging / 'segments').mkdir(parents=True)
+        return {
+            'model': EMBEDDING_MODEL_NAME,
+            'started_ns': time.time_ns(),
+            'last_document_id': 0,
+            'documents': 0,
+            'chunks': 0,
+            'segments': 0,
+        }
+
+    def _save_checkpoint(self, staging, checkpoint):
+        tmp_path = staging / f".{CHECKPOINT_FILE}"
+        tmp_path.write_text(json.dumps(checkpoint))
+        os.replace(tmp_path, staging / CHECKPOINT_FILE)
+
+    def _write_segment(self, rag_pipeline, staging, checkpoint, chunks, embed_batch_size):
+        """Embed a window's chunks in large batches and persist them as one staging segment"""
+        texts = [text for text, _ in chunks]
+        embeddings = []
+        for start in range(0, len(texts), embed_batch_size):
+            embeddings.extend(rag_pipeline.embeddings.embed_documents(texts[start:start + embed_batch_size]))
+
+        segment = FAISS.from_embeddings(
+            list(zip(texts, embeddings)),
+            rag_pipeline.embeddings,
+            metadatas=[metadata for _, metadata in chunks]
+        )
+        # Segment numbers come from the checkpoint, so a window redone after a crash overwrites its own segment
+        segment_path = staging / 'segments' / f"{checkpoint['segments']:08d}"
+        shutil.rmtree(segment_path, ignore_errors=True)
+        segment.save_local(str(segment_path))
+        checkpoint['segments'] += 1
+
+    def _merge_segments(self, rag_pipeline, staging):
+        segment_paths = sorted((staging / 'segments').iterdir())
+        if not segment_paths:
+            return FAISS.from_documents(
+                RAGPipeline.build_documents([{'content': 'This is a placeholder document.',
+                                              'source': 'system', 'title': 'Placeholder'}]),
+                rag_pipeline.embeddings
+            )
+
+        store = FAISS.load_local(str(segment_paths[0]), rag_pipeline.embeddings)
+        for segment_path in segment_paths[1:]:
+            store.merge_from(FAISS.load_local(str(segment_path), rag_pipeline.embeddings))
+        return store
\ No newline at end of file
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Document',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=200)),
+                ('content', models.TextField()),
+                ('source', models.CharField(blank=True, max_length=200)),
+                ('document_type', models.CharField(choices=[('faq', 'FAQ'), ('article', 'Article'), ('manual', 'Manual'), ('knowledge_base', 'Knowledge Base'), ('other', 'Other')], default='article', max_length=50)),
+                ('is_active', models.BooleanField(default=True)),
+                ('index_status', models.CharField(choices=[('pending', 'Pending'), ('indexing', 'Indexing'), ('indexed', 'Indexed'), ('failed', 'Failed')], db_index=True, default='pending', max_length=20)),
+                ('index_error', models.TextField(blank=True)),
+                ('indexed_at', models.DateTimeField(blank=True, null=True)),
+                ('uploaded_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['-uploaded_at'],
+            },
+        ),
+    ]
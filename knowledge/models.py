@@ -1,6 +1,11 @@
 from django.db import models
 
 class Document(models.Model):
+    INDEX_PENDING = 'pending'
+    INDEX_INDEXING = 'indexing'
+    INDEX_INDEXED = 'indexed'
+    INDEX_FAILED = 'failed'
+
     title = models.CharField(max_length=200)
     content = models.TextField()
     source = models.CharField(max_length=200, blank=True)
@@ -12,6 +17,14 @@ class Document(models.Model):
         ('other', 'Other')
     ], default='article')
     is_active = models.BooleanField(default=True)
+    index_status = models.CharField(max_length=20, choices=[
+        (INDEX_PENDING, 'Pending'),
+        (INDEX_INDEXING, 'Indexing'),
+        (INDEX_INDEXED, 'Indexed'),
+        (INDEX_FAILED, 'Failed')
+    ], default=INDEX_PENDING, db_index=True)
+    index_error = models.TextField(blank=True)
+    indexed_at = models.DateTimeField(null=True, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -21,6 +34,17 @@ class Document(models.Model):
     def __str__(self):
         return self.title
     
+    def to_knowledge_dict(self):
+        """Shape expected by RAGPipeline.update_knowledge_base"""
+        return {
+            'id': self.id,
+            'title': self.title,
+            'content': self.content,
+            'source': self.source,
+            'type': self.document_type,
+            'added_at': self.uploaded_at.isoformat()
+        }
+    
     def save(self, *args, **kwargs):
         # Auto-extract title from content if not provided
         if not self.title and self.content:
@@ -4,8 +4,9 @@ from .models import Document
 class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
-        fields = ['id', 'title', 'content', 'source', 'document_type', 'is_active', 'uploaded_at', 'updated_at']
-        read_only_fields = ['id', 'uploaded_at', 'updated_at']
+        fields = ['id', 'title', 'content', 'source', 'document_type', 'is_active',
+                  'index_status', 'index_error', 'indexed_at', 'uploaded_at', 'updated_at']
+        read_only_fields = ['id', 'index_status', 'index_error', 'indexed_at', 'uploaded_at', 'updated_at']
     
     def validate_content(self, value):
         if len(value.strip()) < 10:
@@ -0,0 +1,103 @@
+from datetime import timedelta
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Document
+
+def _claim_pending_batch(batch_size):
+    """Mark up to batch_size pending documents as indexing and return them"""
+    with transaction.atomic():
+        documents = list(
+            Document.objects.select_for_update(skip_locked=True)
+            .filter(index_status=Document.INDEX_PENDING, is_active=True)
+            .order_by('id')[:batch_size]
+        )
+        # updated_at dates the claim, so _release_stale_claims can tell a dead worker's rows
+        Document.objects.filter(id__in=[doc.id for doc in documents]).update(
+            index_status=Document.INDEX_INDEXING,
+            updated_at=timezone.now()
+        )
+    return documents
+
+def _release_stale_claims(timeout):
+    """Return documents a worker claimed but never finished (it died mid-batch) to pending"""
+    return Document.objects.filter(
+        index_status=Document.INDEX_INDEXING,
+        updated_at__lt=timezone.now() - timedelta(seconds=timeout)
+    ).update(index_status=Document.INDEX_PENDING)
+
+@shared_task
+def ingest_pending_documents(batch_size=None, max_batches=None):
+    """
+    Embed pending knowledge documents in batches and commit each batch to the index once
+    """
+    from chat.rag_pipeline import get_rag_pipeline
+
+    batch_size = batch_size or getattr(settings, 'KNOWLEDGE_INGEST_BATCH_SIZE', 64)
+    max_batches = max_batches or getattr(settings, 'KNOWLEDGE_INGEST_MAX_BATCHES', 50)
+    indexed = failed = batches = 0
+
+    released = _release_stale_claims(getattr(settings, 'KNOWLEDGE_INGEST_STALE_SECONDS', 900))
+    rag_pipeline = get_rag_pipeline()
+    while batches < max_batches:
+        documents = _claim_pending_batch(batch_size)
+        if not documents:
+            break
+        batches += 1
+        ids = [doc.id for doc in documents]
+
+        try:
+            rag_pipeline.update_knowledge_base([doc.to_knowledge_dict() for doc in documents])
+        except Exception as e:
+            failed += Document.objects.filter(id__in=ids, index_status=Document.INDEX_INDEXING).update(
+                index_status=Document.INDEX_FAILED,
+                index_error=str(e)[:1000]
+            )
+            continue
+
+        # A document edited since the claim went back to pending and stays there for the next batch
+        indexed += Document.objects.filter(id__in=ids, index_status=Document.INDEX_INDEXING).update(
+            index_status=Document.INDEX_INDEXED,
+            index_error='',
+            indexed_at=timezone.now()
+        )
+
+    # More work than one run is allowed to take; hand the rest to a fresh task
+    if batches == max_batches and Document.objects.filter(
+        index_status=Document.INDEX_PENDING, is_active=True
+    ).exists():
+        ingest_pending_documents.delay(batch_size=batch_size, max_batches=max_batches)
+
+    return {
+        'task': 'ingest_pending_documents',
+        'status': 'success',
+        'batches': batches,
+        'released_documents': released,
+        'indexed_documents': indexed,
+        'failed_documents': failed,
+        'timestamp': timezone.now().isoformat()
+    }
+
+@shared_task
+def remove_documents_from_index(document_ids):
+    """
+    Tombstone the vectors of deleted or deactivated knowledge documents
+    """
+    from chat.rag_pipeline import get_rag_pipeline
+
+    try:
+        removed = get_rag_pipeline().remove_documents(document_ids)
+        return {
+            'task': 'remove_documents_from_index',
+            'status': 'success',
+            'removed_chunks': removed,
+            'timestamp': timezone.now().isoformat()
+        }
+    except Exception as e:
+        return {
+            'task': 'remove_documents_from_index',
+            'status': 'error',
+            'error': str(e),
+            'timestamp': timezone.now().isoformat()
+        }
\ No newline at end of file
@@ -0,0 +1,192 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from chat.tests import RAGPipelineTestCase, create_user
+from .management.commands.rebuild_knowledge_index import Command
+from .models import Document
+from .tasks import _claim_pending_batch, ingest_pending_documents
+
+class IngestPendingDocumentsTests(TestCase):
+    def setUp(self):
+        self.pipeline = mock.Mock()
+        patcher = mock.patch('chat.rag_pipeline.get_rag_pipeline', return_value=self.pipeline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_indexes_pending_documents(self):
+        document = Document.objects.create(title='Refunds', content='Refunds take five days.')
+
+        result = ingest_pending_documents()
+
+        document.refresh_from_db()
+        self.assertEqual(document.index_status, Document.INDEX_INDEXED)
+        self.assertEqual(result['indexed_documents'], 1)
+        self.pipeline.update_knowledge_base.assert_called_once_with([document.to_knowledge_dict()])
+
+    def edit_mid_batch(self, document, content, error=None):
+        """Make the first index call race with an admin edit, the way perform_update saves it"""
+        def update_knowledge_base(documents):
+            if self.pipeline.update_knowledge_base.call_count == 1:
+                edited = Document.objects.get(id=document.id)
+                edited.content = content
+                edited.index_status = Document.INDEX_PENDING
+                edited.save()
+                if error:
+                    raise error
+        self.pipeline.update_knowledge_base.side_effect = update_knowledge_base
+
+    def test_edit_during_ingest_is_indexed_again(self):
+        document = Document.objects.create(title='Refunds', content='Refunds take five days.')
+        self.edit_mid_batch(document, 'Refunds take two days.')
+
+        result = ingest_pending_documents()
+
+        document.refresh_from_db()
+        self.assertEqual(document.index_status, Document.INDEX_INDEXED)
+        self.assertEqual(result['indexed_documents'], 1)
+        last_call = self.pipeline.update_knowledge_base.call_args_list[-1]
+        self.assertEqual(last_call.args[0][0]['content'], 'Refunds take two days.')
+
+    def test_edit_during_failed_ingest_is_not_marked_failed(self):
+        document = Document.objects.create(title='Refunds', content='Refunds take five days.')
+        self.edit_mid_batch(document, 'Refunds take two days.', error=RuntimeError('index unavailable'))
+
+        result = ingest_pending_documents()
+
+        document.refresh_from_db()
+        self.assertEqual(result['failed_documents'], 0)
+        self.assertEqual(document.index_status, Document.INDEX_INDEXED)
+        self.assertEqual(self.pipeline.update_knowledge_base.call_count, 2)
+
+    @override_settings(KNOWLEDGE_INGEST_STALE_SECONDS=900)
+    def test_releases_claims_of_a_dead_worker(self):
+        stale = Document.objects.create(title='Stale', content='Claimed by a worker that died.')
+        fresh = Document.objects.create(title='Fresh', content='Claimed by a worker still running.')
+        _claim_pending_batch(10)
+        Document.objects.filter(id=stale.id).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        result = ingest_pending_documents()
+
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual(result['released_documents'], 1)
+        self.assertEqual(stale.index_status, Document.INDEX_INDEXED)
+        self.assertEqual(fresh.index_status, Document.INDEX_INDEXING)
+
+class RebuildKnowledgeIndexTests(RAGPipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pipeline = self.open_pipeline()
+        for target in ('knowledge.management.commands.rebuild_knowledge_index.get_rag_pipeline',
+                       'chat.rag_pipeline.get_rag_pipeline'):
+            patcher = mock.patch(target, return_value=self.pipeline)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def rebuild(self, during_rebuild):
+        """Run the rebuild with during_rebuild() happening after every document was read"""
+        merge_segments = Command._merge_segments
+
+        def merge_after_changes(command, *args):
+            during_rebuild()
+            return merge_segments(command, *args)
+
+        with mock.patch.object(Command, '_merge_segments', merge_after_changes):
+            call_command('rebuild_knowledge_index', workers=1, stdout=StringIO())
+
+    def test_changes_during_rebuild_are_not_undone(self):
+        edited = Document.objects.create(title='Edited', content='alpha beta old text')
+        removed = Document.objects.create(title='Removed', content='gamma delta to be deleted')
+        ingest_pending_documents()
+
+        def edit_and_delete():
+            edited.content = 'alpha beta new text'
+            edited.index_status = Document.INDEX_PENDING
+            edited.save()
+            ingest_pending_documents()
+            removed_id = removed.id
+            removed.delete()
+            self.pipeline.remove_documents([removed_id])
+
+        self.rebuild(edit_and_delete)
+
+        self.assertEqual(self.texts(self.pipeline.retrieve('alpha beta', k=5)), ['alpha beta new text'])
+        self.assertNotIn('gamma delta to be deleted', self.texts(self.pipeline.retrieve('gamma delta', k=5)))
+        reopened = self.open_pipeline()
+        self.assertEqual(self.texts(reopened.retrieve('alpha beta', k=5)), ['alpha beta new text'])
+
+    def test_interrupted_rebuild_resumes_from_its_checkpoint(self):
+        for word in ('north', 'south', 'east'):
+            Document.objects.create(title=word, content=f"{word} warehouse hours")
+        write_segment = Command._write_segment
+        written, crashes = [], ['worker killed']
+
+        def crash_once_on_second_window(command, rag_pipeline, staging, checkpoint, chunks, embed_batch_size):
+            if len(written) == 1 and crashes:
+                raise RuntimeError(crashes.pop())
+            written.extend(text for text, _ in chunks)
+            return write_segment(command, rag_pipeline, staging, checkpoint, chunks, embed_batch_size)
+
+        output = StringIO()
+        with mock.patch.object(Command, '_write_segment', crash_once_on_second_window):
+            with self.assertRaises(RuntimeError):
+                call_command('rebuild_knowledge_index', workers=1, window=1, stdout=StringIO())
+            call_command('rebuild_knowledge_index', workers=1, window=1, stdout=output)
+
+        self.assertIn('Resuming after document', output.getvalue())
+        self.assertEqual(written, ['north warehouse hours', 'south warehouse hours', 'east warehouse hours'])
+        self.assertEqual(self.texts(self.pipeline.retrieve('warehouse hours', k=5)),
+                         ['east warehouse hours', 'north warehouse hours', 'south warehouse hours'])
+
+    def test_documents_queued_during_rebuild_stay_pending(self):
+        document = Document.objects.create(title='Queued', content='epsilon zeta first draft')
+        ingest_pending_documents()
+
+        def edit():
+            document.content = 'epsilon zeta second draft'
+            document.index_status = Document.INDEX_PENDING
+            document.save()
+
+        self.rebuild(edit)
+
+        document.refresh_from_db()
+        self.assertEqual(document.index_status, Document.INDEX_PENDING)
+
+class DocumentDetailViewTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(create_user(is_staff=True))
+        self.document = Document.objects.create(
+            title='Refunds', content='Refunds take five days.', index_status=Document.INDEX_INDEXED
+        )
+        self.url = reverse('document-detail', args=[self.document.id])
+
+    def test_content_edit_queues_reindexing(self):
+        with mock.patch('knowledge.views.ingest_pending_documents') as ingest, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(self.url, {'content': 'Refunds take two days.'}, format='json')
+
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.index_status, Document.INDEX_PENDING)
+        ingest.delay.assert_called_once_with()
+
+    def test_deactivation_removes_the_documents_chunks(self):
+        with mock.patch('knowledge.views.remove_documents_from_index') as remove, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(self.url, {'is_active': False}, format='json')
+
+        remove.delay.assert_called_once_with([self.document.id])
+
+    def test_edit_that_changes_nothing_indexed_is_not_requeued(self):
+        with mock.patch('knowledge.views.ingest_pending_documents') as ingest, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(self.url, {'title': 'Refunds'}, format='json')
+
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.index_status, Document.INDEX_INDEXED)
+        ingest.delay.assert_not_called()
@@ -1,9 +1,12 @@
+from django.db import transaction
+from django.db.models import Count
 from rest_framework import generics, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from .models import Document
 from .serializers import DocumentSerializer
-from chat.rag_pipeline import RAGPipeline
+from .tasks import ingest_pending_documents, remove_documents_from_index
+from chat.rag_pipeline import get_rag_pipeline
 
 class DocumentListView(generics.ListCreateAPIView):
     queryset = Document.objects.filter(is_active=True)
@@ -11,33 +14,58 @@ class DocumentListView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAdminUser]  # Only admins can manage knowledge base
     
     def perform_create(self, serializer):
-        document = serializer.save()
+        serializer.save(index_status=Document.INDEX_PENDING)
         
-        # Update RAG knowledge base
-        rag_pipeline = RAGPipeline()
-        rag_pipeline.update_knowledge_base([{
-            'title': document.title,
-            'content': document.content,
-            'source': document.source,
-            'type': document.document_type
-        }])
+        # Embedding happens in the ingestion worker; poll index_status for progress
+        transaction.on_commit(lambda: ingest_pending_documents.delay())
 
 class DocumentDetailView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Document.objects.all()
     serializer_class = DocumentSerializer
     permission_classes = [permissions.IsAdminUser]
+    
+    # Fields that end up in the embedded chunks; changing any of them means re-indexing
+    indexed_fields = ('title', 'content', 'source', 'document_type')
+    
+    def perform_update(self, serializer):
+        document = serializer.instance
+        data = serializer.validated_data
+        was_active = document.is_active
+        is_active = data.get('is_active', was_active)
+        changed = any(field in data and data[field] != getattr(document, field) for field in self.indexed_fields)
+        
+        if was_active and not is_active:
+            # Back to pending so re-activating the document queues it for ingestion
+            serializer.save(index_status=Document.INDEX_PENDING)
+            transaction.on_commit(lambda: remove_documents_from_index.delay([document.pk]))
+        elif is_active and (changed or not was_active):
+            # Ingestion replaces the document's old chunks with the new ones
+            serializer.save(index_status=Document.INDEX_PENDING)
+            transaction.on_commit(lambda: ingest_pending_documents.delay())
+        else:
+            serializer.save()
+    
+    def perform_destroy(self, instance):
+        document_id = instance.pk
+        instance.delete()
+        transaction.on_commit(lambda: remove_documents_from_index.delay([document_id]))
 
 class KnowledgeBaseStatsView(APIView):
     permission_classes = [permissions.IsAdminUser]
     
     def get(self, request):
-        rag_pipeline = RAGPipeline()
+        rag_pipeline = get_rag_pipeline()
         stats = rag_pipeline.get_stats()
         
+        index_status = dict(
+            Document.objects.values_list('index_status').annotate(count=Count('id')).order_by()
+        )
+        
         return Response({
             'database_stats': {
                 'total_documents': Document.objects.count(),
                 'active_documents': Document.objects.filter(is_active=True).count(),
+                'index_status': index_status,
             },
             'vector_store_stats': stats,
         })
\ No newline at end of file